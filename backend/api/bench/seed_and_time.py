@@ -0,0 +1,261 @@
+"""Seed a scratch database and time the hot read paths of the API.
+
+    DATABASE_URL=postgres://... python backend/api/bench/seed_and_time.py [feed] [stories] [users] [posts]
+
+Run it only against a disposable database with all db_migrations applied.
+It tops tables up to the target sizes with synthetic rows, so a re-run skips
+the seeding, and then calls the handlers from index.py directly. Sizes can be
+scaled down for a quick pass with BENCH_SCALE=0.1.
+"""
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'index.py')
+BENCH_SCALE = float(os.environ.get('BENCH_SCALE', '1'))
+BENCH_RUNS = int(os.environ.get('BENCH_RUNS', '50'))
+SEED_CHUNK = 250000
+SEED_AUTHORS = 100000
+SEED_VOCABULARY = 50000
+SEED_DAYS = 30
+
+TARGETS = {
+    'feed': {'posts': 1000000},
+    'stories': {'users': 200000, 'stories': 100000},
+    'users': {'users': 1000000},
+    'posts': {'posts': 5000000},
+}
+
+
+def load_api():
+    spec = importlib.util.spec_from_file_location('api', API_PATH)
+    api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(api)
+    return api
+
+
+def scaled(n):
+    return max(int(n * BENCH_SCALE), 1)
+
+
+def count(cur, table, where='TRUE'):
+    cur.execute("SELECT COUNT(*) FROM %s WHERE %s" % (table, where))
+    return cur.fetchone()[0]
+
+
+def seed_in_chunks(conn, label, have, target, sql):
+    cur = conn.cursor()
+    started = time.time()
+    while have < target:
+        n = min(SEED_CHUNK, target - have)
+        cur.execute(sql % {'lo': have + 1, 'hi': have + n})
+        conn.commit()
+        have += n
+        print('  seeded %s %d/%d (%.0fs)' % (label, have, target, time.time() - started), flush=True)
+
+
+def seed_users(conn, target):
+    cur = conn.cursor()
+    seed_in_chunks(conn, 'users', count(cur, 'users'), target, """
+        INSERT INTO users (username, email, password_hash, display_name, is_verified, is_artist, created_at, search_updated_at)
+        SELECT left(md5(g::text), 6) || '_' || g, 'bench' || g || '@example.com', 'x',
+            initcap(left(md5('d' || g), 5)) || ' ' || initcap(left(md5('s' || g), 7)),
+            g %% 97 = 0, g %% 53 = 0, NOW() - INTERVAL '1 day' * (g %% 365), NOW()
+        FROM generate_series(%(lo)d, %(hi)d) g""")
+    cur.execute("DROP TABLE IF EXISTS bench_authors")
+    cur.execute("""CREATE TABLE bench_authors AS
+        SELECT ROW_NUMBER() OVER (ORDER BY id) AS idx, id FROM (SELECT id FROM users ORDER BY id LIMIT %d) u""" % SEED_AUTHORS)
+    cur.execute("CREATE UNIQUE INDEX ON bench_authors (idx)")
+    conn.commit()
+
+
+def seed_posts(conn, api, target):
+    cur = conn.cursor()
+    authors = count(cur, 'bench_authors')
+    words = "'w' || floor(exp(random() * ln(%d)))::int" % SEED_VOCABULARY
+    seed_in_chunks(conn, 'posts', count(cur, 'posts'), target, """
+        WITH fresh AS (
+            INSERT INTO posts (user_id, content, search_vector, created_at)
+            SELECT a.id, c.content, to_tsvector('%(config)s', c.content), NOW() - INTERVAL '1 second' * floor(%(span)d * (1 - g::float8 / %(target)d))
+            FROM generate_series(%%(lo)d, %%(hi)d) g
+            JOIN bench_authors a ON a.idx = 1 + abs(hashint4(g)) %%%% %(authors)d
+            CROSS JOIN LATERAL (SELECT string_agg(%(words)s, ' ') AS content FROM generate_series(1, 8 + g %%%% 12) w WHERE g > 0) c
+            RETURNING id, created_at
+        ), stats AS (
+            INSERT INTO post_stats (post_id, likes_count, comments_count, reposts_count, views_count)
+            SELECT id, floor(exp(random() * 6))::int - 1, floor(exp(random() * 4))::int - 1, floor(exp(random() * 3))::int - 1,
+                floor(exp(random() * 9))::int
+            FROM fresh RETURNING post_id, likes_count, comments_count, reposts_count, views_count
+        )
+        INSERT INTO post_scores (post_id, bucket, score)
+        SELECT f.id, FLOOR(EXTRACT(EPOCH FROM f.created_at) / 86400)::int,
+            LN(1 + s.likes_count * %(like)r + s.comments_count * %(comment)r + s.reposts_count * %(repost)r + s.views_count * %(view)r)
+                + (EXTRACT(EPOCH FROM f.created_at) - %(epoch)d) / %(tau)r
+        FROM fresh f JOIN stats s ON s.post_id = f.id""" % {
+        'span': SEED_DAYS * 86400, 'target': target, 'config': api.SEARCH_TS_CONFIG, 'authors': authors, 'words': words, 'epoch': api.RANK_EPOCH,
+        'tau': api.RANK_HALF_LIFE_HOURS * 3600 / api.math.log(2), 'like': api.RANK_WEIGHTS['like'],
+        'comment': api.RANK_WEIGHTS['comment'], 'repost': api.RANK_WEIGHTS['repost'], 'view': api.RANK_WEIGHTS['view']})
+
+
+def seed_viewer(conn, follows, blocks):
+    cur = conn.cursor()
+    cur.execute("SELECT id, username FROM users WHERE username = 'bench_viewer'")
+    row = cur.fetchone()
+    if row:
+        return {'id': str(row[0]), 'username': row[1], 'is_admin': False, 'is_blocked': False}
+    cur.execute("INSERT INTO users (username, email, password_hash) VALUES ('bench_viewer', 'bench_viewer@example.com', 'x') RETURNING id")
+    viewer = str(cur.fetchone()[0])
+    cur.execute("""INSERT INTO follows (follower_id, following_id, status)
+        SELECT '%s', id, 'accepted' FROM bench_authors WHERE idx %% %d = 0 LIMIT %d""" % (viewer, SEED_AUTHORS // follows, follows))
+    cur.execute("""INSERT INTO follows (follower_id, following_id, status)
+        SELECT id, '%s', 'accepted' FROM bench_authors WHERE idx %% %d = 0 AND idx %% 2 = 0 LIMIT %d""" % (viewer, SEED_AUTHORS // follows, follows // 2))
+    cur.execute("""INSERT INTO blocks (blocker_id, blocked_id)
+        SELECT '%s', id FROM bench_authors WHERE idx %% %d = 1 LIMIT %d""" % (viewer, SEED_AUTHORS // blocks, blocks))
+    conn.commit()
+    return {'id': viewer, 'username': 'bench_viewer', 'is_admin': False, 'is_blocked': False}
+
+
+def seed_stories(conn, api, target):
+    cur = conn.cursor()
+    api.ensure_story_partitions(cur)
+    conn.commit()
+    have = count(cur, 'stories', 'expires_at > NOW()')
+    if have >= target:
+        return
+    cur.execute("""INSERT INTO stories (user_id, image_url, visibility, created_at, expires_at)
+        SELECT a.id, 'https://example.com/s/' || g || '.jpg', (ARRAY['all', 'all', 'followers', 'mutual'])[1 + g %% 4],
+            NOW() - INTERVAL '1 second' * (g %% 80000), NOW() + INTERVAL '1 second' * (86400 - g %% 80000)
+        FROM generate_series(1, %d) g JOIN bench_authors a ON a.idx = 1 + abs(hashint4(g)) %% %d""" % (target - have, count(cur, 'bench_authors')))
+    conn.commit()
+    print('  seeded stories %d' % target, flush=True)
+
+
+def timed(conn, label, call, runs=None):
+    runs = runs or BENCH_RUNS
+    call()
+    conn.rollback()
+    samples = []
+    size = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = call()
+        samples.append((time.perf_counter() - started) * 1000)
+        conn.rollback()
+        body = json.loads(result['body']) if result['statusCode'] == 200 else {}
+        size = len(body['items'] if isinstance(body, dict) and 'items' in body else body)
+    samples.sort()
+    line = '%-44s p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms  rows %d' % (
+        label, samples[len(samples) // 2], samples[int(len(samples) * 0.95) - 1], samples[-1], size)
+    print(line, flush=True)
+    return line
+
+
+def next_cursor(api, conn, handler, params, user, pages):
+    cursor = None
+    for _ in range(pages):
+        body = json.loads(handler(conn, dict(params, cursor=cursor or ''), user)['body'])
+        cursor = body.get('next_cursor')
+        conn.rollback()
+    return cursor
+
+
+def analyze(conn, *tables):
+    conn.commit()
+    conn.autocommit = True
+    try:
+        for table in tables:
+            conn.cursor().execute("VACUUM ANALYZE %s" % table)
+    finally:
+        conn.autocommit = False
+
+
+def bench_feed(conn, api):
+    seed_users(conn, scaled(SEED_AUTHORS))
+    seed_posts(conn, api, scaled(TARGETS['feed']['posts']))
+    viewer = seed_viewer(conn, 300, 20)
+    analyze(conn, 'posts', 'post_stats', 'post_scores', 'users', 'blocks')
+    total = count(conn.cursor(), 'posts')
+    print('feed at %d posts' % total)
+    for mode in ('', 'top'):
+        name = mode or 'chronological'
+        timed(conn, 'feed %s page 1 (anonymous)' % name, lambda: api.get_feed(conn, {'mode': mode}, None))
+        timed(conn, 'feed %s page 1 (viewer, 20 blocks)' % name, lambda: api.get_feed(conn, {'mode': mode}, viewer))
+        cursor = next_cursor(api, conn, api.get_feed, {'mode': mode}, viewer, 5)
+        timed(conn, 'feed %s page 6 by cursor' % name, lambda: api.get_feed(conn, {'mode': mode, 'cursor': cursor}, viewer))
+
+
+def bench_stories(conn, api):
+    seed_users(conn, scaled(TARGETS['stories']['users']))
+    viewer = seed_viewer(conn, 300, 20)
+    seed_stories(conn, api, scaled(TARGETS['stories']['stories']))
+    analyze(conn, 'stories', 'follows', 'users')
+    print('stories at %d active stories, viewer follows %d' % (
+        count(conn.cursor(), 'stories', 'expires_at > NOW()'), count(conn.cursor(), 'follows', "follower_id = '%s'" % viewer['id'])))
+    timed(conn, 'get_stories (viewer)', lambda: api.get_stories(conn, viewer))
+
+
+def bench_users(conn, api):
+    seed_users(conn, scaled(TARGETS['users']['users']))
+    analyze(conn, 'users', 'user_avatars')
+    total = count(conn.cursor(), 'users')
+    print('user search at %d users' % total)
+    for q in ('a', 'ab', 'abc', 'ab1f'):
+        api.prefix_reset('disabled')
+        timed(conn, 'prefix %-5s postgres (index over cap)' % q, lambda: api.search_users(conn, {'q': q, 'mode': 'prefix', 'limit': '10'}, None))
+    api.SEARCH_PREFIX_MAX_USERS = total + 1
+    cur = conn.cursor()
+    api.prefix_reset('cold')
+    samples = []
+    while api._prefix_index['state'] == 'cold':
+        started = time.perf_counter()
+        api.warm_prefix_index(cur)
+        samples.append((time.perf_counter() - started) * 1000)
+        conn.rollback()
+    print('prefix index warm: %d chunks of %d, chunk p50 %.0f ms, last chunk (sort) %.0f ms, %.1fs total' % (
+        len(samples), api.SEARCH_PREFIX_WARM_BATCH, sorted(samples[:-1])[len(samples) // 2], samples[-1], sum(samples) / 1000))
+    api.prefix_reset('cold')
+    tracemalloc.start()
+    while api._prefix_index['state'] == 'cold':
+        api.warm_prefix_index(cur)
+        conn.rollback()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('prefix index memory: %.0f bytes/user' % (memory / float(total)))
+    for q in ('a', 'ab', 'abc', 'ab1f'):
+        timed(conn, 'prefix %-5s in-memory' % q, lambda: api.search_users(conn, {'q': q, 'mode': 'prefix', 'limit': '10'}, None))
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    if not cur.fetchone():
+        print('trigram search skipped: pg_trgm is not installed')
+        return
+    for q in ('ab1f', 'Abcde'):
+        timed(conn, 'trigram %-6s' % q, lambda: api.search_users(conn, {'q': q, 'limit': '10'}, None))
+
+
+def bench_posts(conn, api):
+    seed_users(conn, scaled(SEED_AUTHORS))
+    seed_posts(conn, api, scaled(TARGETS['posts']['posts']))
+    viewer = seed_viewer(conn, 300, 20)
+    analyze(conn, 'posts', 'post_stats', 'users', 'blocks')
+    total = count(conn.cursor(), 'posts')
+    print('post search at %d posts' % total)
+    for q in ('w1', 'w40', 'w900', 'w20000', 'w7 w35', '"w3 w5"'):
+        timed(conn, 'search_posts %-10s (viewer)' % q, lambda: api.search_posts(conn, {'q': q}, viewer))
+    cursor = next_cursor(api, conn, api.search_posts, {'q': 'w40'}, viewer, 5)
+    timed(conn, 'search_posts w40 page 6 by cursor', lambda: api.search_posts(conn, {'q': 'w40', 'cursor': cursor}, viewer))
+
+
+BENCHES = {'feed': bench_feed, 'stories': bench_stories, 'users': bench_users, 'posts': bench_posts}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHES)
+    api = load_api()
+    conn = api.psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        for name in names:
+            BENCHES[name](conn, api)
+    finally:
+        conn.close()
@@ -1,74 +1,1273 @@
+import base64
+import bisect
+import hashlib
+import hmac
 import json
+import math
 import os
 import psycopg2
+import psycopg2.extensions
+import re
+import sys
+import threading
+import time
 import uuid
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+PAGE_SIZE = 20
+TOMBSTONE_ID = '00000000-0000-0000-0000-000000000000'
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_POOL_MAX_LIFETIME = int(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = int(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+
+_pool = []
+_pool_born = {}
+_pool_lock = threading.Lock()
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '5000'))
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', '60'))
+AUTH_EPOCH_CHECK_AFTER = int(os.environ.get('AUTH_EPOCH_CHECK_AFTER', '5'))
+REVOKED_TOKEN_OVERLAP = 60
+USER_CARD_CACHE_SIZE = int(os.environ.get('USER_CARD_CACHE_SIZE', '10000'))
+USER_CARD_CACHE_TTL = int(os.environ.get('USER_CARD_CACHE_TTL', '30'))
+BADGE_CACHE_SIZE = int(os.environ.get('BADGE_CACHE_SIZE', '10000'))
+BADGE_CACHE_TTL = int(os.environ.get('BADGE_CACHE_TTL', '5'))
+STORIES_PER_AUTHOR = int(os.environ.get('STORIES_PER_AUTHOR', '20'))
+STORIES_AUTHOR_LIMIT = int(os.environ.get('STORIES_AUTHOR_LIMIT', '50'))
+STORY_PARTITION_AHEAD_DAYS = int(os.environ.get('STORY_PARTITION_AHEAD_DAYS', '3'))
+STORY_ARCHIVE = os.environ.get('STORY_ARCHIVE', '') == '1'
+STORY_VIEW_BATCH = 100
+SEARCH_LIMIT_MAX = 50
+SEARCH_BOOSTS = {'is_verified': 0.2, 'is_artist': 0.1}
+SEARCH_INDEX_REFRESH = int(os.environ.get('SEARCH_INDEX_REFRESH', '30'))
+SEARCH_INDEX_OVERLAP = 60
+SEARCH_PREFIX_MAX_USERS = int(os.environ.get('SEARCH_PREFIX_MAX_USERS', '50000'))
+SEARCH_PREFIX_WARM_BATCH = int(os.environ.get('SEARCH_PREFIX_WARM_BATCH', '5000'))
+SEARCH_TS_CONFIG = 'russian'
+SEARCH_RANK_CANDIDATES = int(os.environ.get('SEARCH_RANK_CANDIDATES', '200'))
+TAG_PATTERN = re.compile(r'#(\w{1,64})')
+MENTION_PATTERN = re.compile(r'@(\w{1,50})')
+MAX_TAGS = 10
+MAX_MENTIONS = 10
+TRENDING_HOURS = int(os.environ.get('TRENDING_HOURS', '24'))
+TRENDING_RETENTION_HOURS = int(os.environ.get('TRENDING_RETENTION_HOURS', '168'))
+TRENDING_CACHE_TTL = int(os.environ.get('TRENDING_CACHE_TTL', '60'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '5000'))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '30'))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', '')
+RESPONSE_CACHE_ACTIONS = {'profile': True, 'post': True, 'user_posts': True, 'followers': False, 'following': False}
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+SIGNED_TOKEN_TTL = int(os.environ.get('SIGNED_TOKEN_TTL', str(30 * 86400)))
+SESSION_MAX_AGE_DAYS = int(os.environ.get('SESSION_MAX_AGE_DAYS', '0'))
+PRUNE_BATCH_SIZE = int(os.environ.get('PRUNE_BATCH_SIZE', '5000'))
+FANOUT_LIMIT = int(os.environ.get('FANOUT_LIMIT', '5000'))
+TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL', '50'))
+RANK_EPOCH = 1700000000
+RANK_HALF_LIFE_HOURS = float(os.environ.get('RANK_HALF_LIFE_HOURS', '12'))
+RANK_WINDOW_DAYS = int(os.environ.get('RANK_WINDOW_DAYS', '3'))
+RANK_WINDOW_SIZE = int(os.environ.get('RANK_WINDOW_SIZE', '1000'))
+RANK_WEIGHTS = {'post': 1.0, 'view': 0.05, 'like': 1.0, 'comment': 3.0, 'repost': 4.0}
+RANK_UNDO = {'unlike': 'like', 'uncomment': 'comment', 'unrepost': 'repost'}
+VIEW_FLUSH_SIZE = int(os.environ.get('VIEW_FLUSH_SIZE', '200'))
+VIEW_FLUSH_SECONDS = int(os.environ.get('VIEW_FLUSH_SECONDS', '10'))
+VIEW_SKETCH = os.environ.get('VIEW_SKETCH', '') == '1'
+VIEW_SKETCH_BITS = 10
+INBOX_LEGACY_LIMIT = int(os.environ.get('INBOX_LEGACY_LIMIT', '200'))
+MESSAGE_PREVIEW_LENGTH = 200
+CONVERSATION_PAGE_SIZE = int(os.environ.get('CONVERSATION_PAGE_SIZE', '50'))
+CONVERSATION_LEGACY_LIMIT = 100
+COMMENT_PAGE_SIZE = int(os.environ.get('COMMENT_PAGE_SIZE', '20'))
+COMMENT_REPLY_PREVIEW = int(os.environ.get('COMMENT_REPLY_PREVIEW', '3'))
+SYNC_LIMIT = int(os.environ.get('SYNC_LIMIT', '200'))
+SYNC_MAX_WAIT = int(os.environ.get('SYNC_MAX_WAIT', '20'))
+SYNC_POLL_INTERVAL = float(os.environ.get('SYNC_POLL_INTERVAL', '1'))
+NOTIFY_BUCKET_SECONDS = int(os.environ.get('NOTIFY_BUCKET_SECONDS', '86400'))
+NOTIFY_RECENT_ACTORS = 3
+NOTIFY_GROUPED_TYPES = ('like', 'comment', 'follow')
+OUTBOX_INLINE = os.environ.get('OUTBOX_INLINE', '1') == '1'
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '500'))
+OUTBOX_INLINE_LIMIT = int(os.environ.get('OUTBOX_INLINE_LIMIT', '10'))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '2'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_SECONDS = int(os.environ.get('OUTBOX_RETRY_SECONDS', '30'))
+OUTBOX_RETRY_LIMIT = 20
+OUTBOX_COUNTERS = {
+    'like': ('likes_count', 1), 'unlike': ('likes_count', -1),
+    'comment': ('comments_count', 1), 'uncomment': ('comments_count', -1),
+    'repost': ('reposts_count', 1), 'unrepost': ('reposts_count', -1),
+}
+COMMENT_COUNTERS = {
+    'comment_like': ('likes_count', 1), 'comment_unlike': ('likes_count', -1),
+    'comment': ('reply_count', 1), 'uncomment': ('reply_count', -1),
+}
+USER_COUNTERS = {
+    'post': (('user_id', 'posts_count', 1),), 'unpost': (('user_id', 'posts_count', -1),),
+    'follow': (('following_id', 'followers_count', 1), ('follower_id', 'following_count', 1)),
+    'unfollow': (('following_id', 'followers_count', -1), ('follower_id', 'following_count', -1)),
+}
+
+POST_COLUMNS = """p.id, p.content, p.image_url, COALESCE(s.views_count, p.views_count), p.created_at,
+        u.id, u.username, u.display_name, u.is_verified, u.is_artist,
+        COALESCE(s.likes_count, 0), COALESCE(s.comments_count, 0), COALESCE(s.reposts_count, 0)"""
+COMMENT_COLUMNS = "c.id, c.content, c.parent_id, c.created_at, c.user_id, c.likes_count, c.reply_count"
+
+
+def close_quietly(conn):
+    _pool_born.pop(id(conn), None)
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
 
 def get_db():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    while True:
+        with _pool_lock:
+            entry = _pool.pop() if _pool else None
+        if entry is None:
+            break
+        conn, last_used = entry
+        now = time.time()
+        if conn.closed or now - _pool_born.get(id(conn), 0) > DB_POOL_MAX_LIFETIME:
+            close_quietly(conn)
+            continue
+        if now - last_used > DB_POOL_CHECK_AFTER:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                close_quietly(conn)
+                continue
+        return conn
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    _pool_born[id(conn)] = time.time()
+    return conn
+
+
+def release_db(conn):
+    if conn.closed:
+        _pool_born.pop(id(conn), None)
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool) < DB_POOL_SIZE and time.time() - _pool_born.get(id(conn), 0) <= DB_POOL_MAX_LIFETIME:
+            _pool.append((conn, time.time()))
+            return
+    close_quietly(conn)
 
 def cors_headers():
     return {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Auth-Token, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
         'Content-Type': 'application/json'
     }
 
-def get_user_by_token(headers):
+def lru_new(size, ttl):
+    return {'items': OrderedDict(), 'size': size, 'ttl': ttl, 'hits': 0, 'misses': 0, 'lock': threading.Lock()}
+
+
+def lru_get(cache, key):
+    with cache['lock']:
+        entry = cache['items'].get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del cache['items'][key]
+            cache['misses'] += 1
+            return None
+        cache['items'].move_to_end(key)
+        cache['hits'] += 1
+        return entry[1]
+
+
+def lru_put(cache, key, value, ttl=None):
+    if cache['size'] <= 0:
+        return
+    with cache['lock']:
+        cache['items'][key] = (time.time() + (ttl or cache['ttl']), value)
+        cache['items'].move_to_end(key)
+        while len(cache['items']) > cache['size']:
+            cache['items'].popitem(last=False)
+
+
+def lru_pop(cache, key):
+    with cache['lock']:
+        cache['items'].pop(key, None)
+
+
+def lru_clear(cache):
+    with cache['lock']:
+        cache['items'].clear()
+
+
+def lru_stats(cache):
+    return {'size': len(cache['items']), 'capacity': cache['size'], 'hits': cache['hits'], 'misses': cache['misses']}
+
+
+_session_cache = lru_new(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+_auth_epoch = {'version': None, 'checked': 0, 'revoked_at': None}
+
+
+def sync_auth_epoch(conn):
+    now = time.time()
+    if now - _auth_epoch['checked'] < AUTH_EPOCH_CHECK_AFTER:
+        return
+    cur = conn.cursor()
+    since = "TO_TIMESTAMP(%f) - INTERVAL '%d seconds'" % (_auth_epoch['revoked_at'], REVOKED_TOKEN_OVERLAP) if _auth_epoch['revoked_at'] else 'NOW()'
+    cur.execute("""SELECT (SELECT version FROM auth_epoch WHERE id = 1), EXTRACT(EPOCH FROM NOW()),
+        ARRAY(SELECT token_hash FROM revoked_tokens WHERE revoked_at > %s)""" % since)
+    row = cur.fetchone()
+    version = row[0] or 0
+    if version != _auth_epoch['version']:
+        lru_clear(_session_cache)
+        _auth_epoch['version'] = version
+    for digest in row[2] or []:
+        lru_pop(_session_cache, digest)
+    _auth_epoch['revoked_at'] = float(row[1])
+    _auth_epoch['checked'] = now
+
+
+def bump_auth_epoch(cur):
+    cur.execute("UPDATE auth_epoch SET version = version + 1 WHERE id = 1")
+
+
+def invalidate_sessions():
+    lru_clear(_session_cache)
+    _auth_epoch['checked'] = 0
+
+
+def token_signature(payload):
+    digest = hmac.new(SESSION_SIGNING_KEY.encode(), ('s1.' + payload).encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def verify_signed_token(token):
+    if not SESSION_SIGNING_KEY or not token.startswith('s1.'):
+        return None
+    parts = token.split('.')
+    if len(parts) != 3 or not hmac.compare_digest(token_signature(parts[1]).encode(), parts[2].encode()):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)).decode()
+        user_id, issued_at, generation = raw.split('.')
+        claims = {'user_id': str(uuid.UUID(user_id)), 'iat': int(issued_at), 'generation': int(generation)}
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if claims['iat'] + SIGNED_TOKEN_TTL < time.time():
+        return None
+    return claims
+
+
+def session_age_clause():
+    if SESSION_MAX_AGE_DAYS <= 0:
+        return ''
+    return " AND s.created_at > NOW() - INTERVAL '%d days'" % SESSION_MAX_AGE_DAYS
+
+
+def get_user_by_token(conn, headers):
     token = (headers or {}).get('X-Auth-Token', '')
     if not token:
         return None
-    conn = get_db()
+    claims = None
+    if token.startswith('s1.'):
+        claims = verify_signed_token(token)
+        if not claims:
+            return None
+    sync_auth_epoch(conn)
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    cached = lru_get(_session_cache, digest)
+    if cached:
+        return dict(cached)
     cur = conn.cursor()
-    cur.execute("SELECT id, username, is_admin, is_blocked FROM users WHERE id = (SELECT user_id FROM sessions WHERE token = '%s')" % token.replace("'", "''"))
+    if claims:
+        cur.execute("""SELECT id, username, is_admin, is_blocked FROM users
+            WHERE id = '%s' AND session_generation = %d
+            AND NOT EXISTS (SELECT 1 FROM revoked_tokens WHERE token_hash = '%s')""" % (claims['user_id'], claims['generation'], digest))
+    else:
+        cur.execute("SELECT id, username, is_admin, is_blocked FROM users WHERE id = (SELECT user_id FROM sessions s WHERE s.token = '%s'%s)" % (token.replace("'", "''"), session_age_clause()))
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
-    return {'id': str(row[0]), 'username': row[1], 'is_admin': row[2], 'is_blocked': row[3]}
+    user = {'id': str(row[0]), 'username': row[1], 'is_admin': row[2], 'is_blocked': row[3]}
+    lru_put(_session_cache, digest, user)
+    return dict(user)
+
+
+def encode_cursor(value, row_id):
+    raw = '%s|%s' % (value.isoformat() if hasattr(value, 'isoformat') else repr(value), row_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value).isoformat()
+
+
+def parse_score(value):
+    score = float(value)
+    if not math.isfinite(score):
+        raise ValueError(value)
+    return repr(score)
+
+
+def decode_cursor(cursor, parse=parse_timestamp):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        value, row_id = raw.split('|', 1)
+        return parse(value), str(uuid.UUID(row_id))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def page_params(params, column, id_column, parse=parse_timestamp, op='<'):
+    cursor = params.get('cursor')
+    if cursor is None:
+        return '', int(params.get('offset', '0'))
+    if not cursor:
+        return '', 0
+    decoded = decode_cursor(cursor, parse)
+    if not decoded:
+        raise ValueError('Invalid cursor')
+    return " AND (%s, %s) %s ('%s', '%s')" % (column, id_column, op, decoded[0], decoded[1]), 0
+
+
+def paged_response(params, items, last_row, limit=PAGE_SIZE):
+    if params.get('cursor') is None:
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(items, default=str)}
+    next_cursor = encode_cursor(last_row[0], last_row[1]) if last_row and len(items) == limit else None
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'items': items, 'next_cursor': next_cursor}, default=str)}
+
+
+_user_card_cache = lru_new(USER_CARD_CACHE_SIZE, USER_CARD_CACHE_TTL)
+_card_memo = {}
+
+
+def load_user_cards(cur, user_ids):
+    cards = {}
+    missing = []
+    for uid in set(str(i) for i in user_ids if i):
+        card = _card_memo.get(uid) or lru_get(_user_card_cache, uid)
+        if card:
+            cards[uid] = card
+        else:
+            missing.append(uid)
+    if missing:
+        cur.execute("""SELECT u.id, u.username, u.display_name, u.is_verified, u.is_artist, av.url
+            FROM users u LEFT JOIN LATERAL (
+                SELECT url FROM user_avatars WHERE user_id = u.id AND is_primary = TRUE ORDER BY created_at DESC LIMIT 1
+            ) av ON TRUE
+            WHERE u.id IN (%s)""" % ','.join(["'%s'" % uid.replace("'", "''") for uid in missing]))
+        for r in cur.fetchall():
+            card = {'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4], 'avatar': r[5]}
+            cards[card['id']] = card
+            lru_put(_user_card_cache, card['id'], card)
+    _card_memo.update(cards)
+    return dict((uid, dict(card)) for uid, card in cards.items())
+
+
+def invalidate_user_card(user_id):
+    _card_memo.pop(user_id, None)
+    lru_pop(_user_card_cache, user_id)
+
+
+def local_cache_backend(size, ttl):
+    cache = lru_new(size, ttl)
+    return {
+        'get_many': lambda keys: dict((k, v) for k, v in ((k, lru_get(cache, k)) for k in keys) if v is not None),
+        'set': lambda key, value, ttl: lru_put(cache, key, value, ttl),
+        'delete': lambda key: lru_pop(cache, key),
+        'stats': lambda: dict(lru_stats(cache), backend='local'),
+    }
+
+
+def shared_cache_backend(client, prefix='online:'):
+    def get_many(keys):
+        names = [prefix + k for k in keys]
+        values = client.mget(names) if hasattr(client, 'mget') else [client.get(n) for n in names]
+        return dict((k, json.loads(v)) for k, v in zip(keys, values) if v is not None)
+    return {
+        'get_many': get_many,
+        'set': lambda key, value, ttl: client.set(prefix + key, json.dumps(value), ex=ttl),
+        'delete': lambda key: client.delete(prefix + key),
+        'stats': lambda: {'backend': 'shared', 'prefix': prefix},
+    }
+
+
+def make_response_cache():
+    if RESPONSE_CACHE_URL:
+        try:
+            import redis
+            return shared_cache_backend(redis.Redis.from_url(RESPONSE_CACHE_URL, socket_timeout=0.2))
+        except ImportError:
+            pass
+    return local_cache_backend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+_response_cache = make_response_cache()
+
+
+def response_tags(conn, action, params, viewer):
+    try:
+        if action == 'profile':
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM users WHERE username = '%s'" % params.get('username', '').replace("'", "''"))
+            row = cur.fetchone()
+            return ['user:' + str(row[0])] if row else None
+        if action == 'post':
+            return ['post:' + str(uuid.UUID(params.get('id', '')))]
+        uid = str(uuid.UUID(params.get('user_id', '')))
+    except ValueError:
+        return None
+    if action == 'user_posts':
+        return ['posts:' + uid] + (['viewer:' + viewer] if viewer else [])
+    return ['%s:%s' % (action, uid)]
+
+
+def tag_generations(tags, create=False):
+    gens = _response_cache['get_many'](['tag:' + t for t in tags])
+    if create:
+        for t in tags:
+            if 'tag:' + t not in gens:
+                gens['tag:' + t] = uuid.uuid4().hex
+                _response_cache['set']('tag:' + t, gens['tag:' + t], RESPONSE_CACHE_TTL * 4)
+    return dict((t, gens.get('tag:' + t)) for t in tags)
+
+
+def cached_response(conn, action, params, user, headers, render):
+    viewer = user['id'] if user and RESPONSE_CACHE_ACTIONS[action] else ''
+    key = 'resp:' + hashlib.sha1(json.dumps([action, sorted(params.items()), viewer]).encode()).hexdigest()
+    try:
+        entry = _response_cache['get_many']([key]).get(key)
+        if entry and tag_generations(sorted(entry['tags'])) == entry['tags']:
+            response = dict(entry['response'], headers=dict(entry['response']['headers']))
+            etag = response['headers'].get('ETag')
+            if etag and etag_matches(headers, etag):
+                return {'statusCode': 304, 'headers': etag_headers(etag), 'body': ''}
+            return response
+    except Exception:
+        pass
+    gens = None
+    try:
+        tags = response_tags(conn, action, params, viewer)
+        if tags:
+            gens = tag_generations(tags, create=True)
+    except Exception:
+        pass
+    response = render()
+    if response['statusCode'] != 200 or not gens:
+        return response
+    try:
+        if tag_generations(sorted(gens)) == gens:
+            stored = dict(response, headers=dict(response['headers']))
+            _response_cache['set'](key, {'tags': gens, 'response': stored}, RESPONSE_CACHE_TTL)
+    except Exception:
+        pass
+    return response
+
+
+def invalidate_responses(*tags):
+    for t in set(tags):
+        try:
+            _response_cache['delete']('tag:' + t)
+        except Exception:
+            pass
+
+
+def hydrate_posts(cur, posts, user):
+    if not posts:
+        return posts
+    post_ids = ','.join(["'%s'" % p['id'] for p in posts])
+    liked = set()
+    reposted = set()
+    if user:
+        cur.execute("""SELECT 'like', post_id FROM post_likes WHERE user_id = '%s' AND post_id IN (%s)
+            UNION ALL
+            SELECT 'repost', post_id FROM reposts WHERE user_id = '%s' AND post_id IN (%s)""" % (user['id'], post_ids, user['id'], post_ids))
+        for kind, pid in cur.fetchall():
+            (liked if kind == 'like' else reposted).add(str(pid))
+    cards = load_user_cards(cur, [p['user']['id'] for p in posts])
+    for post in posts:
+        post['liked'] = post['id'] in liked
+        post['reposted'] = post['id'] in reposted
+        post['user']['avatar'] = cards.get(post['user']['id'], {}).get('avatar')
+    return posts
+
+def bump_post_stats(cur, deltas):
+    if not deltas:
+        return
+    ids = sorted(deltas)
+    values = ','.join(["('%s'::uuid, %d, %d, %d)" % (pid, deltas[pid].get('likes_count', 0), deltas[pid].get('comments_count', 0), deltas[pid].get('reposts_count', 0)) for pid in ids])
+    cur.execute("SELECT post_id FROM post_stats WHERE post_id IN (%s) ORDER BY post_id FOR UPDATE" % ','.join("'%s'" % pid for pid in ids))
+    cur.execute("""UPDATE post_stats ps SET likes_count = GREATEST(ps.likes_count + v.likes, 0),
+            comments_count = GREATEST(ps.comments_count + v.comments, 0), reposts_count = GREATEST(ps.reposts_count + v.reposts, 0)
+        FROM (VALUES %s) v(post_id, likes, comments, reposts) WHERE ps.post_id = v.post_id""" % values)
+    cur.execute("""INSERT INTO post_stats (post_id, likes_count, comments_count, reposts_count)
+        SELECT p.id, GREATEST(v.likes, 0), GREATEST(v.comments, 0), GREATEST(v.reposts, 0)
+        FROM (VALUES %s) v(post_id, likes, comments, reposts) JOIN posts p ON p.id = v.post_id
+        ORDER BY p.id
+        ON CONFLICT (post_id) DO NOTHING""" % values)
+
+
+def bump_comment_stats(cur, deltas):
+    if not deltas:
+        return
+    ids = sorted(deltas)
+    values = ','.join(["('%s'::uuid, %d, %d)" % (cid, deltas[cid].get('likes_count', 0), deltas[cid].get('reply_count', 0)) for cid in ids])
+    cur.execute("SELECT id FROM comments WHERE id IN (%s) ORDER BY id FOR UPDATE" % ','.join("'%s'" % cid for cid in ids))
+    cur.execute("""UPDATE comments c SET likes_count = GREATEST(c.likes_count + v.likes, 0), reply_count = GREATEST(c.reply_count + v.replies, 0)
+        FROM (VALUES %s) v(comment_id, likes, replies) WHERE c.id = v.comment_id""" % values)
+
+
+def bump_user_stats(cur, deltas):
+    if not deltas:
+        return
+    ids = sorted(deltas)
+    values = ','.join(["('%s'::uuid, %d, %d, %d)" % (uid, deltas[uid].get('followers_count', 0), deltas[uid].get('following_count', 0), deltas[uid].get('posts_count', 0)) for uid in ids])
+    cur.execute("SELECT id FROM users WHERE id IN (%s) ORDER BY id FOR UPDATE" % ','.join("'%s'" % uid for uid in ids))
+    cur.execute("""UPDATE users u SET followers_count = GREATEST(u.followers_count + v.followers, 0),
+            following_count = GREATEST(u.following_count + v.following, 0), posts_count = GREATEST(u.posts_count + v.posts, 0),
+            profile_version = u.profile_version + 1
+        FROM (VALUES %s) v(user_id, followers, following, posts) WHERE u.id = v.user_id""" % values)
+
+
+def bump_profile_version(cur, user_id):
+    cur.execute("UPDATE users SET profile_version = profile_version + 1 WHERE id = '%s'" % user_id)
+
+
+def rank_term(event, at=None):
+    tau = RANK_HALF_LIFE_HOURS * 3600 / math.log(2)
+    return math.log(RANK_WEIGHTS[event]) + ((at or time.time()) - RANK_EPOCH) / tau
+
+
+def log_sum(terms):
+    top = max(terms)
+    return top + math.log(sum(math.exp(t - top) for t in terms))
+
+
+def bump_post_scores(cur, terms):
+    if not terms:
+        return
+    values = ','.join(["('%s'::uuid, %r)" % (pid, log_sum(t)) for pid, t in sorted(terms.items())])
+    cur.execute("""UPDATE post_scores rs SET score = GREATEST(rs.score, v.term) + LN(1 + EXP(LEAST(rs.score, v.term) - GREATEST(rs.score, v.term)))
+        FROM (VALUES %s) v(post_id, term) WHERE rs.post_id = v.post_id""" % values)
+
+
+def drop_post_scores(cur, terms):
+    if not terms:
+        return
+    values = ','.join(["('%s'::uuid, %r)" % (pid, log_sum(t)) for pid, t in sorted(terms.items())])
+    cur.execute("""UPDATE post_scores rs SET score = rs.score + LN(GREATEST(1 - EXP(LEAST(v.term - rs.score, 0)), 1e-9))
+        FROM (VALUES %s) v(post_id, term) WHERE rs.post_id = v.post_id""" % values)
+
+
+_view_buffer = {'counts': {}, 'rows': [], 'since': time.time(), 'lock': threading.Lock()}
+
+
+def sketch_add(registers, key):
+    h = int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big')
+    index = h >> (64 - VIEW_SKETCH_BITS)
+    rest = (h << VIEW_SKETCH_BITS) & ((1 << 64) - 1)
+    rank = 1
+    while rank <= 64 - VIEW_SKETCH_BITS and not rest & (1 << 63):
+        rank += 1
+        rest <<= 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+def sketch_estimate(registers):
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(float(m) / zeros)
+    return int(round(estimate))
+
+
+def buffer_view(post_id, user, viewer_ip):
+    with _view_buffer['lock']:
+        _view_buffer['counts'][post_id] = _view_buffer['counts'].get(post_id, 0) + 1
+        _view_buffer['rows'].append((post_id, viewer_ip, user['id'] if user else None))
+
+
+def flush_views_if_due(conn):
+    pending = len(_view_buffer['rows'])
+    if pending and (pending >= VIEW_FLUSH_SIZE or time.time() - _view_buffer['since'] >= VIEW_FLUSH_SECONDS):
+        flush_views(conn)
+
+
+def flush_views(conn):
+    with _view_buffer['lock']:
+        counts, rows = _view_buffer['counts'], _view_buffer['rows']
+        _view_buffer['counts'], _view_buffer['rows'], _view_buffer['since'] = {}, [], time.time()
+    if not rows:
+        return 0
+    cur = conn.cursor()
+    try:
+        cur.execute("""INSERT INTO post_stats (post_id, views_count)
+            SELECT p.id, v.n FROM (VALUES %s) v(post_id, n) JOIN posts p ON p.id = v.post_id::uuid
+            ORDER BY p.id
+            ON CONFLICT (post_id) DO UPDATE SET views_count = post_stats.views_count + EXCLUDED.views_count""" % ','.join(["('%s', %d)" % item for item in sorted(counts.items())]))
+        cur.execute("""INSERT INTO post_views (post_id, viewer_ip, user_id)
+            SELECT p.id, v.viewer_ip, v.user_id::uuid FROM (VALUES %s) v(post_id, viewer_ip, user_id) JOIN posts p ON p.id = v.post_id::uuid""" % ','.join([
+            "('%s', %s, %s)" % (pid, "'%s'" % ip.replace("'", "''")[:45] if ip else 'NULL', "'%s'" % uid if uid else 'NULL') for pid, ip, uid in rows]))
+        bump_post_scores(cur, dict((pid, [rank_term('view') + math.log(n)]) for pid, n in counts.items()))
+        if VIEW_SKETCH:
+            update_view_sketches(cur, rows)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        with _view_buffer['lock']:
+            for pid, n in counts.items():
+                _view_buffer['counts'][pid] = _view_buffer['counts'].get(pid, 0) + n
+            _view_buffer['rows'].extend(rows)
+        return 0
+    return len(rows)
+
+
+def update_view_sketches(cur, rows):
+    post_ids = sorted(set(r[0] for r in rows))
+    cur.execute("""INSERT INTO post_view_sketches (post_id, registers, updated_at)
+        SELECT p.id, decode(repeat('00', %d), 'hex'), NOW() FROM posts p WHERE p.id IN (%s) ORDER BY p.id
+        ON CONFLICT (post_id) DO NOTHING""" % (1 << VIEW_SKETCH_BITS, ','.join(["'%s'" % pid for pid in post_ids])))
+    cur.execute("""SELECT post_id, registers FROM post_view_sketches WHERE post_id IN (%s)
+        ORDER BY post_id FOR UPDATE""" % ','.join(["'%s'" % pid for pid in post_ids]))
+    sketches = dict((str(r[0]), bytearray(bytes(r[1]))) for r in cur.fetchall())
+    for pid, ip, uid in rows:
+        if pid in sketches:
+            sketch_add(sketches[pid], uid or ip or '')
+    if not sketches:
+        return
+    cur.execute("""UPDATE post_view_sketches s SET registers = decode(v.registers, 'hex'), updated_at = NOW()
+        FROM (VALUES %s) v(post_id, registers) WHERE s.post_id = v.post_id::uuid""" % ','.join([
+        "('%s', '%s')" % (pid, bytes(registers).hex()) for pid, registers in sorted(sketches.items())]))
+
+
+def post_from_row(r):
+    return {
+        'id': str(r[0]), 'content': r[1], 'image_url': r[2], 'views_count': r[3],
+        'created_at': r[4].isoformat() if r[4] else None,
+        'user': {'id': str(r[5]), 'username': r[6], 'display_name': r[7], 'is_verified': r[8], 'is_artist': r[9]},
+        'likes_count': r[10], 'comments_count': r[11], 'reposts_count': r[12],
+        'liked': False, 'reposted': False
+    }
+
+
+def fan_out_post(cur, post_id, author_id):
+    cur.execute("""SELECT COUNT(*) FROM (SELECT 1 FROM follows WHERE following_id = '%s' AND status = 'accepted' LIMIT %d) f""" % (author_id, FANOUT_LIMIT + 1))
+    if cur.fetchone()[0] > FANOUT_LIMIT:
+        cur.execute("UPDATE users SET fanout_on_read = TRUE WHERE id = '%s' AND fanout_on_read = FALSE" % author_id)
+        cur.execute("""INSERT INTO timeline_entries (user_id, post_id, author_id, created_at)
+            SELECT user_id, id, user_id, created_at FROM posts WHERE id = '%s'
+            ON CONFLICT DO NOTHING""" % post_id)
+        return
+    cur.execute("""INSERT INTO timeline_entries (user_id, post_id, author_id, created_at)
+        SELECT f.follower_id, p.id, p.user_id, p.created_at FROM posts p
+        JOIN follows f ON f.following_id = p.user_id AND f.status = 'accepted'
+        WHERE p.id = '%s' AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = f.follower_id AND b.blocked_id = p.user_id)
+        UNION ALL
+        SELECT p.user_id, p.id, p.user_id, p.created_at FROM posts p WHERE p.id = '%s'
+        ON CONFLICT DO NOTHING""" % (post_id, post_id))
+
+
+def backfill_timeline(cur, follower_id, author_id):
+    cur.execute("""INSERT INTO timeline_entries (user_id, post_id, author_id, created_at)
+        SELECT '%s', id, user_id, created_at FROM posts
+        WHERE user_id = '%s' AND is_hidden = FALSE
+        ORDER BY created_at DESC LIMIT %d
+        ON CONFLICT DO NOTHING""" % (follower_id, author_id, TIMELINE_BACKFILL))
+
+
+def purge_timeline(cur, user_id, author_id):
+    cur.execute("DELETE FROM timeline_entries WHERE user_id = '%s' AND author_id = '%s'" % (user_id, author_id))
+
+
+_badge_cache = lru_new(BADGE_CACHE_SIZE, BADGE_CACHE_TTL)
+
+
+def bump_badges(cur, column, counts):
+    counts = dict((uid, n) for uid, n in counts.items() if n)
+    if not counts:
+        return
+    cur.execute("""UPDATE user_sync us SET %s = GREATEST(us.%s + v.n, 0)
+        FROM (VALUES %s) v(user_id, n) WHERE us.user_id = v.user_id""" % (
+        column, column, ','.join(["('%s'::uuid, %d)" % item for item in sorted(counts.items())])))
+    for uid in counts:
+        lru_pop(_badge_cache, uid)
+
+
+def sync_stamp(cur, user_ids):
+    ids = sorted(set(str(i) for i in user_ids if i))
+    if not ids:
+        return None
+    cur.execute("""WITH locked AS (
+            INSERT INTO user_sync (user_id, last_seq) SELECT v.id::uuid, 0 FROM (VALUES %s) v(id) ORDER BY v.id
+            ON CONFLICT (user_id) DO UPDATE SET last_seq = user_sync.last_seq RETURNING user_id
+        )
+        SELECT nextval('sync_seq') FROM (SELECT COUNT(*) FROM locked) l""" % ','.join("('%s')" % i for i in ids))
+    seq = cur.fetchone()[0]
+    cur.execute("UPDATE user_sync SET last_seq = %d WHERE user_id IN (%s)" % (seq, ','.join("'%s'" % i for i in ids)))
+    return seq
+
+
+def notify_group_key(n):
+    return '%s:%s:%d' % (n['type'], n.get('post_id') or '', int((n.get('at') or time.time()) // NOTIFY_BUCKET_SECONDS))
+
+
+def retract_notifications(cur, items):
+    if not items:
+        return
+    seq = sync_stamp(cur, [n['user_id'] for n in items])
+    cur.execute("""WITH gone AS (
+            DELETE FROM notification_actors na USING (VALUES %s) v(user_id, group_key, actor_id)
+            WHERE na.user_id = v.user_id AND na.group_key = v.group_key AND na.actor_id = v.actor_id
+            RETURNING na.user_id, na.group_key, na.actor_id
+        ), lost AS (
+            SELECT user_id, group_key, COUNT(*) AS n, array_agg(actor_id) AS actors FROM gone GROUP BY user_id, group_key
+        )
+        UPDATE notifications nt SET actor_count = nt.actor_count - lost.n, seq = %d,
+            recent_actor_ids = ARRAY(SELECT a FROM unnest(nt.recent_actor_ids) WITH ORDINALITY t(a, i) WHERE a <> ALL(lost.actors) ORDER BY i)
+        FROM lost WHERE nt.user_id = lost.user_id AND nt.group_key = lost.group_key
+        RETURNING nt.id, nt.user_id, nt.actor_count, nt.is_read""" % (','.join(
+        "('%s'::uuid, '%s', '%s'::uuid)" % (n['user_id'], notify_group_key(n), n['from_user_id']) for n in items), seq))
+    empty = [r for r in cur.fetchall() if r[2] <= 0]
+    if not empty:
+        return
+    cur.execute("DELETE FROM notifications WHERE id IN (%s)" % ','.join("'%s'" % r[0] for r in empty))
+    unread = {}
+    for r in empty:
+        if not r[3]:
+            unread[str(r[1])] = unread.get(str(r[1]), 0) - 1
+    bump_badges(cur, 'unread_notifications', unread)
+
+
+def write_notifications(cur, items):
+    if not items:
+        return
+    seq = sync_stamp(cur, [n['user_id'] for n in items])
+    plain = []
+    groups = OrderedDict()
+    for n in items:
+        if n['type'] not in NOTIFY_GROUPED_TYPES or not n.get('from_user_id'):
+            plain.append(n)
+            continue
+        key = (str(uuid.UUID(n['user_id'])), notify_group_key(n))
+        group = groups.setdefault(key, {'actors': []})
+        group['latest'] = n
+        if n['from_user_id'] in group['actors']:
+            group['actors'].remove(n['from_user_id'])
+        group['actors'].insert(0, n['from_user_id'])
+
+    def values(n):
+        return "'%s', '%s', %s, %s, '%s', %d" % (
+            n['user_id'], n['type'], "'%s'::uuid" % n['from_user_id'] if n.get('from_user_id') else 'NULL',
+            "'%s'::uuid" % n['post_id'] if n.get('post_id') else 'NULL', n['content'].replace("'", "''"), seq)
+
+    unread = {}
+    for n in plain:
+        unread[n['user_id']] = unread.get(n['user_id'], 0) + 1
+    if groups:
+        cur.execute("""INSERT INTO notification_actors (user_id, group_key, actor_id) VALUES %s
+            ON CONFLICT DO NOTHING RETURNING user_id, group_key""" % ','.join(
+            "('%s', '%s', '%s')" % (key[0], key[1], a) for key, g in groups.items() for a in g['actors']))
+        for r in cur.fetchall():
+            group = groups[(str(r[0]), r[1])]
+            group['fresh'] = group.get('fresh', 0) + 1
+        cur.execute("SELECT user_id, group_key FROM notifications WHERE user_id IN (%s) AND group_key IN (%s) AND is_read = FALSE" % (
+            ','.join(set("'%s'" % key[0] for key in groups)), ','.join(set("'%s'" % key[1] for key in groups))))
+        already_unread = set((str(r[0]), r[1]) for r in cur.fetchall())
+        for key in groups:
+            if key not in already_unread:
+                unread[key[0]] = unread.get(key[0], 0) + 1
+    bump_badges(cur, 'unread_notifications', unread)
+    if plain:
+        cur.execute("INSERT INTO notifications (user_id, type, from_user_id, post_id, content, seq, recent_actor_ids) VALUES %s" % ','.join([
+            "(%s, %s)" % (values(n), "ARRAY['%s']::uuid[]" % n['from_user_id'] if n.get('from_user_id') else 'NULL') for n in plain]))
+    if groups:
+        cur.execute("""INSERT INTO notifications (user_id, type, from_user_id, post_id, content, seq, actor_count, recent_actor_ids, group_key, updated_at)
+            VALUES %s
+            ON CONFLICT (user_id, group_key) WHERE group_key IS NOT NULL DO UPDATE SET
+                from_user_id = EXCLUDED.from_user_id, content = EXCLUDED.content, seq = EXCLUDED.seq, is_read = FALSE, updated_at = NOW(),
+                actor_count = notifications.actor_count + EXCLUDED.actor_count
+                    - cardinality(ARRAY(SELECT unnest(EXCLUDED.recent_actor_ids) INTERSECT SELECT unnest(notifications.recent_actor_ids))),
+                recent_actor_ids = (EXCLUDED.recent_actor_ids || ARRAY(
+                    SELECT a FROM unnest(notifications.recent_actor_ids) WITH ORDINALITY t(a, i)
+                    WHERE a <> ALL(EXCLUDED.recent_actor_ids) ORDER BY i))[1:%d]""" % (','.join([
+            "(%s, %d, ARRAY[%s]::uuid[], '%s', NOW())" % (
+                values(g['latest']), g.get('fresh', 0), ','.join("'%s'" % a for a in g['actors'][:NOTIFY_RECENT_ACTORS]), key[1])
+            for key, g in groups.items()]), NOTIFY_RECENT_ACTORS))
+
+
+def extract_tags(text):
+    return sorted(set(t.lower() for t in TAG_PATTERN.findall(text or '')))[:MAX_TAGS]
+
+
+def extract_mentions(text):
+    return sorted(set(m.lower() for m in MENTION_PATTERN.findall(text or '')))[:MAX_MENTIONS]
+
+
+def index_post_tags(cur, post_id, tags):
+    if not tags:
+        return
+    cur.execute("""INSERT INTO post_tags (tag, post_id, created_at)
+        SELECT v.tag, p.id, p.created_at FROM (VALUES %s) v(tag) JOIN posts p ON p.id = '%s'
+        ON CONFLICT DO NOTHING""" % (','.join("('%s')" % t.replace("'", "''") for t in tags), post_id))
+
+
+def index_comment_tags(cur, comment_id, tags):
+    if not tags:
+        return
+    cur.execute("""INSERT INTO comment_tags (tag, comment_id, post_id, created_at)
+        SELECT v.tag, c.id, c.post_id, c.created_at FROM (VALUES %s) v(tag) JOIN comments c ON c.id = '%s'
+        ON CONFLICT DO NOTHING""" % (','.join("('%s')" % t.replace("'", "''") for t in tags), comment_id))
+
+
+def bump_tag_trends(cur, counts):
+    if not counts:
+        return
+    bucket = int(time.time() // 3600)
+    cur.execute("""INSERT INTO tag_trends (bucket, tag, uses) VALUES %s
+        ON CONFLICT (bucket, tag) DO UPDATE SET uses = tag_trends.uses + EXCLUDED.uses""" % ','.join([
+        "(%d, '%s', %d)" % (bucket, tag.replace("'", "''"), n) for tag, n in sorted(counts.items())]))
+    if _trend_state['purged'] != bucket:
+        cur.execute("DELETE FROM tag_trends WHERE bucket < %d" % (bucket - TRENDING_RETENTION_HOURS))
+        _trend_state['purged'] = bucket
+
+
+def write_mentions(cur, mentions):
+    names = sorted(set(name for m in mentions for name in m['mentions']))
+    if not names:
+        return []
+    cur.execute("SELECT id, username FROM users WHERE username IN (%s) AND is_blocked = FALSE" % ','.join("'%s'" % n.replace("'", "''") for n in names))
+    users = dict((r[1], str(r[0])) for r in cur.fetchall())
+    rows = []
+    notes = []
+    for m in mentions:
+        for name in m['mentions']:
+            uid = users.get(name)
+            if not uid or uid == m['user_id']:
+                continue
+            rows.append("('%s', '%s', '%s', %s)" % (uid, m['user_id'], m['post_id'], "'%s'" % m['comment_id'] if m.get('comment_id') else 'NULL'))
+            notes.append({'user_id': uid, 'type': 'mention', 'from_user_id': m['user_id'], 'post_id': m['post_id'], 'content': 'mentioned you'})
+    if rows:
+        cur.execute("INSERT INTO mentions (user_id, author_id, post_id, comment_id) VALUES %s" % ','.join(rows))
+    return notes
+
+
+_trend_state = {'purged': None}
+
+
+def enqueue(cur, kind, **payload):
+    cur.execute("INSERT INTO outbox (kind, payload) VALUES ('%s', '%s') RETURNING id" % (kind, json.dumps(payload).replace("'", "''")))
+    row = cur.fetchone()
+    if row:
+        _outbox_state['pending'].append(row[0])
+
+
+_outbox_state = {'pending': []}
+
+
+def claim_outbox(cur, where, limit):
+    cur.execute("""DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE %s ORDER BY id LIMIT %d FOR UPDATE SKIP LOCKED)
+        RETURNING id, kind, payload""" % (where, limit))
+    return sorted(cur.fetchall())
+
+
+def apply_outbox(cur, events):
+    deltas = {}
+    comment_deltas = {}
+    user_deltas = {}
+    gains = {}
+    losses = {}
+    fan_outs = []
+    notes = []
+    owner_notes = []
+    retractions = []
+    mentions = []
+    trends = {}
+    for _, kind, payload in events:
+        if payload.get('mentions'):
+            mentions.append(payload)
+        for tag in payload.get('tags', []):
+            trends[tag] = trends.get(tag, 0) + 1
+        if kind == 'post':
+            fan_outs.append((payload['post_id'], payload['user_id']))
+        elif kind == 'notify':
+            notes.append(payload)
+        elif kind in OUTBOX_COUNTERS:
+            column, delta = OUTBOX_COUNTERS[kind]
+            post_deltas = deltas.setdefault(payload['post_id'], {})
+            post_deltas[column] = post_deltas.get(column, 0) + delta
+            if kind in RANK_WEIGHTS:
+                gains.setdefault(payload['post_id'], []).append(rank_term(kind, payload.get('at')))
+            elif kind in RANK_UNDO and payload.get('at'):
+                losses.setdefault(payload['post_id'], []).append(rank_term(RANK_UNDO[kind], payload['at']))
+            if kind in ('like', 'comment') or (kind == 'unlike' and payload.get('user_id') and payload.get('at')):
+                owner_notes.append((kind, payload))
+        if kind in COMMENT_COUNTERS:
+            column, delta = COMMENT_COUNTERS[kind]
+            target = payload.get('parent_id') if column == 'reply_count' else payload.get('comment_id')
+            if target:
+                counters = comment_deltas.setdefault(target, {})
+                counters[column] = counters.get(column, 0) + delta
+        for field, column, delta in USER_COUNTERS.get(kind, ()):
+            counters = user_deltas.setdefault(payload[field], {})
+            counters[column] = counters.get(column, 0) + delta
+    if owner_notes:
+        cur.execute("SELECT id, user_id FROM posts WHERE id IN (%s)" % ','.join(set("'%s'" % p['post_id'] for _, p in owner_notes)))
+        owners = dict((str(r[0]), str(r[1])) for r in cur.fetchall())
+        for kind, p in owner_notes:
+            owner = owners.get(p['post_id'])
+            if not owner or owner == p['user_id']:
+                continue
+            if kind == 'unlike':
+                retractions.append({'user_id': owner, 'type': 'like', 'from_user_id': p['user_id'], 'post_id': p['post_id'], 'at': p['at']})
+            else:
+                notes.append({'user_id': owner, 'type': kind, 'from_user_id': p['user_id'], 'post_id': p['post_id'], 'at': p.get('at'),
+                              'content': 'liked your post' if kind == 'like' else p['content'][:100]})
+    bump_post_stats(cur, deltas)
+    bump_comment_stats(cur, comment_deltas)
+    bump_user_stats(cur, user_deltas)
+    bump_post_scores(cur, gains)
+    drop_post_scores(cur, losses)
+    for post_id, author_id in fan_outs:
+        fan_out_post(cur, post_id, author_id)
+    bump_tag_trends(cur, trends)
+    write_notifications(cur, notes + write_mentions(cur, mentions))
+    retract_notifications(cur, retractions)
+    return ['post:' + pid for pid in deltas] + ['user:' + uid for uid in user_deltas]
+
+
+def fail_outbox_event(cur, event_id, error):
+    cur.execute("""UPDATE outbox SET attempts = attempts + 1, last_error = '%s',
+            retry_at = NOW() + INTERVAL '1 second' * %d * (attempts + 1)
+        WHERE id = %d RETURNING attempts""" % (('%s: %s' % (type(error).__name__, error))[:500].replace("'", "''"), OUTBOX_RETRY_SECONDS, event_id))
+    row = cur.fetchone()
+    if row and row[0] >= OUTBOX_MAX_ATTEMPTS:
+        cur.execute("""WITH dead AS (DELETE FROM outbox WHERE id = %d RETURNING id, kind, payload, attempts, last_error, created_at)
+            INSERT INTO outbox_dead (id, kind, payload, attempts, last_error, created_at) SELECT * FROM dead""" % event_id)
+
+
+def process_outbox_event(conn, event_id):
+    cur = conn.cursor()
+    try:
+        tags = apply_outbox(cur, claim_outbox(cur, "id = %d" % event_id, 1))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        fail_outbox_event(cur, event_id, e)
+        conn.commit()
+        return
+    invalidate_responses(*tags)
+
+
+def process_outbox(conn, limit=OUTBOX_BATCH_SIZE, ids=None):
+    cur = conn.cursor()
+    where = "id IN (%s)" % ','.join('%d' % i for i in ids) if ids else "attempts = 0"
+    events = []
+    try:
+        events = claim_outbox(cur, where, limit)
+        tags = apply_outbox(cur, events)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if not events:
+            raise
+        for event_id, _, _ in events:
+            process_outbox_event(conn, event_id)
+        return len(events)
+    invalidate_responses(*tags)
+    if ids is None:
+        cur.execute("SELECT id FROM outbox WHERE attempts > 0 AND retry_at <= NOW() ORDER BY id LIMIT %d" % OUTBOX_RETRY_LIMIT)
+        for r in cur.fetchall():
+            process_outbox_event(conn, r[0])
+    return len(events)
+
+
+def drain_outbox_if_inline(conn):
+    ids, _outbox_state['pending'] = _outbox_state['pending'][:OUTBOX_INLINE_LIMIT], []
+    if not OUTBOX_INLINE or not ids:
+        return
+    try:
+        process_outbox(conn, len(ids), ids)
+    except psycopg2.Error:
+        pass
+
+
+def touch_conversation(cur, user_id, partner_id, message_id, content, sender_id, unread, seq):
+    cur.execute("""INSERT INTO conversations (user_id, partner_id, last_message_id, last_message, last_sender_id, last_time, unread_count, seq)
+        VALUES ('%s', '%s', '%s', '%s', '%s', NOW(), %d, %d)
+        ON CONFLICT (user_id, partner_id) DO UPDATE SET last_message_id = EXCLUDED.last_message_id, last_message = EXCLUDED.last_message,
+            last_sender_id = EXCLUDED.last_sender_id, last_time = EXCLUDED.last_time,
+            unread_count = conversations.unread_count + EXCLUDED.unread_count, seq = EXCLUDED.seq""" % (
+        user_id, partner_id, message_id, content[:MESSAGE_PREVIEW_LENGTH].replace("'", "''"), sender_id, unread, seq))
+
+
+def rebuild_conversations(cur, user_id=None):
+    scope = " AND user_id = '%s'" % user_id if user_id else ''
+    cur.execute("DELETE FROM conversations WHERE TRUE%s" % scope)
+    cur.execute("""WITH sides AS (
+            SELECT sender_id AS user_id, receiver_id AS partner_id, id, content, sender_id, created_at, FALSE AS unread
+            FROM messages WHERE hidden_by_sender = FALSE
+            UNION ALL
+            SELECT receiver_id, sender_id, id, content, sender_id, created_at, NOT is_read
+            FROM messages WHERE hidden_by_receiver = FALSE
+        ), latest AS (
+            SELECT DISTINCT ON (user_id, partner_id) user_id, partner_id, id, content, sender_id, created_at
+            FROM sides WHERE TRUE%s ORDER BY user_id, partner_id, created_at DESC
+        ), unread AS (
+            SELECT user_id, partner_id, COUNT(*) FILTER (WHERE unread) AS n FROM sides WHERE TRUE%s GROUP BY user_id, partner_id
+        )
+        INSERT INTO conversations (user_id, partner_id, last_message_id, last_message, last_sender_id, last_time, unread_count)
+        SELECT l.user_id, l.partner_id, l.id, LEFT(l.content, %d), l.sender_id, l.created_at, u.n
+        FROM latest l JOIN unread u ON u.user_id = l.user_id AND u.partner_id = l.partner_id""" % (scope, scope, MESSAGE_PREVIEW_LENGTH))
+    rebuilt = cur.rowcount
+    cur.execute("""UPDATE user_sync SET unread_messages = COALESCE((SELECT SUM(unread_count) FROM conversations c WHERE c.user_id = user_sync.user_id), 0)
+        WHERE TRUE%s""" % scope)
+    return rebuilt
+
+
+_story_partitions = {'day': None}
+
+
+def ensure_story_partitions(cur):
+    today = datetime.utcnow().date()
+    for offset in range(-1, STORY_PARTITION_AHEAD_DAYS + 1):
+        day = today + timedelta(days=offset)
+        for table in ('stories', 'story_views'):
+            cur.execute("CREATE TABLE IF NOT EXISTS %s_p%s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+                table, day.strftime('%Y%m%d'), table, day, day + timedelta(days=1)))
+
+
+def ensure_story_partitions_if_due(conn):
+    day = int(time.time() // 86400)
+    if _story_partitions['day'] == day:
+        return
+    cur = conn.cursor()
+    last = (datetime.utcnow().date() + timedelta(days=STORY_PARTITION_AHEAD_DAYS)).strftime('%Y%m%d')
+    cur.execute("SELECT to_regclass('stories_p%s') IS NOT NULL AND to_regclass('story_views_p%s') IS NOT NULL" % (last, last))
+    row = cur.fetchone()
+    if not (row and row[0]):
+        ensure_story_partitions(cur)
+        conn.commit()
+    _story_partitions['day'] = day
+
+
+def maintain_story_partitions(conn):
+    cur = conn.cursor()
+    ensure_story_partitions(cur)
+    cutoff = (datetime.utcnow().date() - timedelta(days=1)).strftime('%Y%m%d')
+    cur.execute("""SELECT parent.relname, child.relname FROM pg_inherits i
+        JOIN pg_class parent ON parent.oid = i.inhparent JOIN pg_class child ON child.oid = i.inhrelid
+        WHERE parent.relname IN ('stories', 'story_views') ORDER BY child.relname""")
+    expired = []
+    for parent, child in cur.fetchall():
+        suffix = child[len(parent) + 2:]
+        if child.startswith(parent + '_p') and suffix.isdigit() and suffix < cutoff:
+            if STORY_ARCHIVE:
+                cur.execute("ALTER TABLE %s DETACH PARTITION %s" % (parent, child))
+            else:
+                cur.execute("DROP TABLE %s" % child)
+            expired.append(child)
+    conn.commit()
+    _story_partitions['day'] = int(time.time() // 86400)
+    return expired
+
+
+_prefix_index = {'terms': [], 'slots': array('i'), 'ids': [], 'names': [], 'slot_of': {}, 'state': 'cold', 'after': None,
+                 'since': None, 'checked': 0, 'lock': threading.Lock()}
+
+
+def prefix_terms(username, display_name):
+    return tuple(sorted(set(sys.intern(term.lower()) for term in (username, display_name) if term)))
+
+
+def prefix_add(index, uid, names):
+    slot = len(index['ids'])
+    index['ids'].append(uid)
+    index['names'].append(names)
+    index['slot_of'][uid] = slot
+    return slot
+
+
+def prefix_reset(state):
+    _prefix_index.update({'terms': [], 'slots': array('i'), 'ids': [], 'names': [], 'slot_of': {}, 'state': state, 'after': None})
+
+
+def warm_prefix_index(cur):
+    if _prefix_index['after'] is None:
+        cur.execute("SELECT reltuples::bigint, (SELECT MAX(search_updated_at) FROM users) FROM pg_class WHERE relname = 'users'")
+        row = cur.fetchone()
+        if row and row[0] > SEARCH_PREFIX_MAX_USERS:
+            prefix_reset('disabled')
+            return
+        _prefix_index['since'] = (row and row[1]) or datetime.utcnow()
+        _prefix_index['after'] = TOMBSTONE_ID
+    cur.execute("""SELECT id, username, display_name FROM users WHERE is_blocked = FALSE AND id > '%s'
+        ORDER BY id LIMIT %d""" % (_prefix_index['after'], SEARCH_PREFIX_WARM_BATCH))
+    rows = cur.fetchall()
+    with _prefix_index['lock']:
+        for r in rows:
+            names = prefix_terms(r[1], r[2])
+            slot = prefix_add(_prefix_index, str(r[0]), names)
+            _prefix_index['terms'].extend(names)
+            _prefix_index['slots'].extend([slot] * len(names))
+        if rows:
+            _prefix_index['after'] = str(rows[-1][0])
+        if len(_prefix_index['ids']) > SEARCH_PREFIX_MAX_USERS:
+            prefix_reset('disabled')
+        elif len(rows) < SEARCH_PREFIX_WARM_BATCH:
+            terms, slots = _prefix_index['terms'], _prefix_index['slots']
+            order = sorted(range(len(terms)), key=terms.__getitem__)
+            _prefix_index['terms'] = [terms[k] for k in order]
+            _prefix_index['slots'] = array('i', (slots[k] for k in order))
+            _prefix_index['state'] = 'ready'
+            _prefix_index['checked'] = time.time()
+
+
+def refresh_prefix_index(cur):
+    if time.time() - _prefix_index['checked'] < SEARCH_INDEX_REFRESH:
+        return
+    _prefix_index['checked'] = time.time()
+    cur.execute("""SELECT id, username, display_name, is_blocked, search_updated_at FROM users
+        WHERE search_updated_at > '%s'::timestamp - INTERVAL '%d seconds' ORDER BY search_updated_at""" % (_prefix_index['since'].isoformat(), SEARCH_INDEX_OVERLAP))
+    rows = cur.fetchall()
+    with _prefix_index['lock']:
+        terms, slots = _prefix_index['terms'], _prefix_index['slots']
+        for r in rows:
+            uid = str(r[0])
+            slot = _prefix_index['slot_of'].pop(uid, None)
+            if slot is not None:
+                for term in _prefix_index['names'][slot]:
+                    k = bisect.bisect_left(terms, term)
+                    while k < len(terms) and terms[k] == term and slots[k] != slot:
+                        k += 1
+                    if k < len(terms) and terms[k] == term:
+                        del terms[k]
+                        del slots[k]
+                _prefix_index['ids'][slot] = None
+                _prefix_index['names'][slot] = ()
+            if not r[3]:
+                names = prefix_terms(r[1], r[2])
+                slot = prefix_add(_prefix_index, uid, names)
+                for term in names:
+                    k = bisect.bisect_right(terms, term)
+                    terms.insert(k, term)
+                    slots.insert(k, slot)
+            _prefix_index['since'] = max(_prefix_index['since'], r[4])
+        if len(_prefix_index['slot_of']) > SEARCH_PREFIX_MAX_USERS:
+            prefix_reset('disabled')
+
+
+def prefix_search_db(cur, prefix, limit):
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace("'", "''")
+    cur.execute("""(SELECT id FROM users WHERE lower(username) COLLATE "C" LIKE '%s%%' AND is_blocked = FALSE ORDER BY lower(username) COLLATE "C" LIMIT %d)
+        UNION ALL (SELECT id FROM users WHERE lower(display_name) COLLATE "C" LIKE '%s%%' AND is_blocked = FALSE ORDER BY lower(display_name) COLLATE "C" LIMIT %d)""" % (
+        pattern, limit, pattern, limit))
+    ids = []
+    for r in cur.fetchall():
+        if str(r[0]) not in ids:
+            ids.append(str(r[0]))
+    return ids
+
+
+def prefix_search(cur, q, limit):
+    prefix = q.lower()
+    if _prefix_index['state'] == 'cold':
+        warm_prefix_index(cur)
+    elif _prefix_index['state'] == 'ready':
+        refresh_prefix_index(cur)
+    if _prefix_index['state'] == 'ready':
+        ids = []
+        with _prefix_index['lock']:
+            terms, slots, slot_ids = _prefix_index['terms'], _prefix_index['slots'], _prefix_index['ids']
+            i = bisect.bisect_left(terms, prefix)
+            while i < len(terms) and terms[i].startswith(prefix) and len(ids) < limit * 5:
+                uid = slot_ids[slots[i]]
+                if uid not in ids:
+                    ids.append(uid)
+                i += 1
+    else:
+        ids = prefix_search_db(cur, prefix, limit * 5)
+    cards = load_user_cards(cur, ids)
+    found = [cards[uid] for uid in ids if uid in cards]
+    found.sort(key=lambda c: -sum(boost for flag, boost in SEARCH_BOOSTS.items() if c.get(flag)))
+    return found[:limit]
+
 
 def handler(event, context):
     """Основное API соцсети Online: посты, лайки, комментарии, подписки, профили"""
     if event.get('httpMethod') == 'OPTIONS':
         return {'statusCode': 200, 'headers': cors_headers(), 'body': ''}
 
+    conn = get_db()
+    try:
+        response = dispatch(conn, event)
+        drain_outbox_if_inline(conn)
+        return response
+    finally:
+        release_db(conn)
+
+
+def dispatch(conn, event):
+    _card_memo.clear()
+    _outbox_state['pending'] = []
     method = event.get('httpMethod', 'GET')
     params = event.get('queryStringParameters', {}) or {}
     action = params.get('action', '')
     headers = event.get('headers', {}) or {}
-    user = get_user_by_token(headers)
+    user = get_user_by_token(conn, headers)
 
     if method == 'GET':
         if action == 'feed':
-            return get_feed(params, user)
+            return get_feed(conn, params, user)
         elif action == 'post':
-            return get_post(params, user)
+            return cached_response(conn, action, params, user, headers, lambda: get_post(conn, params, user))
         elif action == 'profile':
-            return get_profile(params, user)
+            return cached_response(conn, action, params, user, headers, lambda: get_profile(conn, params, user, headers))
         elif action == 'comments':
-            return get_comments(params, user)
+            return get_comments(conn, params, user)
         elif action == 'search':
-            return search_users(params, user)
+            return search_users(conn, params, user)
+        elif action == 'search_posts':
+            return search_posts(conn, params, user)
+        elif action == 'tag_feed':
+            return get_tag_feed(conn, params, user)
+        elif action == 'trending':
+            return get_trending(conn, params)
         elif action == 'followers':
-            return get_followers(params, user)
+            return cached_response(conn, action, params, user, headers, lambda: get_followers(conn, params, user))
         elif action == 'following':
-            return get_following(params, user)
+            return cached_response(conn, action, params, user, headers, lambda: get_following(conn, params, user))
         elif action == 'friends':
-            return get_friends(params, user)
+            return get_friends(conn, params, user)
         elif action == 'stories':
-            return get_stories(user)
+            return get_stories(conn, user)
+        elif action == 'badges':
+            return get_badges(conn, user)
+        elif action == 'sync':
+            return get_sync(conn, params, user)
         elif action == 'notifications':
-            return get_notifications(user)
+            return get_notifications(conn, user)
         elif action == 'messages':
-            return get_messages(params, user)
+            return get_messages(conn, params, user)
         elif action == 'conversation':
-            return get_conversation(params, user)
+            return get_conversation(conn, params, user)
         elif action == 'user_posts':
-            return get_user_posts(params, user)
+            return cached_response(conn, action, params, user, headers, lambda: get_user_posts(conn, params, user))
         elif action == 'user_likes':
-            return get_user_likes(params, user)
+            return get_user_likes(conn, params, user)
         elif action == 'user_reposts':
-            return get_user_reposts(params, user)
+            return get_user_reposts(conn, params, user)
 
     if method == 'POST':
         body = json.loads(event.get('body', '{}') or '{}')
@@ -76,183 +1275,270 @@ def handler(event, context):
 
         if not user:
             return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
+        if user.get('is_blocked') and act != 'appeal':
+            return {'statusCode': 403, 'headers': cors_headers(), 'body': json.dumps({'error': 'blocked'})}
 
         if act == 'create_post':
-            return create_post(body, user)
+            return create_post(conn, body, user)
         elif act == 'like_post':
-            return like_post(body, user)
+            return like_post(conn, body, user)
         elif act == 'unlike_post':
-            return unlike_post(body, user)
+            return unlike_post(conn, body, user)
         elif act == 'comment':
-            return add_comment(body, user)
+            return add_comment(conn, body, user)
         elif act == 'like_comment':
-            return like_comment(body, user)
+            return like_comment(conn, body, user)
         elif act == 'unlike_comment':
-            return unlike_comment(body, user)
+            return unlike_comment(conn, body, user)
         elif act == 'follow':
-            return follow_user(body, user)
+            return follow_user(conn, body, user)
         elif act == 'unfollow':
-            return unfollow_user(body, user)
+            return unfollow_user(conn, body, user)
         elif act == 'repost':
-            return repost(body, user)
+            return repost(conn, body, user)
         elif act == 'unrepost':
-            return unrepost(body, user)
+            return unrepost(conn, body, user)
         elif act == 'hide_post':
-            return hide_post(body, user)
+            return hide_post(conn, body, user)
         elif act == 'hide_comment':
-            return hide_comment(body, user)
+            return hide_comment(conn, body, user)
         elif act == 'update_profile':
-            return update_profile(body, user)
+            return update_profile(conn, body, user)
         elif act == 'send_message':
-            return send_message(body, user)
+            return send_message(conn, body, user)
         elif act == 'edit_message':
-            return edit_message(body, user)
+            return edit_message(conn, body, user)
         elif act == 'pin_message':
-            return pin_message(body, user)
+            return pin_message(conn, body, user)
         elif act == 'mark_read':
-            return mark_read(body, user)
+            return mark_read(conn, body, user)
         elif act == 'create_story':
-            return create_story(body, user)
+            return create_story(conn, body, user)
+        elif act == 'record_story_views':
+            return record_story_views(conn, body, user)
         elif act == 'block_user':
-            return block_user(body, user)
+            return block_user(conn, body, user)
         elif act == 'unblock_user':
-            return unblock_user(body, user)
+            return unblock_user(conn, body, user)
         elif act == 'report':
-            return create_report(body, user)
+            return create_report(conn, body, user)
         elif act == 'request_verification':
-            return request_verification(body, user)
+            return request_verification(conn, body, user)
         elif act == 'view_post':
-            return view_post(body, user)
+            return view_post(conn, body, user, ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp', ''))
         elif act == 'accept_follow':
-            return accept_follow(body, user)
+            return accept_follow(conn, body, user)
         elif act == 'reject_follow':
-            return reject_follow(body, user)
+            return reject_follow(conn, body, user)
         elif act == 'appeal':
-            return create_appeal(body, user)
+            return create_appeal(conn, body, user)
         elif act == 'delete_account':
-            return delete_account(user)
+            return delete_account(conn, user)
         elif act == 'upload_avatar':
-            return upload_avatar(body, user)
+            return upload_avatar(conn, body, user)
         elif act == 'remove_avatar':
-            return remove_avatar(body, user)
+            return remove_avatar(conn, body, user)
         elif act == 'set_primary_avatar':
-            return set_primary_avatar(body, user)
+            return set_primary_avatar(conn, body, user)
         elif act == 'read_notifications':
-            return read_notifications(user)
+            return read_notifications(conn, user)
 
         if user.get('is_admin'):
             if act == 'admin_verify':
-                return admin_verify(body)
+                return admin_verify(conn, body)
             elif act == 'admin_reject_verify':
-                return admin_reject_verify(body)
+                return admin_reject_verify(conn, body)
             elif act == 'admin_block_user':
-                return admin_block_user(body)
+                return admin_block_user(conn, body)
             elif act == 'admin_unblock_user':
-                return admin_unblock_user(body)
+                return admin_unblock_user(conn, body)
             elif act == 'admin_hide_post':
-                return admin_hide_post(body)
+                return admin_hide_post(conn, body)
             elif act == 'admin_resolve_report':
-                return admin_resolve_report(body)
+                return admin_resolve_report(conn, body)
             elif act == 'admin_resolve_appeal':
-                return admin_resolve_appeal(body)
+                return admin_resolve_appeal(conn, body)
             elif act == 'admin_get_reports':
-                return admin_get_reports()
+                return admin_get_reports(conn)
             elif act == 'admin_get_verifications':
-                return admin_get_verifications()
+                return admin_get_verifications(conn)
             elif act == 'admin_get_appeals':
-                return admin_get_appeals()
+                return admin_get_appeals(conn)
             elif act == 'admin_add_release':
-                return admin_add_release(body)
+                return admin_add_release(conn, body)
+            elif act == 'admin_reconcile_counters':
+                return admin_reconcile_counters(conn, body)
+            elif act == 'admin_cache_stats':
+                return admin_cache_stats()
+            elif act == 'admin_prune_sessions':
+                return admin_prune_sessions(conn)
+            elif act == 'admin_refresh_rank_window':
+                return admin_refresh_rank_window(conn)
+            elif act == 'admin_flush_views':
+                return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'flushed': flush_views(conn)})}
+            elif act == 'admin_rebuild_conversations':
+                return admin_rebuild_conversations(conn, body)
+            elif act == 'admin_process_outbox':
+                return admin_process_outbox(conn)
+            elif act == 'admin_compact_tombstones':
+                return admin_compact_tombstones(conn)
+            elif act == 'admin_purge_stories':
+                return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'expired': maintain_story_partitions(conn)})}
 
     return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Unknown action'})}
 
 
-def get_feed(params, user):
-    conn = get_db()
+def get_feed(conn, params, user):
+    if params.get('mode') == 'following':
+        return get_home_timeline(conn, params, user)
+    if params.get('mode') == 'top':
+        return get_ranked_feed(conn, params, user)
+    try:
+        page_clause, offset = page_params(params, 'p.created_at', 'p.id')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
     cur = conn.cursor()
-    offset = int(params.get('offset', '0'))
     blocked_clause = ""
     if user:
         cur.execute("SELECT blocked_id FROM blocks WHERE blocker_id = '%s'" % user['id'])
         blocked = [str(r[0]) for r in cur.fetchall()]
         if blocked:
             blocked_clause = " AND p.user_id NOT IN (%s)" % ','.join(["'%s'" % b for b in blocked])
-    cur.execute("""SELECT p.id, p.content, p.image_url, p.views_count, p.created_at,
-        u.id, u.username, u.display_name, u.is_verified, u.is_artist,
-        (SELECT COUNT(*) FROM post_likes WHERE post_id = p.id),
-        (SELECT COUNT(*) FROM comments WHERE post_id = p.id AND is_hidden = FALSE),
-        (SELECT COUNT(*) FROM reposts WHERE post_id = p.id)
-        FROM posts p JOIN users u ON p.user_id = u.id
-        WHERE p.is_hidden = FALSE AND u.is_blocked = FALSE %s
-        ORDER BY p.created_at DESC LIMIT 20 OFFSET %d""" % (blocked_clause, offset))
+    cur.execute("""SELECT %s
+        FROM posts p JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE p.is_hidden = FALSE AND u.is_blocked = FALSE %s%s
+        ORDER BY p.created_at DESC, p.id DESC LIMIT %d OFFSET %d""" % (POST_COLUMNS, blocked_clause, page_clause, PAGE_SIZE, offset))
     posts = []
+    last_row = None
     for r in cur.fetchall():
-        post = {
-            'id': str(r[0]), 'content': r[1], 'image_url': r[2], 'views_count': r[3],
-            'created_at': r[4].isoformat() if r[4] else None,
-            'user': {'id': str(r[5]), 'username': r[6], 'display_name': r[7], 'is_verified': r[8], 'is_artist': r[9]},
-            'likes_count': r[10], 'comments_count': r[11], 'reposts_count': r[12],
-            'liked': False, 'reposted': False
-        }
-        if user:
-            cur.execute("SELECT id FROM post_likes WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post['id']))
-            post['liked'] = cur.fetchone() is not None
-            cur.execute("SELECT id FROM reposts WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post['id']))
-            post['reposted'] = cur.fetchone() is not None
-        cur.execute("SELECT id, url, is_primary FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % post['user']['id'])
-        av = cur.fetchone()
-        post['user']['avatar'] = av[1] if av else None
-        posts.append(post)
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(posts, default=str)}
+        last_row = (r[4], r[0])
+        posts.append(post_from_row(r))
+    hydrate_posts(cur, posts, user)
+    return paged_response(params, posts, last_row)
 
 
-def get_post(params, user):
+def get_home_timeline(conn, params, user):
+    if not user:
+        return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
+    try:
+        timeline_clause, offset = page_params(params, 't.created_at', 't.post_id')
+        celebrity_clause, _ = page_params(params, 'created_at', 'id')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    cur = conn.cursor()
+    cur.execute("""SELECT %s
+        FROM (
+            (SELECT t.post_id, t.created_at FROM timeline_entries t
+                JOIN posts p ON p.id = t.post_id JOIN users u ON u.id = t.author_id
+                WHERE t.user_id = '%s' AND p.is_hidden = FALSE AND u.is_blocked = FALSE%s
+                AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = t.user_id AND b.blocked_id = t.author_id)
+                ORDER BY t.created_at DESC, t.post_id DESC LIMIT %d)
+            UNION
+            (SELECT c.id, c.created_at FROM follows f
+                JOIN users fu ON fu.id = f.following_id AND fu.fanout_on_read = TRUE AND fu.is_blocked = FALSE
+                CROSS JOIN LATERAL (SELECT id, created_at FROM posts
+                    WHERE user_id = f.following_id AND is_hidden = FALSE%s
+                    ORDER BY created_at DESC, id DESC LIMIT %d) c
+                WHERE f.follower_id = '%s' AND f.status = 'accepted'
+                AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = f.follower_id AND b.blocked_id = f.following_id))
+        ) t
+        JOIN posts p ON p.id = t.post_id JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        ORDER BY t.created_at DESC, t.post_id DESC LIMIT %d OFFSET %d""" % (
+        POST_COLUMNS, user['id'], timeline_clause, PAGE_SIZE + offset, celebrity_clause, PAGE_SIZE + offset, user['id'], PAGE_SIZE, offset))
+    posts = []
+    last_row = None
+    for r in cur.fetchall():
+        last_row = (r[4], r[0])
+        posts.append(post_from_row(r))
+    hydrate_posts(cur, posts, user)
+    return paged_response(params, posts, last_row)
+
+
+def get_ranked_feed(conn, params, user):
+    try:
+        page_clause, offset = page_params(params, 'rs.score', 'rs.post_id', parse_score)
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    blocked_clause = ''
+    if user:
+        blocked_clause = " AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = '%s' AND b.blocked_id = p.user_id)" % user['id']
+    cur = conn.cursor()
+    cur.execute("""SELECT %s, rs.score
+        FROM post_scores rs JOIN posts p ON p.id = rs.post_id JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE rs.bucket >= %d AND p.is_hidden = FALSE AND u.is_blocked = FALSE%s%s
+        ORDER BY rs.score DESC, rs.post_id DESC LIMIT %d OFFSET %d""" % (POST_COLUMNS, int(time.time() // 86400) - RANK_WINDOW_DAYS + 1, blocked_clause, page_clause, PAGE_SIZE, offset))
+    posts = []
+    last_row = None
+    for r in cur.fetchall():
+        last_row = (r[13], r[0])
+        posts.append(post_from_row(r))
+    hydrate_posts(cur, posts, user)
+    return paged_response(params, posts, last_row)
+
+
+def get_post(conn, params, user):
     post_id = params.get('id', '')
     if not post_id:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Post ID required'})}
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("""SELECT p.id, p.content, p.image_url, p.views_count, p.created_at,
-        u.id, u.username, u.display_name, u.is_verified, u.is_artist,
-        (SELECT COUNT(*) FROM post_likes WHERE post_id = p.id),
-        (SELECT COUNT(*) FROM comments WHERE post_id = p.id AND is_hidden = FALSE),
-        (SELECT COUNT(*) FROM reposts WHERE post_id = p.id)
-        FROM posts p JOIN users u ON p.user_id = u.id
-        WHERE p.id = '%s' AND p.is_hidden = FALSE""" % post_id.replace("'", "''"))
+    cur.execute("""SELECT %s
+        FROM posts p JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE p.id = '%s' AND p.is_hidden = FALSE""" % (POST_COLUMNS, post_id.replace("'", "''")))
     r = cur.fetchone()
     if not r:
-        conn.close()
         return {'statusCode': 404, 'headers': cors_headers(), 'body': json.dumps({'error': 'Post not found'})}
-    post = {
-        'id': str(r[0]), 'content': r[1], 'image_url': r[2], 'views_count': r[3],
-        'created_at': r[4].isoformat() if r[4] else None,
-        'user': {'id': str(r[5]), 'username': r[6], 'display_name': r[7], 'is_verified': r[8], 'is_artist': r[9]},
-        'likes_count': r[10], 'comments_count': r[11], 'reposts_count': r[12],
-        'liked': False, 'reposted': False
-    }
-    if user:
-        cur.execute("SELECT id FROM post_likes WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post['id']))
-        post['liked'] = cur.fetchone() is not None
-        cur.execute("SELECT id FROM reposts WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post['id']))
-        post['reposted'] = cur.fetchone() is not None
-    cur.execute("SELECT id, url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % post['user']['id'])
-    av = cur.fetchone()
-    post['user']['avatar'] = av[1] if av else None
-    conn.close()
+    post = post_from_row(r)
+    hydrate_posts(cur, [post], user)
+    if VIEW_SKETCH:
+        cur.execute("SELECT registers FROM post_view_sketches WHERE post_id = '%s'" % post['id'])
+        sk = cur.fetchone()
+        post['unique_viewers'] = sketch_estimate(bytearray(bytes(sk[0]))) if sk else 0
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(post, default=str)}
 
 
-def get_profile(params, user):
+def profile_etag(user_id, version, viewer_id, follow_status):
+    raw = '%s:%d:%s:%s' % (user_id, version, viewer_id or '', follow_status or '')
+    return '"%s"' % hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def etag_matches(headers, etag):
+    header = headers.get('If-None-Match') or headers.get('if-none-match') or ''
+    return any(t.strip() in (etag, 'W/' + etag, '*') for t in header.split(','))
+
+
+def etag_headers(etag):
+    headers = cors_headers()
+    headers['ETag'] = etag
+    headers['Cache-Control'] = 'private, no-cache'
+    return headers
+
+
+def get_profile(conn, params, user, headers=None):
     username = params.get('username', '')
     if not username:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Username required'})}
-    conn = get_db()
+    headers = headers or {}
+    viewer_id = user['id'] if user else None
+    status_sql = "(SELECT status FROM follows WHERE follower_id = '%s' AND following_id = u.id)" % viewer_id if viewer_id else 'NULL'
     cur = conn.cursor()
-    cur.execute("SELECT id, username, email, display_name, bio, is_private, is_verified, is_artist, is_admin, is_blocked, telegram, instagram, website, tiktok, youtube, show_likes, show_reposts, show_followers, show_following, show_friends, created_at FROM users WHERE username = '%s'" % username.replace("'", "''"))
+    if headers.get('If-None-Match') or headers.get('if-none-match'):
+        cur.execute("SELECT u.id, u.profile_version, %s FROM users u WHERE u.username = '%s'" % (status_sql, username.replace("'", "''")))
+        probe = cur.fetchone()
+        if probe:
+            etag = profile_etag(probe[0], probe[1], viewer_id, probe[2])
+            if etag_matches(headers, etag):
+                return {'statusCode': 304, 'headers': etag_headers(etag), 'body': ''}
+    cur.execute("""SELECT u.id, u.username, u.email, u.display_name, u.bio, u.is_private, u.is_verified, u.is_artist, u.is_admin, u.is_blocked,
+            u.telegram, u.instagram, u.website, u.tiktok, u.youtube, u.show_likes, u.show_reposts, u.show_followers, u.show_following, u.show_friends, u.created_at,
+            u.followers_count, u.following_count, u.posts_count, u.profile_version, %s,
+            (SELECT COALESCE(json_agg(json_build_object('id', a.id, 'url', a.url, 'is_primary', a.is_primary) ORDER BY a.is_primary DESC, a.created_at DESC), '[]')
+                FROM user_avatars a WHERE a.user_id = u.id),
+            CASE WHEN u.is_artist THEN (SELECT COALESCE(json_agg(json_build_object('id', x.id, 'title', x.title, 'artist_name', x.artist_name,
+                    'cover_url', x.cover_url, 'audio_url', x.audio_url, 'created_at', x.created_at) ORDER BY x.created_at DESC), '[]')
+                FROM releases x WHERE x.artist_id = u.id) END
+        FROM users u WHERE u.username = '%s'""" % (status_sql, username.replace("'", "''")))
     r = cur.fetchone()
     if not r:
-        conn.close()
         return {'statusCode': 404, 'headers': cors_headers(), 'body': json.dumps({'error': 'User not found'})}
     uid = str(r[0])
     profile = {
@@ -260,721 +1546,953 @@ def get_profile(params, user):
         'is_private': r[5], 'is_verified': r[6], 'is_artist': r[7], 'is_admin': r[8], 'is_blocked': r[9],
         'telegram': r[10], 'instagram': r[11], 'website': r[12], 'tiktok': r[13], 'youtube': r[14],
         'show_likes': r[15], 'show_reposts': r[16], 'show_followers': r[17], 'show_following': r[18], 'show_friends': r[19],
-        'created_at': r[20].isoformat() if r[20] else None
+        'created_at': r[20].isoformat() if r[20] else None,
+        'followers_count': r[21], 'following_count': r[22], 'posts_count': r[23],
+        'avatars': r[26] or [],
+        'is_following': r[25] == 'accepted', 'follow_status': r[25]
     }
-    cur.execute("SELECT COUNT(*) FROM follows WHERE following_id = '%s' AND status = 'accepted'" % uid)
-    profile['followers_count'] = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM follows WHERE follower_id = '%s' AND status = 'accepted'" % uid)
-    profile['following_count'] = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM posts WHERE user_id = '%s' AND is_hidden = FALSE" % uid)
-    profile['posts_count'] = cur.fetchone()[0]
-    cur.execute("SELECT id, url, is_primary FROM user_avatars WHERE user_id = '%s' ORDER BY is_primary DESC, created_at DESC" % uid)
-    profile['avatars'] = [{'id': str(a[0]), 'url': a[1], 'is_primary': a[2]} for a in cur.fetchall()]
-    profile['is_following'] = False
-    profile['follow_status'] = None
-    if user and user['id'] != uid:
-        cur.execute("SELECT status FROM follows WHERE follower_id = '%s' AND following_id = '%s'" % (user['id'], uid))
-        fr = cur.fetchone()
-        if fr:
-            profile['follow_status'] = fr[0]
-            profile['is_following'] = fr[0] == 'accepted'
-    if r[7]:
-        cur.execute("SELECT id, title, artist_name, cover_url, audio_url, created_at FROM releases WHERE artist_id = '%s' ORDER BY created_at DESC" % uid)
-        profile['releases'] = [{'id': str(x[0]), 'title': x[1], 'artist_name': x[2], 'cover_url': x[3], 'audio_url': x[4], 'created_at': x[5].isoformat() if x[5] else None} for x in cur.fetchall()]
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(profile, default=str)}
-
-
-def get_comments(params, user):
+    if r[27] is not None:
+        profile['releases'] = r[27]
+    etag = profile_etag(uid, r[24], viewer_id, r[25])
+    return {'statusCode': 200, 'headers': etag_headers(etag), 'body': json.dumps(profile, default=str)}
+
+
+def comments_from_rows(cur, rows, author_id, user):
+    comments = [{
+        'id': str(r[0]), 'content': r[1], 'parent_id': str(r[2]) if r[2] else None,
+        'created_at': r[3].isoformat() if r[3] else None, 'user': {'id': str(r[4])},
+        'likes_count': r[5], 'reply_count': r[6], 'is_author_like': False, 'liked': False
+    } for r in rows]
+    if not comments:
+        return comments
+    viewer_id = user['id'] if user else author_id
+    cur.execute("""SELECT comment_id, BOOL_OR(user_id = '%s'), BOOL_OR(user_id = '%s') FROM comment_likes
+        WHERE user_id IN ('%s', '%s') AND comment_id IN (%s) GROUP BY comment_id""" % (
+        viewer_id, author_id, viewer_id, author_id, ','.join("'%s'" % c['id'] for c in comments)))
+    flags = dict((str(r[0]), (r[1], r[2])) for r in cur.fetchall())
+    cards = load_user_cards(cur, [c['user']['id'] for c in comments])
+    for c in comments:
+        liked, author_liked = flags.get(c['id'], (False, False))
+        c['liked'] = bool(user) and liked
+        c['is_author_like'] = author_liked
+        c['user'] = cards.get(c['user']['id'], c['user'])
+    return comments
+
+
+def get_comments(conn, params, user):
     post_id = params.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("""SELECT c.id, c.content, c.parent_id, c.created_at,
-        u.id, u.username, u.display_name, u.is_verified, u.is_artist,
-        (SELECT COUNT(*) FROM comment_likes WHERE comment_id = c.id),
-        p.user_id
-        FROM comments c JOIN users u ON c.user_id = u.id JOIN posts p ON c.post_id = p.id
-        WHERE c.post_id = '%s' AND c.is_hidden = FALSE
-        ORDER BY c.created_at ASC""" % post_id.replace("'", "''"))
-    comments = []
+    cur.execute("SELECT user_id FROM posts WHERE id = '%s'" % post_id.replace("'", "''"))
+    post = cur.fetchone()
+    if not post:
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
+    author_id = str(post[0])
+    parent_id = params.get('parent_id')
+    if params.get('mode') != 'threaded' and not parent_id:
+        cur.execute("""SELECT %s FROM comments c
+            WHERE c.post_id = '%s' AND c.is_hidden = FALSE
+            ORDER BY c.created_at ASC""" % (COMMENT_COLUMNS, post_id.replace("'", "''")))
+        comments = comments_from_rows(cur, cur.fetchall(), author_id, user)
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(comments, default=str)}
+    try:
+        page_clause, offset = page_params(params, 'c.created_at', 'c.id', op='>' if parent_id else '<')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    if parent_id:
+        cur.execute("""SELECT %s FROM comments c
+            WHERE c.parent_id = '%s' AND c.post_id = '%s' AND c.is_hidden = FALSE%s
+            ORDER BY c.created_at ASC, c.id ASC LIMIT %d OFFSET %d""" % (
+            COMMENT_COLUMNS, parent_id.replace("'", "''"), post_id.replace("'", "''"), page_clause, COMMENT_PAGE_SIZE, offset))
+        rows = cur.fetchall()
+        replies = comments_from_rows(cur, rows, author_id, user)
+        return paged_response(params, replies, (rows[-1][3], rows[-1][0]) if rows else None, COMMENT_PAGE_SIZE)
+    cur.execute("""WITH roots AS (
+            SELECT %s FROM comments c
+            WHERE c.post_id = '%s' AND c.parent_id IS NULL AND c.is_hidden = FALSE%s
+            ORDER BY c.created_at DESC, c.id DESC LIMIT %d OFFSET %d
+        )
+        SELECT * FROM roots
+        UNION ALL
+        SELECT r.* FROM roots JOIN LATERAL (
+            SELECT %s FROM comments c
+            WHERE c.parent_id = roots.id AND c.is_hidden = FALSE
+            ORDER BY c.created_at ASC, c.id ASC LIMIT %d
+        ) r ON TRUE""" % (
+        COMMENT_COLUMNS, post_id.replace("'", "''"), page_clause, COMMENT_PAGE_SIZE, offset, COMMENT_COLUMNS, COMMENT_REPLY_PREVIEW))
+    rows = cur.fetchall()
+    root_rows = sorted([r for r in rows if not r[2]], key=lambda r: (r[3], str(r[0])), reverse=True)
+    reply_rows = sorted([r for r in rows if r[2]], key=lambda r: (r[3], str(r[0])))
+    comments = comments_from_rows(cur, root_rows + reply_rows, author_id, user)
+    roots = comments[:len(root_rows)]
+    by_parent = {}
+    for c in comments[len(root_rows):]:
+        by_parent.setdefault(c['parent_id'], []).append(c)
+    for c in roots:
+        c['replies'] = by_parent.get(c['id'], [])
+    last_root = (root_rows[-1][3], root_rows[-1][0]) if root_rows else None
+    return paged_response(params, roots, last_root, COMMENT_PAGE_SIZE)
+
+
+def search_users(conn, params, user):
+    q = params.get('q', '').strip()
+    try:
+        limit = min(max(int(params.get('limit', PAGE_SIZE)), 1), SEARCH_LIMIT_MAX)
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid limit'})}
+    cur = conn.cursor()
+    if params.get('mode') == 'prefix':
+        results = prefix_search(cur, q, limit) if q else []
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(results)}
+    if not q or len(q) < 2:
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
+    try:
+        page_clause, offset = page_params(params, 'score', 'id', parse=parse_score)
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    term = q.replace("'", "''")
+    cur.execute("""SELECT id, username, display_name, is_verified, is_artist, bio, score FROM (
+            SELECT id, username, display_name, is_verified, is_artist, bio,
+                GREATEST(similarity(username, '%s'), similarity(display_name, '%s'))::float8
+                    + CASE WHEN is_verified THEN %r ELSE 0 END + CASE WHEN is_artist THEN %r ELSE 0 END AS score
+            FROM users
+            WHERE (username %% '%s' OR display_name %% '%s' OR username ILIKE '%%%s%%' OR display_name ILIKE '%%%s%%') AND is_blocked = FALSE
+        ) ranked WHERE TRUE%s
+        ORDER BY score DESC, id DESC LIMIT %d OFFSET %d""" % (
+        term, term, SEARCH_BOOSTS['is_verified'], SEARCH_BOOSTS['is_artist'], term, term, term, term, page_clause, limit, offset))
+    rows = cur.fetchall()
+    results = [{'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4], 'bio': r[5]} for r in rows]
+    cards = load_user_cards(cur, [u['id'] for u in results])
+    for u in results:
+        u['avatar'] = cards.get(u['id'], {}).get('avatar')
+    return paged_response(params, results, (rows[-1][6], rows[-1][0]) if rows else None, limit)
+
+
+def get_tag_feed(conn, params, user):
+    tag = params.get('tag', '').strip().lstrip('#').lower()
+    if not tag:
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
+    try:
+        page_clause, offset = page_params(params, 'pt.created_at', 'pt.post_id')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    if params.get('scope') == 'comments':
+        return get_tag_comments(conn, params, user, tag)
+    blocked_clause = ''
+    if user:
+        blocked_clause = " AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = '%s' AND b.blocked_id = p.user_id)" % user['id']
+    cur = conn.cursor()
+    cur.execute("""SELECT %s
+        FROM post_tags pt JOIN posts p ON p.id = pt.post_id JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE pt.tag = '%s' AND p.is_hidden = FALSE AND u.is_blocked = FALSE%s%s
+        ORDER BY pt.created_at DESC, pt.post_id DESC LIMIT %d OFFSET %d""" % (
+        POST_COLUMNS, tag[:64].replace("'", "''"), blocked_clause, page_clause, PAGE_SIZE, offset))
+    posts = []
+    last_row = None
     for r in cur.fetchall():
-        c = {
-            'id': str(r[0]), 'content': r[1], 'parent_id': str(r[2]) if r[2] else None,
-            'created_at': r[3].isoformat() if r[3] else None,
-            'user': {'id': str(r[4]), 'username': r[5], 'display_name': r[6], 'is_verified': r[7], 'is_artist': r[8]},
-            'likes_count': r[9], 'is_author_like': False, 'liked': False
-        }
-        post_author_id = str(r[10])
-        cur.execute("SELECT id FROM comment_likes WHERE comment_id = '%s' AND user_id = '%s'" % (c['id'], post_author_id))
-        c['is_author_like'] = cur.fetchone() is not None
-        if user:
-            cur.execute("SELECT id FROM comment_likes WHERE comment_id = '%s' AND user_id = '%s'" % (c['id'], user['id']))
-            c['liked'] = cur.fetchone() is not None
-        cur.execute("SELECT id, url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % c['user']['id'])
-        av = cur.fetchone()
-        c['user']['avatar'] = av[1] if av else None
-        comments.append(c)
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(comments, default=str)}
-
-
-def search_users(params, user):
+        last_row = (r[4], r[0])
+        posts.append(post_from_row(r))
+    hydrate_posts(cur, posts, user)
+    return paged_response(params, posts, last_row)
+
+
+def get_tag_comments(conn, params, user, tag):
+    try:
+        page_clause, offset = page_params(params, 'ct.created_at', 'ct.comment_id')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    blocked_clause = ''
+    if user:
+        blocked_clause = " AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = '%s' AND b.blocked_id = c.user_id)" % user['id']
+    cur = conn.cursor()
+    cur.execute("""SELECT c.id, c.post_id, c.content, c.created_at, c.user_id, c.likes_count
+        FROM comment_tags ct JOIN comments c ON c.id = ct.comment_id JOIN posts p ON p.id = ct.post_id
+        WHERE ct.tag = '%s' AND c.is_hidden = FALSE AND p.is_hidden = FALSE%s%s
+        ORDER BY ct.created_at DESC, ct.comment_id DESC LIMIT %d OFFSET %d""" % (
+        tag[:64].replace("'", "''"), blocked_clause, page_clause, PAGE_SIZE, offset))
+    rows = cur.fetchall()
+    cards = load_user_cards(cur, [r[4] for r in rows])
+    comments = [{
+        'id': str(r[0]), 'post_id': str(r[1]), 'content': r[2], 'created_at': r[3].isoformat() if r[3] else None,
+        'user': cards.get(str(r[4]), {'id': str(r[4])}), 'likes_count': r[5]
+    } for r in rows]
+    return paged_response(params, comments, (rows[-1][3], rows[-1][0]) if rows else None)
+
+
+_trending_cache = lru_new(16, TRENDING_CACHE_TTL)
+
+
+def get_trending(conn, params):
+    try:
+        hours = min(max(int(params.get('hours', TRENDING_HOURS)), 1), TRENDING_RETENTION_HOURS)
+        limit = min(max(int(params.get('limit', '10')), 1), SEARCH_LIMIT_MAX)
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid parameters'})}
+    key = (hours, limit)
+    trending = lru_get(_trending_cache, key)
+    if trending is None:
+        cur = conn.cursor()
+        cur.execute("""SELECT tag, SUM(uses) AS uses FROM tag_trends WHERE bucket > %d
+            GROUP BY tag ORDER BY uses DESC, tag LIMIT %d""" % (int(time.time() // 3600) - hours, limit))
+        trending = [{'tag': r[0], 'uses': int(r[1])} for r in cur.fetchall()]
+        lru_put(_trending_cache, key, trending)
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(trending)}
+
+
+def search_posts(conn, params, user):
     q = params.get('q', '').strip()
     if not q or len(q) < 2:
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
-    conn = get_db()
+    try:
+        page_clause, offset = page_params(params, 'c.rank', 'p.id', parse_score)
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    blocked_clause = ''
+    if user:
+        blocked_clause = " AND NOT EXISTS (SELECT 1 FROM blocks b WHERE b.blocker_id = '%s' AND b.blocked_id = p.user_id)" % user['id']
     cur = conn.cursor()
-    cur.execute("SELECT id, username, display_name, is_verified, is_artist, bio FROM users WHERE (username ILIKE '%%%s%%' OR display_name ILIKE '%%%s%%') AND is_blocked = FALSE LIMIT 20" % (q.replace("'", "''"), q.replace("'", "''")))
-    results = []
+    cur.execute("""WITH candidates AS MATERIALIZED (
+            SELECT p.id, ts_rank_cd(p.search_vector, query)::float8 AS rank
+            FROM posts p CROSS JOIN websearch_to_tsquery('%s', '%s') query
+            WHERE p.search_vector @@ query AND p.is_hidden = FALSE
+            ORDER BY p.created_at DESC, p.id DESC LIMIT %d
+        )
+        SELECT %s, c.rank
+        FROM candidates c JOIN posts p ON p.id = c.id JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE u.is_blocked = FALSE%s%s
+        ORDER BY c.rank DESC, p.id DESC LIMIT %d OFFSET %d""" % (
+        SEARCH_TS_CONFIG, q.replace("'", "''"), SEARCH_RANK_CANDIDATES, POST_COLUMNS, blocked_clause, page_clause, PAGE_SIZE, offset))
+    posts = []
+    last_row = None
     for r in cur.fetchall():
-        u = {'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4], 'bio': r[5]}
-        cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % u['id'])
-        av = cur.fetchone()
-        u['avatar'] = av[0] if av else None
-        results.append(u)
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(results)}
+        last_row = (r[13], r[0])
+        posts.append(post_from_row(r))
+    hydrate_posts(cur, posts, user)
+    return paged_response(params, posts, last_row)
 
 
-def create_post(body, user):
+def create_post(conn, body, user):
     content = body.get('content', '').strip()
     image_url = body.get('image_url', '')
     if not content and not image_url:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Content or image required'})}
-    conn = get_db()
     cur = conn.cursor()
     post_id = str(uuid.uuid4())
-    cur.execute("INSERT INTO posts (id, user_id, content, image_url) VALUES ('%s', '%s', '%s', '%s')" % (post_id, user['id'], content.replace("'", "''"), (image_url or '').replace("'", "''")))
+    cur.execute("INSERT INTO posts (id, user_id, content, image_url, search_vector) VALUES ('%s', '%s', '%s', '%s', to_tsvector('%s', '%s'))" % (
+        post_id, user['id'], content.replace("'", "''"), (image_url or '').replace("'", "''"), SEARCH_TS_CONFIG, content.replace("'", "''")))
+    cur.execute("INSERT INTO post_stats (post_id) VALUES ('%s')" % post_id)
+    cur.execute("INSERT INTO post_scores (post_id, bucket, score) VALUES ('%s', %d, %r)" % (post_id, int(time.time() // 86400), rank_term('post')))
+    tags = extract_tags(content)
+    index_post_tags(cur, post_id, tags)
+    enqueue(cur, 'post', post_id=post_id, user_id=user['id'], tags=tags, mentions=extract_mentions(content))
     conn.commit()
-    conn.close()
+    invalidate_responses('posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'id': post_id})}
 
 
-def like_post(body, user):
+def like_post(conn, body, user):
     post_id = body.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT id FROM post_likes WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post_id.replace("'", "''")))
     if cur.fetchone():
-        conn.close()
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
-    cur.execute("INSERT INTO post_likes (user_id, post_id) VALUES ('%s', '%s')" % (user['id'], post_id.replace("'", "''")))
-    cur.execute("SELECT user_id FROM posts WHERE id = '%s'" % post_id.replace("'", "''"))
-    post_owner = cur.fetchone()
-    if post_owner and str(post_owner[0]) != user['id']:
-        cur.execute("INSERT INTO notifications (user_id, type, from_user_id, post_id, content) VALUES ('%s', 'like', '%s', '%s', 'liked your post')" % (str(post_owner[0]), user['id'], post_id.replace("'", "''")))
+    cur.execute("INSERT INTO post_likes (user_id, post_id) VALUES ('%s', '%s') RETURNING EXTRACT(EPOCH FROM created_at)" % (user['id'], post_id.replace("'", "''")))
+    enqueue(cur, 'like', post_id=str(uuid.UUID(post_id)), user_id=user['id'], at=float(cur.fetchone()[0]))
     conn.commit()
-    conn.close()
+    invalidate_responses('post:' + str(uuid.UUID(post_id)), 'viewer:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def unlike_post(body, user):
+def unlike_post(conn, body, user):
     post_id = body.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE post_likes SET post_id = post_id WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post_id.replace("'", "''")))
-    cur.execute("SELECT id FROM post_likes WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post_id.replace("'", "''")))
-    row = cur.fetchone()
-    if row:
-        lid = str(row[0])
-        cur.execute("UPDATE post_likes SET user_id = '00000000-0000-0000-0000-000000000000' WHERE id = '%s'" % lid)
+    cur.execute("DELETE FROM post_likes WHERE user_id = '%s' AND post_id = '%s' RETURNING EXTRACT(EPOCH FROM created_at)" % (user['id'], post_id.replace("'", "''")))
+    removed = cur.fetchone()
+    if removed:
+        enqueue(cur, 'unlike', post_id=str(uuid.UUID(post_id)), user_id=user['id'], at=float(removed[0]) if removed[0] is not None else None)
     conn.commit()
-    conn.close()
+    if removed:
+        invalidate_responses('post:' + str(uuid.UUID(post_id)), 'viewer:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def add_comment(body, user):
+def add_comment(conn, body, user):
     post_id = body.get('post_id', '')
     content = body.get('content', '').strip()
     parent_id = body.get('parent_id', None)
     if not content:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Content required'})}
-    conn = get_db()
     cur = conn.cursor()
     cid = str(uuid.uuid4())
-    parent_sql = "'%s'" % parent_id if parent_id else "NULL"
-    cur.execute("INSERT INTO comments (id, post_id, user_id, parent_id, content) VALUES ('%s', '%s', '%s', %s, '%s')" % (cid, post_id.replace("'", "''"), user['id'], parent_sql, content.replace("'", "''")))
-    cur.execute("SELECT user_id FROM posts WHERE id = '%s'" % post_id.replace("'", "''"))
-    post_owner = cur.fetchone()
-    if post_owner and str(post_owner[0]) != user['id']:
-        cur.execute("INSERT INTO notifications (user_id, type, from_user_id, post_id, content) VALUES ('%s', 'comment', '%s', '%s', '%s')" % (str(post_owner[0]), user['id'], post_id.replace("'", "''"), content.replace("'", "''")[:100]))
+    parent_sql = "'%s'" % parent_id.replace("'", "''") if parent_id else "NULL"
+    cur.execute("INSERT INTO comments (id, post_id, user_id, parent_id, content) VALUES ('%s', '%s', '%s', %s, '%s') RETURNING EXTRACT(EPOCH FROM created_at)" % (cid, post_id.replace("'", "''"), user['id'], parent_sql, content.replace("'", "''")))
+    at = float(cur.fetchone()[0])
+    tags = extract_tags(content)
+    index_comment_tags(cur, cid, tags)
+    enqueue(cur, 'comment', post_id=str(uuid.UUID(post_id)), user_id=user['id'], content=content[:100], comment_id=cid, at=at,
+            parent_id=str(uuid.UUID(parent_id)) if parent_id else None, tags=tags, mentions=extract_mentions(content))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'id': cid})}
 
 
-def like_comment(body, user):
+def like_comment(conn, body, user):
     comment_id = body.get('comment_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT id FROM comment_likes WHERE user_id = '%s' AND comment_id = '%s'" % (user['id'], comment_id.replace("'", "''")))
     if cur.fetchone():
-        conn.close()
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
     cur.execute("INSERT INTO comment_likes (user_id, comment_id) VALUES ('%s', '%s')" % (user['id'], comment_id.replace("'", "''")))
+    enqueue(cur, 'comment_like', comment_id=str(uuid.UUID(comment_id)))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def unlike_comment(body, user):
+def unlike_comment(conn, body, user):
     comment_id = body.get('comment_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM comment_likes WHERE user_id = '%s' AND comment_id = '%s'" % (user['id'], comment_id.replace("'", "''")))
-    row = cur.fetchone()
-    if row:
-        cur.execute("UPDATE comment_likes SET user_id = '00000000-0000-0000-0000-000000000000' WHERE id = '%s'" % str(row[0]))
+    cur.execute("DELETE FROM comment_likes WHERE user_id = '%s' AND comment_id = '%s' RETURNING comment_id" % (user['id'], comment_id.replace("'", "''")))
+    removed = cur.fetchone()
+    if removed:
+        enqueue(cur, 'comment_unlike', comment_id=str(removed[0]))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def follow_user(body, user):
-    target_id = body.get('user_id', '')
+def follow_user(conn, body, user):
+    try:
+        target_id = str(uuid.UUID(str(body.get('user_id', ''))))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid user id'})}
     if target_id == user['id']:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Cannot follow yourself'})}
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id, status FROM follows WHERE follower_id = '%s' AND following_id = '%s'" % (user['id'], target_id.replace("'", "''")))
+    cur.execute("SELECT id, status FROM follows WHERE follower_id = '%s' AND following_id = '%s'" % (user['id'], target_id))
     existing = cur.fetchone()
-    if existing:
-        conn.close()
+    if existing and existing[1] == 'removed':
+        cur.execute("DELETE FROM follows WHERE id = '%s'" % str(existing[0]))
+    elif existing:
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'status': existing[1]})}
-    cur.execute("SELECT is_private FROM users WHERE id = '%s'" % target_id.replace("'", "''"))
+    cur.execute("SELECT is_private FROM users WHERE id = '%s'" % target_id)
     target = cur.fetchone()
     status = 'pending' if target and target[0] else 'accepted'
-    cur.execute("INSERT INTO follows (follower_id, following_id, status) VALUES ('%s', '%s', '%s')" % (user['id'], target_id.replace("'", "''"), status))
+    cur.execute("INSERT INTO follows (follower_id, following_id, status) VALUES ('%s', '%s', '%s')" % (user['id'], target_id, status))
+    if status == 'accepted':
+        backfill_timeline(cur, user['id'], target_id)
+        enqueue(cur, 'follow', follower_id=user['id'], following_id=target_id)
     ntype = 'follow_request' if status == 'pending' else 'follow'
-    cur.execute("INSERT INTO notifications (user_id, type, from_user_id, content) VALUES ('%s', '%s', '%s', '%s')" % (target_id.replace("'", "''"), ntype, user['id'], 'wants to follow you' if status == 'pending' else 'started following you'))
+    enqueue(cur, 'notify', user_id=target_id, type=ntype, from_user_id=user['id'], content='wants to follow you' if status == 'pending' else 'started following you')
     conn.commit()
-    conn.close()
+    invalidate_responses('user:' + target_id, 'followers:' + target_id, 'following:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'status': status})}
 
 
-def unfollow_user(body, user):
-    target_id = body.get('user_id', '')
-    conn = get_db()
+def unfollow_user(conn, body, user):
+    try:
+        target_id = str(uuid.UUID(str(body.get('user_id', ''))))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid user id'})}
     cur = conn.cursor()
-    cur.execute("SELECT id FROM follows WHERE follower_id = '%s' AND following_id = '%s'" % (user['id'], target_id.replace("'", "''")))
-    row = cur.fetchone()
-    if row:
-        cur.execute("UPDATE follows SET status = 'removed' WHERE id = '%s'" % str(row[0]))
+    cur.execute("DELETE FROM follows WHERE follower_id = '%s' AND following_id = '%s' RETURNING status" % (user['id'], target_id))
+    removed = cur.fetchone()
+    if removed:
+        purge_timeline(cur, user['id'], target_id)
+        if removed[0] == 'accepted':
+            enqueue(cur, 'unfollow', follower_id=user['id'], following_id=target_id)
     conn.commit()
-    conn.close()
+    if removed:
+        invalidate_responses('user:' + target_id, 'followers:' + target_id, 'following:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def accept_follow(body, user):
-    follower_id = body.get('user_id', '')
-    conn = get_db()
+def accept_follow(conn, body, user):
+    try:
+        follower_id = str(uuid.UUID(str(body.get('user_id', ''))))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid user id'})}
     cur = conn.cursor()
-    cur.execute("UPDATE follows SET status = 'accepted' WHERE follower_id = '%s' AND following_id = '%s' AND status = 'pending'" % (follower_id.replace("'", "''"), user['id']))
-    cur.execute("INSERT INTO notifications (user_id, type, from_user_id, content) VALUES ('%s', 'follow_accepted', '%s', 'accepted your follow request')" % (follower_id.replace("'", "''"), user['id']))
+    cur.execute("UPDATE follows SET status = 'accepted' WHERE follower_id = '%s' AND following_id = '%s' AND status = 'pending'" % (follower_id, user['id']))
+    if cur.rowcount:
+        backfill_timeline(cur, follower_id, user['id'])
+        enqueue(cur, 'follow', follower_id=follower_id, following_id=user['id'])
+        enqueue(cur, 'notify', user_id=follower_id, type='follow_accepted', from_user_id=user['id'], content='accepted your follow request')
     conn.commit()
-    conn.close()
+    invalidate_responses('user:' + user['id'], 'followers:' + user['id'], 'following:' + follower_id)
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def reject_follow(body, user):
-    follower_id = body.get('user_id', '')
-    conn = get_db()
+def reject_follow(conn, body, user):
+    try:
+        follower_id = str(uuid.UUID(str(body.get('user_id', ''))))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid user id'})}
     cur = conn.cursor()
-    cur.execute("UPDATE follows SET status = 'rejected' WHERE follower_id = '%s' AND following_id = '%s' AND status = 'pending'" % (follower_id.replace("'", "''"), user['id']))
+    cur.execute("UPDATE follows SET status = 'rejected' WHERE follower_id = '%s' AND following_id = '%s' AND status = 'pending'" % (follower_id, user['id']))
     conn.commit()
-    conn.close()
+    invalidate_responses('user:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def repost(body, user):
+def repost(conn, body, user):
     post_id = body.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT id FROM reposts WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post_id.replace("'", "''")))
     if cur.fetchone():
-        conn.close()
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
-    cur.execute("INSERT INTO reposts (user_id, post_id) VALUES ('%s', '%s')" % (user['id'], post_id.replace("'", "''")))
+    cur.execute("INSERT INTO reposts (user_id, post_id) VALUES ('%s', '%s') RETURNING EXTRACT(EPOCH FROM created_at)" % (user['id'], post_id.replace("'", "''")))
+    enqueue(cur, 'repost', post_id=str(uuid.UUID(post_id)), at=float(cur.fetchone()[0]))
     conn.commit()
-    conn.close()
+    invalidate_responses('post:' + str(uuid.UUID(post_id)), 'viewer:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def unrepost(body, user):
+def unrepost(conn, body, user):
     post_id = body.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM reposts WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post_id.replace("'", "''")))
-    row = cur.fetchone()
-    if row:
-        cur.execute("UPDATE reposts SET user_id = '00000000-0000-0000-0000-000000000000' WHERE id = '%s'" % str(row[0]))
+    cur.execute("DELETE FROM reposts WHERE user_id = '%s' AND post_id = '%s' RETURNING EXTRACT(EPOCH FROM created_at)" % (user['id'], post_id.replace("'", "''")))
+    removed = cur.fetchone()
+    if removed:
+        enqueue(cur, 'unrepost', post_id=str(uuid.UUID(post_id)), at=float(removed[0]) if removed[0] is not None else None)
     conn.commit()
-    conn.close()
+    if removed:
+        invalidate_responses('post:' + str(uuid.UUID(post_id)), 'viewer:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def hide_post(body, user):
+def hide_post(conn, body, user):
     post_id = body.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE posts SET is_hidden = TRUE WHERE id = '%s' AND user_id = '%s'" % (post_id.replace("'", "''"), user['id']))
+    cur.execute("UPDATE posts SET is_hidden = TRUE WHERE id = '%s' AND user_id = '%s' AND is_hidden = FALSE RETURNING id" % (post_id.replace("'", "''"), user['id']))
+    hidden = cur.fetchone()
+    if hidden:
+        enqueue(cur, 'unpost', user_id=user['id'])
     conn.commit()
-    conn.close()
+    if hidden:
+        invalidate_responses('post:' + str(hidden[0]), 'posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def hide_comment(body, user):
+def hide_comment(conn, body, user):
     comment_id = body.get('comment_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT c.id FROM comments c JOIN posts p ON c.post_id = p.id WHERE c.id = '%s' AND (c.user_id = '%s' OR p.user_id = '%s')" % (comment_id.replace("'", "''"), user['id'], user['id']))
     if cur.fetchone():
-        cur.execute("UPDATE comments SET is_hidden = TRUE WHERE id = '%s'" % comment_id.replace("'", "''"))
+        cur.execute("UPDATE comments SET is_hidden = TRUE WHERE id = '%s' AND is_hidden = FALSE RETURNING post_id, parent_id, EXTRACT(EPOCH FROM created_at)" % comment_id.replace("'", "''"))
+        hidden = cur.fetchone()
+        if hidden:
+            enqueue(cur, 'uncomment', post_id=str(hidden[0]), parent_id=str(hidden[1]) if hidden[1] else None,
+                    at=float(hidden[2]) if hidden[2] is not None else None)
         conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def update_profile(body, user):
-    conn = get_db()
+def update_profile(conn, body, user):
     cur = conn.cursor()
     fields = []
     for f in ['display_name', 'bio', 'telegram', 'instagram', 'website', 'tiktok', 'youtube', 'show_likes', 'show_reposts', 'show_followers', 'show_following', 'show_friends', 'theme']:
         if f in body:
             fields.append("%s = '%s'" % (f, str(body[f]).replace("'", "''")))
+    if 'display_name' in body:
+        fields.append("search_updated_at = NOW()")
     if 'is_private' in body:
         fields.append("is_private = %s" % ('TRUE' if body['is_private'] else 'FALSE'))
     if 'allow_messages' in body:
         fields.append("allow_messages = %s" % ('TRUE' if body['allow_messages'] else 'FALSE'))
+    if fields:
+        fields.append("profile_version = profile_version + 1")
     if fields:
         cur.execute("UPDATE users SET %s WHERE id = '%s'" % (', '.join(fields), user['id']))
         conn.commit()
-    conn.close()
+        invalidate_user_card(user['id'])
+        invalidate_responses('user:' + user['id'], 'posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def send_message(body, user):
-    receiver_id = body.get('receiver_id', '')
+def send_message(conn, body, user):
+    try:
+        receiver_id = str(uuid.UUID(str(body.get('receiver_id', ''))))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid user id'})}
     content = body.get('content', '').strip()
     reply_to_id = body.get('reply_to_id', None)
     if not content:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Content required'})}
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT allow_messages FROM users WHERE id = '%s'" % receiver_id.replace("'", "''"))
+    cur.execute("SELECT allow_messages FROM users WHERE id = '%s'" % receiver_id)
     rec = cur.fetchone()
     if rec and not rec[0]:
-        conn.close()
         return {'statusCode': 403, 'headers': cors_headers(), 'body': json.dumps({'error': 'User disabled messages'})}
-    cur.execute("SELECT id FROM blocks WHERE blocker_id = '%s' AND blocked_id = '%s'" % (receiver_id.replace("'", "''"), user['id']))
+    cur.execute("SELECT id FROM blocks WHERE blocker_id = '%s' AND blocked_id = '%s'" % (receiver_id, user['id']))
     if cur.fetchone():
-        conn.close()
         return {'statusCode': 403, 'headers': cors_headers(), 'body': json.dumps({'error': 'Blocked'})}
     mid = str(uuid.uuid4())
     reply_sql = "'%s'" % reply_to_id if reply_to_id else "NULL"
-    cur.execute("INSERT INTO messages (id, sender_id, receiver_id, content, reply_to_id) VALUES ('%s', '%s', '%s', '%s', %s)" % (mid, user['id'], receiver_id.replace("'", "''"), content.replace("'", "''"), reply_sql))
-    cur.execute("INSERT INTO notifications (user_id, type, from_user_id, content) VALUES ('%s', 'message', '%s', '%s')" % (receiver_id.replace("'", "''"), user['id'], content.replace("'", "''")[:50]))
+    seq = sync_stamp(cur, [user['id'], receiver_id])
+    cur.execute("INSERT INTO messages (id, sender_id, receiver_id, content, reply_to_id, seq) VALUES ('%s', '%s', '%s', '%s', %s, %d)" % (mid, user['id'], receiver_id, content.replace("'", "''"), reply_sql, seq))
+    touch_conversation(cur, user['id'], receiver_id, mid, content, user['id'], 0, seq)
+    touch_conversation(cur, receiver_id, user['id'], mid, content, user['id'], 1, seq)
+    bump_badges(cur, 'unread_messages', {receiver_id: 1})
+    enqueue(cur, 'notify', user_id=receiver_id, type='message', from_user_id=user['id'], content=content[:50])
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'id': mid})}
 
 
-def edit_message(body, user):
+def edit_message(conn, body, user):
     msg_id = body.get('message_id', '')
     content = body.get('content', '').strip()
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE messages SET content = '%s', edited_at = NOW() WHERE id = '%s' AND sender_id = '%s'" % (content.replace("'", "''"), msg_id.replace("'", "''"), user['id']))
+    cur.execute("SELECT id, receiver_id FROM messages WHERE id = '%s' AND sender_id = '%s'" % (msg_id.replace("'", "''"), user['id']))
+    row = cur.fetchone()
+    if row:
+        seq = sync_stamp(cur, [user['id'], row[1]])
+        cur.execute("UPDATE messages SET content = '%s', edited_at = NOW(), seq = %d WHERE id = '%s'" % (content.replace("'", "''"), seq, row[0]))
+        cur.execute("""UPDATE conversations SET last_message = '%s', seq = %d
+            WHERE ((user_id = '%s' AND partner_id = '%s') OR (user_id = '%s' AND partner_id = '%s')) AND last_message_id = '%s'""" % (
+            content[:MESSAGE_PREVIEW_LENGTH].replace("'", "''"), seq, user['id'], row[1], row[1], user['id'], row[0]))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def pin_message(body, user):
+def pin_message(conn, body, user):
     msg_id = body.get('message_id', '')
     pinned = body.get('pinned', True)
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE messages SET is_pinned = %s WHERE id = '%s' AND (sender_id = '%s' OR receiver_id = '%s')" % ('TRUE' if pinned else 'FALSE', msg_id.replace("'", "''"), user['id'], user['id']))
+    cur.execute("SELECT id, sender_id, receiver_id FROM messages WHERE id = '%s' AND (sender_id = '%s' OR receiver_id = '%s')" % (msg_id.replace("'", "''"), user['id'], user['id']))
+    row = cur.fetchone()
+    if row:
+        cur.execute("UPDATE messages SET is_pinned = %s, seq = %d WHERE id = '%s'" % ('TRUE' if pinned else 'FALSE', sync_stamp(cur, [row[1], row[2]]), row[0]))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def mark_read(body, user):
+def mark_read(conn, body, user):
     sender_id = body.get('sender_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE messages SET is_read = TRUE WHERE sender_id = '%s' AND receiver_id = '%s' AND is_read = FALSE" % (sender_id.replace("'", "''"), user['id']))
+    cur.execute("SELECT 1 FROM messages WHERE sender_id = '%s' AND receiver_id = '%s' AND is_read = FALSE LIMIT 1" % (sender_id.replace("'", "''"), user['id']))
+    if not cur.fetchone():
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
+    seq = sync_stamp(cur, [user['id'], sender_id.replace("'", "''")])
+    cur.execute("UPDATE messages SET is_read = TRUE, seq = %d WHERE sender_id = '%s' AND receiver_id = '%s' AND is_read = FALSE" % (seq, sender_id.replace("'", "''"), user['id']))
+    cur.execute("SELECT unread_count FROM conversations WHERE user_id = '%s' AND partner_id = '%s'" % (user['id'], sender_id.replace("'", "''")))
+    row = cur.fetchone()
+    cur.execute("UPDATE conversations SET unread_count = 0, seq = %d WHERE user_id = '%s' AND partner_id = '%s' AND unread_count > 0" % (seq, user['id'], sender_id.replace("'", "''")))
+    bump_badges(cur, 'unread_messages', {user['id']: -row[0] if row else 0})
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def get_messages(params, user):
-    if not user:
-        return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""SELECT DISTINCT ON (partner_id) partner_id, content, created_at, is_read, sender_id FROM (
-        SELECT CASE WHEN sender_id = '%s' THEN receiver_id ELSE sender_id END as partner_id,
-        content, created_at, is_read, sender_id
-        FROM messages WHERE (sender_id = '%s' AND hidden_by_sender = FALSE) OR (receiver_id = '%s' AND hidden_by_receiver = FALSE)
-        ORDER BY partner_id, created_at DESC
-    ) sub""" % (user['id'], user['id'], user['id']))
+def chats_from_rows(cur, rows):
+    cards = load_user_cards(cur, [r[0] for r in rows])
     chats = []
-    for r in cur.fetchall():
+    for r in rows:
         pid = str(r[0])
-        cur.execute("SELECT username, display_name, is_verified, is_artist FROM users WHERE id = '%s'" % pid)
-        u = cur.fetchone()
+        u = cards.get(pid)
         if not u:
             continue
-        cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % pid)
-        av = cur.fetchone()
-        cur.execute("SELECT COUNT(*) FROM messages WHERE sender_id = '%s' AND receiver_id = '%s' AND is_read = FALSE" % (pid, user['id']))
-        unread = cur.fetchone()[0]
         chats.append({
-            'partner_id': pid, 'username': u[0], 'display_name': u[1], 'is_verified': u[2], 'is_artist': u[3],
-            'avatar': av[0] if av else None, 'last_message': r[1], 'last_time': r[2].isoformat() if r[2] else None,
-            'unread': unread
+            'partner_id': pid, 'username': u['username'], 'display_name': u['display_name'], 'is_verified': u['is_verified'], 'is_artist': u['is_artist'],
+            'avatar': u['avatar'], 'last_message': r[1], 'last_time': r[2].isoformat() if r[2] else None,
+            'unread': r[3]
         })
-    conn.close()
-    chats.sort(key=lambda x: x['last_time'] or '', reverse=True)
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(chats, default=str)}
+    return chats
 
 
-def get_conversation(params, user):
+def get_messages(conn, params, user):
     if not user:
         return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
-    partner_id = params.get('partner_id', '')
-    conn = get_db()
+    try:
+        page_clause, offset = page_params(params, 'last_time', 'partner_id')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
+    limit = PAGE_SIZE if params.get('cursor') is not None else INBOX_LEGACY_LIMIT
     cur = conn.cursor()
-    cur.execute("""SELECT id, sender_id, receiver_id, content, reply_to_id, is_read, is_pinned, edited_at, created_at
-        FROM messages
-        WHERE ((sender_id = '%s' AND receiver_id = '%s' AND hidden_by_sender = FALSE) OR (sender_id = '%s' AND receiver_id = '%s' AND hidden_by_receiver = FALSE))
-        ORDER BY created_at ASC LIMIT 100""" % (user['id'], partner_id.replace("'", "''"), partner_id.replace("'", "''"), user['id']))
-    msgs = []
-    for r in cur.fetchall():
-        msgs.append({
-            'id': str(r[0]), 'sender_id': str(r[1]), 'receiver_id': str(r[2]),
-            'content': r[3], 'reply_to_id': str(r[4]) if r[4] else None,
-            'is_read': r[5], 'is_pinned': r[6],
-            'edited_at': r[7].isoformat() if r[7] else None,
-            'created_at': r[8].isoformat() if r[8] else None
-        })
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(msgs, default=str)}
+    cur.execute("""SELECT partner_id, last_message, last_time, unread_count FROM conversations
+        WHERE user_id = '%s'%s
+        ORDER BY last_time DESC, partner_id DESC LIMIT %d OFFSET %d""" % (user['id'], page_clause, limit, offset))
+    rows = cur.fetchall()
+    return paged_response(params, chats_from_rows(cur, rows), (rows[-1][2], rows[-1][0]) if rows else None)
+
+
+def message_from_row(r):
+    return {
+        'id': str(r[0]), 'sender_id': str(r[1]), 'receiver_id': str(r[2]),
+        'content': r[3], 'reply_to_id': str(r[4]) if r[4] else None,
+        'is_read': r[5], 'is_pinned': r[6],
+        'edited_at': r[7].isoformat() if r[7] else None,
+        'created_at': r[8].isoformat() if r[8] else None
+    }
 
 
-def create_story(body, user):
+def get_conversation(conn, params, user):
+    if not user:
+        return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
+    partner_id = params.get('partner_id', '').replace("'", "''")
+    before = params.get('before')
+    page_clause = ''
+    if before:
+        decoded = decode_cursor(before, parse_timestamp)
+        if not decoded:
+            return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid cursor'})}
+        page_clause = " AND (created_at, id) < ('%s', '%s')" % decoded
+    pair_clause = """LEAST(sender_id, receiver_id) = LEAST('%s'::uuid, '%s'::uuid) AND GREATEST(sender_id, receiver_id) = GREATEST('%s'::uuid, '%s'::uuid)
+        AND ((sender_id = '%s' AND hidden_by_sender = FALSE) OR (receiver_id = '%s' AND hidden_by_receiver = FALSE))""" % (
+        user['id'], partner_id, user['id'], partner_id, user['id'], user['id'])
+    limit = CONVERSATION_PAGE_SIZE if before is not None else CONVERSATION_LEGACY_LIMIT
+    cur = conn.cursor()
+    cur.execute("""SELECT id, sender_id, receiver_id, content, reply_to_id, is_read, is_pinned, edited_at, created_at
+        FROM messages WHERE %s%s
+        ORDER BY created_at DESC, id DESC LIMIT %d""" % (pair_clause, page_clause, limit))
+    rows = cur.fetchall()
+    msgs = [message_from_row(r) for r in rows]
+    if before is None:
+        msgs.reverse()
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(msgs, default=str)}
+    pinned = []
+    if not before:
+        cur.execute("""SELECT id, sender_id, receiver_id, content, reply_to_id, is_read, is_pinned, edited_at, created_at
+            FROM messages WHERE is_pinned = TRUE AND %s
+            ORDER BY created_at DESC LIMIT %d""" % (pair_clause, CONVERSATION_PAGE_SIZE))
+        pinned = [message_from_row(r) for r in cur.fetchall()]
+    next_cursor = encode_cursor(rows[-1][8], rows[-1][0]) if len(rows) == limit else None
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'items': msgs, 'pinned': pinned, 'next_cursor': next_cursor}, default=str)}
+
+
+def create_story(conn, body, user):
     image_url = body.get('image_url', '')
     visibility = body.get('visibility', 'all')
     if not image_url:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Image required'})}
-    conn = get_db()
+    ensure_story_partitions_if_due(conn)
     cur = conn.cursor()
     sid = str(uuid.uuid4())
     cur.execute("INSERT INTO stories (id, user_id, image_url, visibility) VALUES ('%s', '%s', '%s', '%s')" % (sid, user['id'], image_url.replace("'", "''"), visibility.replace("'", "''")))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'id': sid})}
 
 
-def get_stories(user):
+def record_story_views(conn, body, user):
+    try:
+        story_ids = sorted(set(str(uuid.UUID(str(sid))) for sid in body.get('story_ids', [])))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid story id'})}
+    if not story_ids:
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'recorded': 0})}
+    if len(story_ids) > STORY_VIEW_BATCH:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'At most %d story ids per request' % STORY_VIEW_BATCH})}
+    cur = conn.cursor()
+    cur.execute("""INSERT INTO story_views (story_id, user_id, story_expires_at)
+        SELECT id, '%s', expires_at FROM stories WHERE id IN (%s) AND expires_at > NOW()
+        ON CONFLICT DO NOTHING""" % (user['id'], ','.join("'%s'" % sid for sid in story_ids)))
+    recorded = cur.rowcount
+    conn.commit()
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'recorded': recorded})}
+
+
+def get_stories(conn, user):
     if not user:
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("""SELECT s.id, s.image_url, s.visibility, s.created_at, s.expires_at,
-        u.id, u.username, u.display_name, u.is_verified, u.is_artist
-        FROM stories s JOIN users u ON s.user_id = u.id
-        WHERE s.expires_at > NOW() AND u.is_blocked = FALSE
-        ORDER BY s.created_at DESC""")
+    cur.execute("""WITH authors AS (
+            SELECT following_id AS user_id FROM follows WHERE follower_id = '%s' AND status = 'accepted'
+            UNION SELECT '%s'::uuid
+        ), visible AS (
+            SELECT s.id, s.image_url, s.visibility, s.created_at, s.expires_at, s.user_id,
+                ROW_NUMBER() OVER (PARTITION BY s.user_id ORDER BY s.created_at DESC) AS rn,
+                MAX(s.created_at) OVER (PARTITION BY s.user_id) AS latest
+            FROM authors a JOIN stories s ON s.user_id = a.user_id AND s.expires_at > NOW()
+            WHERE s.user_id = '%s' OR s.visibility IN ('all', 'followers') OR (s.visibility = 'mutual' AND EXISTS (
+                SELECT 1 FROM follows r WHERE r.follower_id = s.user_id AND r.following_id = '%s' AND r.status = 'accepted'))
+        ), ranked AS (
+            SELECT v.*, DENSE_RANK() OVER (ORDER BY v.user_id = '%s' DESC, v.latest DESC, v.user_id) AS author_rank
+            FROM visible v WHERE v.rn <= %d
+        )
+        SELECT r.id, r.image_url, r.visibility, r.created_at, r.expires_at,
+            u.id, u.username, u.display_name, u.is_verified, u.is_artist
+        FROM ranked r JOIN users u ON u.id = r.user_id AND u.is_blocked = FALSE
+        WHERE r.author_rank <= %d
+        ORDER BY r.author_rank, r.created_at DESC""" % (user['id'], user['id'], user['id'], user['id'], user['id'], STORIES_PER_AUTHOR, STORIES_AUTHOR_LIMIT))
     stories = []
     for r in cur.fetchall():
-        s_user_id = str(r[5])
-        vis = r[2]
-        can_see = False
-        if s_user_id == user['id']:
-            can_see = True
-        elif vis == 'all':
-            can_see = True
-        elif vis == 'followers':
-            cur.execute("SELECT id FROM follows WHERE follower_id = '%s' AND following_id = '%s' AND status = 'accepted'" % (user['id'], s_user_id))
-            can_see = cur.fetchone() is not None
-        elif vis == 'mutual':
-            cur.execute("SELECT id FROM follows WHERE follower_id = '%s' AND following_id = '%s' AND status = 'accepted'" % (user['id'], s_user_id))
-            f1 = cur.fetchone()
-            cur.execute("SELECT id FROM follows WHERE follower_id = '%s' AND following_id = '%s' AND status = 'accepted'" % (s_user_id, user['id']))
-            f2 = cur.fetchone()
-            can_see = f1 is not None and f2 is not None
-        if can_see:
-            cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % s_user_id)
-            av = cur.fetchone()
-            stories.append({
-                'id': str(r[0]), 'image_url': r[1], 'visibility': r[2],
-                'created_at': r[3].isoformat() if r[3] else None,
-                'expires_at': r[4].isoformat() if r[4] else None,
-                'user': {'id': s_user_id, 'username': r[6], 'display_name': r[7], 'is_verified': r[8], 'is_artist': r[9], 'avatar': av[0] if av else None}
-            })
-    conn.close()
+        stories.append({
+            'id': str(r[0]), 'image_url': r[1], 'visibility': r[2],
+            'created_at': r[3].isoformat() if r[3] else None,
+            'expires_at': r[4].isoformat() if r[4] else None,
+            'user': {'id': str(r[5]), 'username': r[6], 'display_name': r[7], 'is_verified': r[8], 'is_artist': r[9]}
+        })
+    cards = load_user_cards(cur, [st['user']['id'] for st in stories])
+    for st in stories:
+        st['user']['avatar'] = cards.get(st['user']['id'], {}).get('avatar')
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(stories, default=str)}
 
 
-def get_notifications(user):
+def get_badges(conn, user):
+    if not user:
+        return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
+    badges = lru_get(_badge_cache, user['id'])
+    if badges is None:
+        cur = conn.cursor()
+        cur.execute("SELECT unread_notifications, unread_messages FROM user_sync WHERE user_id = '%s'" % user['id'])
+        row = cur.fetchone() or (0, 0)
+        badges = {'notifications': row[0], 'messages': row[1]}
+        lru_put(_badge_cache, user['id'], badges)
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(badges)}
+
+
+def get_sync(conn, params, user):
+    if not user:
+        return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
+    try:
+        since = int(params['since']) if params.get('since') else None
+        wait = min(max(int(params.get('wait', '0')), 0), SYNC_MAX_WAIT)
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid cursor'})}
+    cur = conn.cursor()
+    deadline = time.time() + wait
+    while True:
+        cur.execute("SELECT last_seq, unread_messages, unread_notifications FROM user_sync WHERE user_id = '%s'" % user['id'])
+        row = cur.fetchone() or (0, 0, 0)
+        last_seq = row[0]
+        remaining = deadline - time.time()
+        if since is None or last_seq > since or remaining <= 0:
+            break
+        conn.rollback()
+        time.sleep(min(SYNC_POLL_INTERVAL, remaining))
+    result = {'cursor': str(last_seq), 'messages': [], 'notifications': [], 'conversations': [], 'unread': None, 'has_more': False}
+    if since is not None and last_seq <= since:
+        result['cursor'] = str(since)
+        return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result)}
+    if since is not None:
+        window = "seq > %d AND seq <= %d" % (since, last_seq)
+        cur.execute("""SELECT id, sender_id, receiver_id, content, reply_to_id, is_read, is_pinned, edited_at, created_at, seq FROM messages
+            WHERE ((sender_id = '%s' AND hidden_by_sender = FALSE) OR (receiver_id = '%s' AND hidden_by_receiver = FALSE)) AND %s
+            ORDER BY seq LIMIT %d""" % (user['id'], user['id'], window, SYNC_LIMIT))
+        messages = cur.fetchall()
+        cur.execute("""SELECT id, type, content, is_read, COALESCE(updated_at, created_at), post_id, from_user_id, actor_count, recent_actor_ids::text[], seq
+            FROM notifications WHERE user_id = '%s' AND %s ORDER BY seq LIMIT %d""" % (user['id'], window, SYNC_LIMIT))
+        notifications = cur.fetchall()
+        cur.execute("""SELECT partner_id, last_message, last_time, unread_count, seq FROM conversations
+            WHERE user_id = '%s' AND %s ORDER BY seq LIMIT %d""" % (user['id'], window, SYNC_LIMIT))
+        conversations = cur.fetchall()
+        truncated = [rows[-1][-1] for rows in (messages, notifications, conversations) if len(rows) == SYNC_LIMIT]
+        if truncated:
+            result['cursor'] = str(min(truncated))
+            result['has_more'] = True
+        result['messages'] = [message_from_row(r) for r in messages]
+        result['notifications'] = notifications_from_rows(cur, notifications)
+        result['conversations'] = chats_from_rows(cur, conversations)
+    result['unread'] = {'messages': row[1], 'notifications': row[2]}
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result, default=str)}
+
+
+def get_notifications(conn, user):
     if not user:
         return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Auth required'})}
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("""SELECT n.id, n.type, n.content, n.is_read, n.created_at, n.post_id,
-        u.id, u.username, u.display_name, u.is_verified
-        FROM notifications n LEFT JOIN users u ON n.from_user_id = u.id
-        WHERE n.user_id = '%s' ORDER BY n.created_at DESC LIMIT 50""" % user['id'])
+    cur.execute("""SELECT id, type, content, is_read, COALESCE(updated_at, created_at), post_id, from_user_id, actor_count, recent_actor_ids::text[]
+        FROM notifications WHERE user_id = '%s' ORDER BY COALESCE(updated_at, created_at) DESC LIMIT 50""" % user['id'])
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(notifications_from_rows(cur, cur.fetchall()), default=str)}
+
+
+def notifications_from_rows(cur, rows):
+    cards = load_user_cards(cur, [r[6] for r in rows] + [a for r in rows for a in (r[8] or [])])
     notifs = []
-    for r in cur.fetchall():
-        n = {
+    for r in rows:
+        actors = [cards[a] for a in (r[8] or []) if a in cards]
+        notifs.append({
             'id': str(r[0]), 'type': r[1], 'content': r[2], 'is_read': r[3],
             'created_at': r[4].isoformat() if r[4] else None,
             'post_id': str(r[5]) if r[5] else None,
-            'from_user': {'id': str(r[6]), 'username': r[7], 'display_name': r[8], 'is_verified': r[9]} if r[6] else None
-        }
-        if n['from_user']:
-            cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % n['from_user']['id'])
-            av = cur.fetchone()
-            n['from_user']['avatar'] = av[0] if av else None
-        notifs.append(n)
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(notifs, default=str)}
+            'from_user': cards.get(str(r[6])) if r[6] else None,
+            'actor_count': r[7], 'actors': actors
+        })
+    return notifs
 
 
-def read_notifications(user):
-    conn = get_db()
+def read_notifications(conn, user):
     cur = conn.cursor()
-    cur.execute("UPDATE notifications SET is_read = TRUE WHERE user_id = '%s' AND is_read = FALSE" % user['id'])
+    cur.execute("UPDATE notifications SET is_read = TRUE, seq = %d WHERE user_id = '%s' AND is_read = FALSE" % (sync_stamp(cur, [user['id']]), user['id']))
+    cur.execute("UPDATE user_sync SET unread_notifications = 0 WHERE user_id = '%s'" % user['id'])
     conn.commit()
-    conn.close()
+    lru_pop(_badge_cache, user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def block_user(body, user):
+def block_user(conn, body, user):
     blocked_id = body.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT id FROM blocks WHERE blocker_id = '%s' AND blocked_id = '%s'" % (user['id'], blocked_id.replace("'", "''")))
     if not cur.fetchone():
         cur.execute("INSERT INTO blocks (blocker_id, blocked_id) VALUES ('%s', '%s')" % (user['id'], blocked_id.replace("'", "''")))
+        purge_timeline(cur, user['id'], blocked_id.replace("'", "''"))
+        purge_timeline(cur, blocked_id.replace("'", "''"), user['id'])
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def unblock_user(body, user):
+def unblock_user(conn, body, user):
     blocked_id = body.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM blocks WHERE blocker_id = '%s' AND blocked_id = '%s'" % (user['id'], blocked_id.replace("'", "''")))
-    row = cur.fetchone()
-    if row:
-        cur.execute("UPDATE blocks SET blocker_id = '00000000-0000-0000-0000-000000000000' WHERE id = '%s'" % str(row[0]))
+    cur.execute("DELETE FROM blocks WHERE blocker_id = '%s' AND blocked_id = '%s'" % (user['id'], blocked_id.replace("'", "''")))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def create_report(body, user):
+def create_report(conn, body, user):
     target_type = body.get('target_type', '')
     target_id = body.get('target_id', '')
     reason = body.get('reason', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("INSERT INTO reports (reporter_id, target_type, target_id, reason) VALUES ('%s', '%s', '%s', '%s')" % (user['id'], target_type.replace("'", "''"), target_id.replace("'", "''"), reason.replace("'", "''")))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def request_verification(body, user):
+def request_verification(conn, body, user):
     vtype = body.get('type', 'standard')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT id FROM verification_requests WHERE user_id = '%s' AND status = 'pending'" % user['id'])
     if cur.fetchone():
-        conn.close()
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Already pending'})}
     cur.execute("INSERT INTO verification_requests (user_id, type) VALUES ('%s', '%s')" % (user['id'], vtype.replace("'", "''")))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def view_post(body, user):
-    post_id = body.get('post_id', '')
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE posts SET views_count = views_count + 1 WHERE id = '%s'" % post_id.replace("'", "''"))
-    conn.commit()
-    conn.close()
+def view_post(conn, body, user, viewer_ip=''):
+    try:
+        post_id = str(uuid.UUID(body.get('post_id', '')))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Post ID required'})}
+    buffer_view(post_id, user, viewer_ip)
+    flush_views_if_due(conn)
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def create_appeal(body, user):
+def create_appeal(conn, body, user):
     reason = body.get('reason', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("INSERT INTO appeal_requests (user_id, reason) VALUES ('%s', '%s')" % (user['id'], reason.replace("'", "''")))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def delete_account(user):
-    conn = get_db()
+def delete_account(conn, user):
     cur = conn.cursor()
-    cur.execute("UPDATE users SET is_blocked = TRUE, username = username || '_deleted_' || '%s', email = email || '_deleted' WHERE id = '%s'" % (str(uuid.uuid4())[:8], user['id']))
+    cur.execute("UPDATE users SET is_blocked = TRUE, search_updated_at = NOW(), session_generation = session_generation + 1, username = username || '_deleted_' || '%s', email = email || '_deleted', profile_version = profile_version + 1 WHERE id = '%s'" % (str(uuid.uuid4())[:8], user['id']))
+    bump_auth_epoch(cur)
     conn.commit()
-    conn.close()
+    invalidate_sessions()
+    invalidate_responses('user:' + user['id'], 'posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def upload_avatar(body, user):
+def upload_avatar(conn, body, user):
     url = body.get('url', '')
     if not url:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'URL required'})}
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("UPDATE user_avatars SET is_primary = FALSE WHERE user_id = '%s'" % user['id'])
     aid = str(uuid.uuid4())
     cur.execute("INSERT INTO user_avatars (id, user_id, url, is_primary) VALUES ('%s', '%s', '%s', TRUE)" % (aid, user['id'], url.replace("'", "''")))
+    bump_profile_version(cur, user['id'])
     conn.commit()
-    conn.close()
+    invalidate_user_card(user['id'])
+    invalidate_responses('user:' + user['id'], 'posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'id': aid})}
 
 
-def remove_avatar(body, user):
+def remove_avatar(conn, body, user):
     avatar_id = body.get('avatar_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("UPDATE user_avatars SET is_primary = FALSE, url = 'removed' WHERE id = '%s' AND user_id = '%s'" % (avatar_id.replace("'", "''"), user['id']))
+    bump_profile_version(cur, user['id'])
     conn.commit()
-    conn.close()
+    invalidate_user_card(user['id'])
+    invalidate_responses('user:' + user['id'], 'posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def set_primary_avatar(body, user):
+def set_primary_avatar(conn, body, user):
     avatar_id = body.get('avatar_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("UPDATE user_avatars SET is_primary = FALSE WHERE user_id = '%s'" % user['id'])
     cur.execute("UPDATE user_avatars SET is_primary = TRUE WHERE id = '%s' AND user_id = '%s'" % (avatar_id.replace("'", "''"), user['id']))
+    bump_profile_version(cur, user['id'])
     conn.commit()
-    conn.close()
+    invalidate_user_card(user['id'])
+    invalidate_responses('user:' + user['id'], 'posts:' + user['id'])
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def get_followers(params, user):
+def get_followers(conn, params, user):
     uid = params.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("""SELECT u.id, u.username, u.display_name, u.is_verified, u.is_artist
         FROM follows f JOIN users u ON f.follower_id = u.id
         WHERE f.following_id = '%s' AND f.status = 'accepted' AND u.is_blocked = FALSE""" % uid.replace("'", "''"))
-    result = []
-    for r in cur.fetchall():
-        u = {'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4]}
-        cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % u['id'])
-        av = cur.fetchone()
-        u['avatar'] = av[0] if av else None
-        result.append(u)
-    conn.close()
+    result = [{'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4]} for r in cur.fetchall()]
+    cards = load_user_cards(cur, [u['id'] for u in result])
+    for u in result:
+        u['avatar'] = cards.get(u['id'], {}).get('avatar')
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result)}
 
 
-def get_following(params, user):
+def get_following(conn, params, user):
     uid = params.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("""SELECT u.id, u.username, u.display_name, u.is_verified, u.is_artist
         FROM follows f JOIN users u ON f.following_id = u.id
         WHERE f.follower_id = '%s' AND f.status = 'accepted' AND u.is_blocked = FALSE""" % uid.replace("'", "''"))
-    result = []
-    for r in cur.fetchall():
-        u = {'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4]}
-        cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % u['id'])
-        av = cur.fetchone()
-        u['avatar'] = av[0] if av else None
-        result.append(u)
-    conn.close()
+    result = [{'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4]} for r in cur.fetchall()]
+    cards = load_user_cards(cur, [u['id'] for u in result])
+    for u in result:
+        u['avatar'] = cards.get(u['id'], {}).get('avatar')
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result)}
 
 
-def get_friends(params, user):
+def get_friends(conn, params, user):
     uid = params.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("""SELECT u.id, u.username, u.display_name, u.is_verified, u.is_artist
         FROM follows f1 JOIN follows f2 ON f1.follower_id = f2.following_id AND f1.following_id = f2.follower_id
         JOIN users u ON f1.following_id = u.id
         WHERE f1.follower_id = '%s' AND f1.status = 'accepted' AND f2.status = 'accepted' AND u.is_blocked = FALSE""" % uid.replace("'", "''"))
-    result = []
-    for r in cur.fetchall():
-        u = {'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4]}
-        cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % u['id'])
-        av = cur.fetchone()
-        u['avatar'] = av[0] if av else None
-        result.append(u)
-    conn.close()
+    result = [{'id': str(r[0]), 'username': r[1], 'display_name': r[2], 'is_verified': r[3], 'is_artist': r[4]} for r in cur.fetchall()]
+    cards = load_user_cards(cur, [u['id'] for u in result])
+    for u in result:
+        u['avatar'] = cards.get(u['id'], {}).get('avatar')
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result)}
 
 
-def get_user_posts(params, user):
+def get_user_posts(conn, params, user):
     uid = params.get('user_id', '')
-    offset = int(params.get('offset', '0'))
-    conn = get_db()
+    try:
+        page_clause, offset = page_params(params, 'p.created_at', 'p.id')
+    except ValueError as e:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': str(e)})}
     cur = conn.cursor()
-    cur.execute("""SELECT p.id, p.content, p.image_url, p.views_count, p.created_at,
-        u.id, u.username, u.display_name, u.is_verified, u.is_artist,
-        (SELECT COUNT(*) FROM post_likes WHERE post_id = p.id),
-        (SELECT COUNT(*) FROM comments WHERE post_id = p.id AND is_hidden = FALSE),
-        (SELECT COUNT(*) FROM reposts WHERE post_id = p.id)
-        FROM posts p JOIN users u ON p.user_id = u.id
-        WHERE p.user_id = '%s' AND p.is_hidden = FALSE
-        ORDER BY p.created_at DESC LIMIT 20 OFFSET %d""" % (uid.replace("'", "''"), offset))
+    cur.execute("""SELECT %s
+        FROM posts p JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE p.user_id = '%s' AND p.is_hidden = FALSE%s
+        ORDER BY p.created_at DESC, p.id DESC LIMIT %d OFFSET %d""" % (POST_COLUMNS, uid.replace("'", "''"), page_clause, PAGE_SIZE, offset))
     posts = []
+    last_row = None
     for r in cur.fetchall():
-        post = {
-            'id': str(r[0]), 'content': r[1], 'image_url': r[2], 'views_count': r[3],
-            'created_at': r[4].isoformat() if r[4] else None,
-            'user': {'id': str(r[5]), 'username': r[6], 'display_name': r[7], 'is_verified': r[8], 'is_artist': r[9]},
-            'likes_count': r[10], 'comments_count': r[11], 'reposts_count': r[12],
-            'liked': False, 'reposted': False
-        }
-        if user:
-            cur.execute("SELECT id FROM post_likes WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post['id']))
-            post['liked'] = cur.fetchone() is not None
-            cur.execute("SELECT id FROM reposts WHERE user_id = '%s' AND post_id = '%s'" % (user['id'], post['id']))
-            post['reposted'] = cur.fetchone() is not None
-        cur.execute("SELECT url FROM user_avatars WHERE user_id = '%s' AND is_primary = TRUE LIMIT 1" % post['user']['id'])
-        av = cur.fetchone()
-        post['user']['avatar'] = av[0] if av else None
-        posts.append(post)
-    conn.close()
-    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(posts, default=str)}
+        last_row = (r[4], r[0])
+        posts.append(post_from_row(r))
+    hydrate_posts(cur, posts, user)
+    return paged_response(params, posts, last_row)
 
 
-def get_user_likes(params, user):
+def get_user_likes(conn, params, user):
     uid = params.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT show_likes FROM users WHERE id = '%s'" % uid.replace("'", "''"))
     row = cur.fetchone()
     if row and row[0] == 'none' and (not user or user['id'] != uid):
-        conn.close()
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
-    cur.execute("""SELECT p.id, p.content, p.image_url, p.views_count, p.created_at,
+    cur.execute("""SELECT p.id, p.content, p.image_url, COALESCE(s.views_count, p.views_count), p.created_at,
         u.id, u.username, u.display_name, u.is_verified, u.is_artist,
-        (SELECT COUNT(*) FROM post_likes WHERE post_id = p.id),
-        (SELECT COUNT(*) FROM comments WHERE post_id = p.id AND is_hidden = FALSE)
-        FROM post_likes pl JOIN posts p ON pl.post_id = p.id JOIN users u ON p.user_id = u.id
+        COALESCE(s.likes_count, 0), COALESCE(s.comments_count, 0)
+        FROM post_likes pl JOIN posts p ON pl.post_id = p.id JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
         WHERE pl.user_id = '%s' AND p.is_hidden = FALSE
         ORDER BY pl.created_at DESC LIMIT 20""" % uid.replace("'", "''"))
     posts = []
@@ -986,24 +2504,20 @@ def get_user_likes(params, user):
             'likes_count': r[10], 'comments_count': r[11]
         }
         posts.append(post)
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(posts, default=str)}
 
 
-def get_user_reposts(params, user):
+def get_user_reposts(conn, params, user):
     uid = params.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT show_reposts FROM users WHERE id = '%s'" % uid.replace("'", "''"))
     row = cur.fetchone()
     if row and row[0] == 'none' and (not user or user['id'] != uid):
-        conn.close()
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps([])}
-    cur.execute("""SELECT p.id, p.content, p.image_url, p.views_count, p.created_at,
+    cur.execute("""SELECT p.id, p.content, p.image_url, COALESCE(s.views_count, p.views_count), p.created_at,
         u.id, u.username, u.display_name, u.is_verified, u.is_artist,
-        (SELECT COUNT(*) FROM post_likes WHERE post_id = p.id),
-        (SELECT COUNT(*) FROM comments WHERE post_id = p.id AND is_hidden = FALSE)
-        FROM reposts rp JOIN posts p ON rp.post_id = p.id JOIN users u ON p.user_id = u.id
+        COALESCE(s.likes_count, 0), COALESCE(s.comments_count, 0)
+        FROM reposts rp JOIN posts p ON rp.post_id = p.id JOIN users u ON p.user_id = u.id LEFT JOIN post_stats s ON s.post_id = p.id
         WHERE rp.user_id = '%s' AND p.is_hidden = FALSE
         ORDER BY rp.created_at DESC LIMIT 20""" % uid.replace("'", "''"))
     posts = []
@@ -1015,145 +2529,266 @@ def get_user_reposts(params, user):
             'likes_count': r[10], 'comments_count': r[11]
         }
         posts.append(post)
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(posts, default=str)}
 
 
-def admin_get_reports():
-    conn = get_db()
+def admin_get_reports(conn):
     cur = conn.cursor()
     cur.execute("""SELECT r.id, r.target_type, r.target_id, r.reason, r.status, r.created_at,
         u.username, u.display_name FROM reports r JOIN users u ON r.reporter_id = u.id
         WHERE r.status = 'pending' ORDER BY r.created_at DESC""")
     reports = [{'id': str(r[0]), 'target_type': r[1], 'target_id': str(r[2]), 'reason': r[3], 'status': r[4], 'created_at': r[5].isoformat() if r[5] else None, 'reporter': r[6]} for r in cur.fetchall()]
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(reports, default=str)}
 
 
-def admin_get_verifications():
-    conn = get_db()
+def admin_get_verifications(conn):
     cur = conn.cursor()
     cur.execute("""SELECT v.id, v.type, v.status, v.created_at, u.id, u.username, u.display_name
         FROM verification_requests v JOIN users u ON v.user_id = u.id
         WHERE v.status = 'pending' ORDER BY v.created_at DESC""")
     result = [{'id': str(r[0]), 'type': r[1], 'status': r[2], 'created_at': r[3].isoformat() if r[3] else None, 'user_id': str(r[4]), 'username': r[5], 'display_name': r[6]} for r in cur.fetchall()]
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result, default=str)}
 
 
-def admin_get_appeals():
-    conn = get_db()
+def admin_get_appeals(conn):
     cur = conn.cursor()
     cur.execute("""SELECT a.id, a.reason, a.status, a.created_at, u.id, u.username, u.display_name
         FROM appeal_requests a JOIN users u ON a.user_id = u.id
         WHERE a.status = 'pending' ORDER BY a.created_at DESC""")
     result = [{'id': str(r[0]), 'reason': r[1], 'status': r[2], 'created_at': r[3].isoformat() if r[3] else None, 'user_id': str(r[4]), 'username': r[5], 'display_name': r[6]} for r in cur.fetchall()]
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(result, default=str)}
 
 
-def admin_verify(body):
+def admin_verify(conn, body):
     req_id = body.get('request_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT user_id, type FROM verification_requests WHERE id = '%s'" % req_id.replace("'", "''"))
     row = cur.fetchone()
     if not row:
-        conn.close()
         return {'statusCode': 404, 'headers': cors_headers(), 'body': json.dumps({'error': 'Not found'})}
     uid = str(row[0])
     vtype = row[1]
     cur.execute("UPDATE verification_requests SET status = 'approved' WHERE id = '%s'" % req_id.replace("'", "''"))
     if vtype == 'artist':
-        cur.execute("UPDATE users SET is_verified = TRUE, is_artist = TRUE WHERE id = '%s'" % uid)
+        cur.execute("UPDATE users SET is_verified = TRUE, is_artist = TRUE, profile_version = profile_version + 1 WHERE id = '%s'" % uid)
     else:
-        cur.execute("UPDATE users SET is_verified = TRUE WHERE id = '%s'" % uid)
-    cur.execute("INSERT INTO notifications (user_id, type, content) VALUES ('%s', 'verification', 'Your verification request was approved!')" % uid)
+        cur.execute("UPDATE users SET is_verified = TRUE, profile_version = profile_version + 1 WHERE id = '%s'" % uid)
+    enqueue(cur, 'notify', user_id=uid, type='verification', content='Your verification request was approved!')
     conn.commit()
-    conn.close()
+    invalidate_user_card(uid)
+    invalidate_responses('user:' + uid, 'posts:' + uid)
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_reject_verify(body):
+def admin_reject_verify(conn, body):
     req_id = body.get('request_id', '')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT user_id FROM verification_requests WHERE id = '%s'" % req_id.replace("'", "''"))
     row = cur.fetchone()
     if row:
         cur.execute("UPDATE verification_requests SET status = 'rejected' WHERE id = '%s'" % req_id.replace("'", "''"))
-        cur.execute("INSERT INTO notifications (user_id, type, content) VALUES ('%s', 'verification', 'Your verification request was rejected')" % str(row[0]))
+        enqueue(cur, 'notify', user_id=str(row[0]), type='verification', content='Your verification request was rejected')
         conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_block_user(body):
+def admin_block_user(conn, body):
     uid = body.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE users SET is_blocked = TRUE, block_count = block_count + 1 WHERE id = '%s'" % uid.replace("'", "''"))
+    cur.execute("UPDATE users SET is_blocked = TRUE, search_updated_at = NOW(), session_generation = session_generation + 1, block_count = block_count + 1, profile_version = profile_version + 1 WHERE id = '%s' RETURNING id" % uid.replace("'", "''"))
+    row = cur.fetchone()
+    bump_auth_epoch(cur)
     conn.commit()
-    conn.close()
+    invalidate_sessions()
+    if row:
+        invalidate_responses('user:' + str(row[0]), 'posts:' + str(row[0]))
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_unblock_user(body):
+def admin_unblock_user(conn, body):
     uid = body.get('user_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE users SET is_blocked = FALSE WHERE id = '%s'" % uid.replace("'", "''"))
+    cur.execute("UPDATE users SET is_blocked = FALSE, search_updated_at = NOW(), profile_version = profile_version + 1 WHERE id = '%s' RETURNING id" % uid.replace("'", "''"))
+    row = cur.fetchone()
+    bump_auth_epoch(cur)
     conn.commit()
-    conn.close()
+    invalidate_sessions()
+    if row:
+        invalidate_responses('user:' + str(row[0]), 'posts:' + str(row[0]))
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_hide_post(body):
+def admin_hide_post(conn, body):
     post_id = body.get('post_id', '')
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE posts SET is_hidden = TRUE WHERE id = '%s'" % post_id.replace("'", "''"))
+    cur.execute("UPDATE posts SET is_hidden = TRUE WHERE id = '%s' AND is_hidden = FALSE RETURNING user_id, id" % post_id.replace("'", "''"))
+    hidden = cur.fetchone()
+    if hidden:
+        enqueue(cur, 'unpost', user_id=str(hidden[0]))
     conn.commit()
-    conn.close()
+    if hidden:
+        invalidate_responses('post:' + str(hidden[1]), 'posts:' + str(hidden[0]))
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_resolve_report(body):
+def admin_resolve_report(conn, body):
     report_id = body.get('report_id', '')
     action = body.get('resolve_action', 'dismiss')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("UPDATE reports SET status = '%s' WHERE id = '%s'" % (action.replace("'", "''"), report_id.replace("'", "''")))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_resolve_appeal(body):
+def admin_resolve_appeal(conn, body):
     appeal_id = body.get('appeal_id', '')
     action = body.get('resolve_action', 'reject')
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT user_id FROM appeal_requests WHERE id = '%s'" % appeal_id.replace("'", "''"))
     row = cur.fetchone()
     if row and action == 'approve':
-        cur.execute("UPDATE users SET is_blocked = FALSE WHERE id = '%s'" % str(row[0]))
+        cur.execute("UPDATE users SET is_blocked = FALSE, search_updated_at = NOW(), profile_version = profile_version + 1 WHERE id = '%s'" % str(row[0]))
+        bump_auth_epoch(cur)
     cur.execute("UPDATE appeal_requests SET status = '%s' WHERE id = '%s'" % (action.replace("'", "''"), appeal_id.replace("'", "''")))
     conn.commit()
-    conn.close()
+    invalidate_sessions()
+    if row and action == 'approve':
+        invalidate_responses('user:' + str(row[0]), 'posts:' + str(row[0]))
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
 
 
-def admin_add_release(body):
-    artist_id = body.get('artist_id', '')
+def admin_add_release(conn, body):
+    try:
+        artist_id = str(uuid.UUID(str(body.get('artist_id', ''))))
+    except ValueError:
+        return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid artist id'})}
     title = body.get('title', '')
     artist_name = body.get('artist_name', '')
     cover_url = body.get('cover_url', '')
     audio_url = body.get('audio_url', '')
-    conn = get_db()
     cur = conn.cursor()
     rid = str(uuid.uuid4())
-    cur.execute("INSERT INTO releases (id, artist_id, title, artist_name, cover_url, audio_url) VALUES ('%s', '%s', '%s', '%s', '%s', '%s')" % (rid, artist_id.replace("'", "''"), title.replace("'", "''"), artist_name.replace("'", "''"), cover_url.replace("'", "''"), audio_url.replace("'", "''")))
+    cur.execute("INSERT INTO releases (id, artist_id, title, artist_name, cover_url, audio_url) VALUES ('%s', '%s', '%s', '%s', '%s', '%s')" % (rid, artist_id, title.replace("'", "''"), artist_name.replace("'", "''"), cover_url.replace("'", "''"), audio_url.replace("'", "''")))
+    bump_profile_version(cur, artist_id)
     conn.commit()
-    conn.close()
+    invalidate_responses('user:' + artist_id)
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'id': rid})}
+
+
+def admin_reconcile_counters(conn, body):
+    fix = body.get('fix', True)
+    cur = conn.cursor()
+    cur.execute("""CREATE TEMP TABLE post_stats_drift ON COMMIT DROP AS
+        SELECT p.id AS post_id,
+            COALESCE(l.n, 0) AS likes_count, COALESCE(c.n, 0) AS comments_count, COALESCE(r.n, 0) AS reposts_count,
+            s.likes_count AS old_likes, s.comments_count AS old_comments, s.reposts_count AS old_reposts
+        FROM posts p
+        LEFT JOIN (SELECT post_id, COUNT(*) AS n FROM post_likes WHERE user_id <> '%s' GROUP BY post_id) l ON l.post_id = p.id
+        LEFT JOIN (SELECT post_id, COUNT(*) AS n FROM comments WHERE is_hidden = FALSE GROUP BY post_id) c ON c.post_id = p.id
+        LEFT JOIN (SELECT post_id, COUNT(*) AS n FROM reposts WHERE user_id <> '%s' GROUP BY post_id) r ON r.post_id = p.id
+        LEFT JOIN post_stats s ON s.post_id = p.id
+        WHERE s.post_id IS NULL OR s.likes_count <> COALESCE(l.n, 0)
+            OR s.comments_count <> COALESCE(c.n, 0) OR s.reposts_count <> COALESCE(r.n, 0)""" % (TOMBSTONE_ID, TOMBSTONE_ID))
+    cur.execute("SELECT COUNT(*) FROM post_stats_drift")
+    drifted = cur.fetchone()[0]
+    cur.execute("""SELECT post_id, likes_count, comments_count, reposts_count, old_likes, old_comments, old_reposts
+        FROM post_stats_drift ORDER BY post_id LIMIT 100""")
+    sample = [{
+        'post_id': str(r[0]),
+        'likes_count': [r[4], r[1]], 'comments_count': [r[5], r[2]], 'reposts_count': [r[6], r[3]]
+    } for r in cur.fetchall()]
+    if fix:
+        cur.execute("""INSERT INTO post_stats (post_id, likes_count, comments_count, reposts_count)
+            SELECT post_id, likes_count, comments_count, reposts_count FROM post_stats_drift
+            ON CONFLICT (post_id) DO UPDATE SET likes_count = EXCLUDED.likes_count,
+                comments_count = EXCLUDED.comments_count, reposts_count = EXCLUDED.reposts_count""")
+    conn.commit()
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'drifted': drifted, 'fixed': bool(fix), 'sample': sample})}
+
+
+def admin_cache_stats():
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'sessions': lru_stats(_session_cache), 'user_cards': lru_stats(_user_card_cache), 'badges': lru_stats(_badge_cache), 'responses': _response_cache['stats'](), 'auth_epoch': _auth_epoch['version']})}
+
+
+def admin_prune_sessions(conn):
+    cur = conn.cursor()
+    age_clause = " OR created_at < NOW() - INTERVAL '%d days'" % SESSION_MAX_AGE_DAYS if SESSION_MAX_AGE_DAYS > 0 else ''
+    sessions_pruned = 0
+    while True:
+        cur.execute("""DELETE FROM sessions WHERE id IN (
+            SELECT id FROM sessions WHERE LEFT(token, 8) = 'expired_'%s LIMIT %d)""" % (age_clause, PRUNE_BATCH_SIZE))
+        deleted = cur.rowcount
+        conn.commit()
+        sessions_pruned += deleted
+        if deleted < PRUNE_BATCH_SIZE:
+            break
+    cur.execute("DELETE FROM revoked_tokens WHERE expires_at < NOW()")
+    revoked_pruned = cur.rowcount
+    conn.commit()
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'sessions': sessions_pruned, 'revoked_tokens': revoked_pruned})}
+
+
+def admin_compact_tombstones(conn):
+    cur = conn.cursor()
+    reclaimed = {}
+    for table, condition in (
+            ('post_likes', "user_id = '%s'" % TOMBSTONE_ID),
+            ('comment_likes', "user_id = '%s'" % TOMBSTONE_ID),
+            ('reposts', "user_id = '%s'" % TOMBSTONE_ID),
+            ('blocks', "blocker_id = '%s'" % TOMBSTONE_ID),
+            ('follows', "status = 'removed'")):
+        reclaimed[table] = 0
+        while True:
+            cur.execute("DELETE FROM %s WHERE id IN (SELECT id FROM %s WHERE %s LIMIT %d)" % (table, table, condition, PRUNE_BATCH_SIZE))
+            deleted = cur.rowcount
+            conn.commit()
+            reclaimed[table] += deleted
+            if deleted < PRUNE_BATCH_SIZE:
+                break
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'reclaimed': reclaimed})}
+
+
+def admin_refresh_rank_window(conn):
+    cur = conn.cursor()
+    first_bucket = int(time.time() // 86400) - RANK_WINDOW_DAYS + 1
+    cur.execute("DELETE FROM post_scores WHERE bucket < %d" % first_bucket)
+    expired = cur.rowcount
+    cur.execute("""DELETE FROM post_scores WHERE post_id IN (
+        SELECT post_id FROM (
+            SELECT post_id, ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY score DESC) AS rn FROM post_scores
+        ) ranked WHERE rn > %d)""" % RANK_WINDOW_SIZE)
+    trimmed = cur.rowcount
+    conn.commit()
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'expired': expired, 'trimmed': trimmed})}
+
+
+def admin_rebuild_conversations(conn, body):
+    user_id = body.get('user_id')
+    cur = conn.cursor()
+    rebuilt = rebuild_conversations(cur, user_id.replace("'", "''") if user_id else None)
+    conn.commit()
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'rebuilt': rebuilt})}
+
+
+def admin_process_outbox(conn):
+    processed = 0
+    while True:
+        batch = process_outbox(conn)
+        processed += batch
+        if batch < OUTBOX_BATCH_SIZE:
+            break
+    return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'processed': processed})}
+
+
+if __name__ == '__main__':
+    worker_conn = get_db()
+    try:
+        while True:
+            if _story_partitions['day'] != int(time.time() // 86400):
+                maintain_story_partitions(worker_conn)
+            if process_outbox(worker_conn) < OUTBOX_BATCH_SIZE:
+                if '--once' in sys.argv:
+                    break
+                time.sleep(OUTBOX_POLL_SECONDS)
+    finally:
+        release_db(worker_conn)
@@ -1,21 +1,128 @@
+import base64
 import json
 import hashlib
+import hmac
 import os
 import psycopg2
+import psycopg2.extensions
+import threading
+import time
 import uuid
 
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_POOL_MAX_LIFETIME = int(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = int(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+
+_pool = []
+_pool_born = {}
+_pool_lock = threading.Lock()
+
+SESSION_SIGNING_KEY = os.environ.get('SESSION_SIGNING_KEY', '')
+SIGNED_TOKEN_TTL = int(os.environ.get('SIGNED_TOKEN_TTL', str(30 * 86400)))
+SESSION_MAX_AGE_DAYS = int(os.environ.get('SESSION_MAX_AGE_DAYS', '0'))
+
+def close_quietly(conn):
+    _pool_born.pop(id(conn), None)
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
 def get_db():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    while True:
+        with _pool_lock:
+            entry = _pool.pop() if _pool else None
+        if entry is None:
+            break
+        conn, last_used = entry
+        now = time.time()
+        if conn.closed or now - _pool_born.get(id(conn), 0) > DB_POOL_MAX_LIFETIME:
+            close_quietly(conn)
+            continue
+        if now - last_used > DB_POOL_CHECK_AFTER:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                close_quietly(conn)
+                continue
+        return conn
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    _pool_born[id(conn)] = time.time()
+    return conn
+
+def release_db(conn):
+    if conn.closed:
+        _pool_born.pop(id(conn), None)
+        return
+    try:
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        close_quietly(conn)
+        return
+    with _pool_lock:
+        if len(_pool) < DB_POOL_SIZE and time.time() - _pool_born.get(id(conn), 0) <= DB_POOL_MAX_LIFETIME:
+            _pool.append((conn, time.time()))
+            return
+    close_quietly(conn)
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-def get_user_by_token(token):
-    conn = get_db()
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def token_signature(payload):
+    return b64encode(hmac.new(SESSION_SIGNING_KEY.encode(), ('s1.' + payload).encode(), hashlib.sha256).digest())
+
+def sign_token(user_id, generation):
+    payload = b64encode(('%s.%d.%d' % (user_id, int(time.time()), generation)).encode())
+    return 's1.%s.%s' % (payload, token_signature(payload))
+
+def verify_signed_token(token):
+    if not SESSION_SIGNING_KEY or not token.startswith('s1.'):
+        return None
+    parts = token.split('.')
+    if len(parts) != 3 or not hmac.compare_digest(token_signature(parts[1]).encode(), parts[2].encode()):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)).decode()
+        user_id, issued_at, generation = raw.split('.')
+        claims = {'user_id': str(uuid.UUID(user_id)), 'iat': int(issued_at), 'generation': int(generation)}
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if claims['iat'] + SIGNED_TOKEN_TTL < time.time():
+        return None
+    return claims
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def session_age_clause():
+    if SESSION_MAX_AGE_DAYS <= 0:
+        return ''
+    return " AND s.created_at > NOW() - INTERVAL '%d days'" % SESSION_MAX_AGE_DAYS
+
+def issue_token(cur, user_id, generation):
+    if SESSION_SIGNING_KEY:
+        return sign_token(user_id, generation)
+    token = str(uuid.uuid4())
+    cur.execute("INSERT INTO sessions (user_id, token) VALUES ('%s', '%s')" % (user_id, token))
+    return token
+
+def get_user_by_token(conn, token):
     cur = conn.cursor()
-    cur.execute("SELECT u.id, u.username, u.email, u.display_name, u.bio, u.is_private, u.is_verified, u.is_artist, u.is_admin, u.is_blocked, u.block_count, u.telegram, u.instagram, u.website, u.tiktok, u.youtube, u.show_likes, u.show_reposts, u.show_followers, u.show_following, u.show_friends, u.allow_messages, u.theme FROM sessions s JOIN users u ON s.user_id = u.id WHERE s.token = '%s'" % token.replace("'", "''"))
+    columns = "u.id, u.username, u.email, u.display_name, u.bio, u.is_private, u.is_verified, u.is_artist, u.is_admin, u.is_blocked, u.block_count, u.telegram, u.instagram, u.website, u.tiktok, u.youtube, u.show_likes, u.show_reposts, u.show_followers, u.show_following, u.show_friends, u.allow_messages, u.theme"
+    if token.startswith('s1.'):
+        claims = verify_signed_token(token)
+        if not claims:
+            return None
+        cur.execute("SELECT %s FROM users u WHERE u.id = '%s' AND u.session_generation = %d AND NOT EXISTS (SELECT 1 FROM revoked_tokens WHERE token_hash = '%s')" % (columns, claims['user_id'], claims['generation'], token_hash(token)))
+    else:
+        cur.execute("SELECT %s FROM sessions s JOIN users u ON s.user_id = u.id WHERE s.token = '%s'%s" % (columns, token.replace("'", "''"), session_age_clause()))
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
     return {
@@ -41,6 +148,13 @@ def handler(event, context):
     if event.get('httpMethod') == 'OPTIONS':
         return {'statusCode': 200, 'headers': cors_headers(), 'body': ''}
 
+    conn = get_db()
+    try:
+        return dispatch(conn, event)
+    finally:
+        release_db(conn)
+
+def dispatch(conn, event):
     method = event.get('httpMethod', 'GET')
     path = event.get('queryStringParameters', {}) or {}
     action = path.get('action', '')
@@ -50,31 +164,29 @@ def handler(event, context):
         action = body.get('action', action)
 
         if action == 'register':
-            return register(body)
+            return register(conn, body)
         elif action == 'login':
-            return login(body)
+            return login(conn, body)
         elif action == 'logout':
             token = (event.get('headers', {}) or {}).get('X-Auth-Token', '')
-            return logout(token)
+            return logout(conn, token)
 
     if method == 'GET' and action == 'me':
         token = (event.get('headers', {}) or {}).get('X-Auth-Token', '')
         if not token:
             return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Not authenticated'})}
-        user = get_user_by_token(token)
+        user = get_user_by_token(conn, token)
         if not user:
             return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid token'})}
-        conn = get_db()
         cur = conn.cursor()
         cur.execute("SELECT id, url, is_primary FROM user_avatars WHERE user_id = '%s' ORDER BY is_primary DESC, created_at DESC" % user['id'])
         avatars = [{'id': str(r[0]), 'url': r[1], 'is_primary': r[2]} for r in cur.fetchall()]
-        conn.close()
         user['avatars'] = avatars
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps(user)}
 
     return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Unknown action'})}
 
-def register(body):
+def register(conn, body):
     username = body.get('username', '').strip().lower()
     email = body.get('email', '').strip().lower()
     password = body.get('password', '')
@@ -86,38 +198,32 @@ def register(body):
     if len(password) < 4:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Password too short'})}
 
-    conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT id FROM users WHERE username = '%s' OR email = '%s'" % (username.replace("'", "''"), email.replace("'", "''")))
     if cur.fetchone():
-        conn.close()
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Username or email already taken'})}
 
     user_id = str(uuid.uuid4())
-    token = str(uuid.uuid4())
     pw_hash = hash_password(password)
 
     cur.execute("INSERT INTO users (id, username, email, password_hash, display_name) VALUES ('%s', '%s', '%s', '%s', '%s')" % (user_id, username.replace("'", "''"), email.replace("'", "''"), pw_hash, username.replace("'", "''")))
-    cur.execute("INSERT INTO sessions (user_id, token) VALUES ('%s', '%s')" % (user_id, token))
+    token = issue_token(cur, user_id, 0)
     conn.commit()
-    conn.close()
 
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'token': token, 'user': {'id': user_id, 'username': username, 'email': email, 'display_name': username}})}
 
-def login(body):
+def login(conn, body):
     email = body.get('email', '').strip().lower()
     password = body.get('password', '')
 
     if not email or not password:
         return {'statusCode': 400, 'headers': cors_headers(), 'body': json.dumps({'error': 'Email and password required'})}
 
-    conn = get_db()
     cur = conn.cursor()
     pw_hash = hash_password(password)
-    cur.execute("SELECT id, username, email, display_name, is_blocked, is_admin, block_count FROM users WHERE email = '%s' AND password_hash = '%s'" % (email.replace("'", "''"), pw_hash))
+    cur.execute("SELECT id, username, email, display_name, is_blocked, is_admin, block_count, session_generation FROM users WHERE email = '%s' AND password_hash = '%s'" % (email.replace("'", "''"), pw_hash))
     row = cur.fetchone()
     if not row:
-        conn.close()
         return {'statusCode': 401, 'headers': cors_headers(), 'body': json.dumps({'error': 'Invalid credentials'})}
 
     user_id = str(row[0])
@@ -125,22 +231,23 @@ def login(body):
     block_count = row[6]
 
     if is_blocked:
-        conn.close()
         return {'statusCode': 403, 'headers': cors_headers(), 'body': json.dumps({'error': 'blocked', 'block_count': block_count})}
 
-    token = str(uuid.uuid4())
-    cur.execute("INSERT INTO sessions (user_id, token) VALUES ('%s', '%s')" % (user_id, token))
+    token = issue_token(cur, user_id, row[7])
     conn.commit()
-    conn.close()
 
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'token': token, 'user': {'id': user_id, 'username': row[1], 'email': row[2], 'display_name': row[3], 'is_admin': row[5]}})}
 
-def logout(token):
+def logout(conn, token):
     if not token:
         return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
-    conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE sessions SET token = 'expired_' || token WHERE token = '%s'" % token.replace("'", "''"))
+    claims = verify_signed_token(token)
+    if claims:
+        cur.execute("INSERT INTO revoked_tokens (token_hash, expires_at) VALUES ('%s', TO_TIMESTAMP(%d)) ON CONFLICT (token_hash) DO NOTHING" % (token_hash(token), claims['iat'] + SIGNED_TOKEN_TTL))
+    else:
+        cur.execute("DELETE FROM sessions WHERE token = '%s'" % token.replace("'", "''"))
+        if cur.rowcount:
+            cur.execute("INSERT INTO revoked_tokens (token_hash, expires_at) VALUES ('%s', NOW() + INTERVAL '1 day') ON CONFLICT (token_hash) DO NOTHING" % token_hash(token))
     conn.commit()
-    conn.close()
     return {'statusCode': 200, 'headers': cors_headers(), 'body': json.dumps({'ok': True})}
@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS post_stats (
+    post_id UUID PRIMARY KEY REFERENCES posts(id),
+    likes_count INTEGER NOT NULL DEFAULT 0,
+    comments_count INTEGER NOT NULL DEFAULT 0,
+    reposts_count INTEGER NOT NULL DEFAULT 0,
+    views_count INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO post_stats (post_id, likes_count, comments_count, reposts_count, views_count)
+SELECT p.id,
+    (SELECT COUNT(*) FROM post_likes WHERE post_id = p.id AND user_id <> '00000000-0000-0000-0000-000000000000'),
+    (SELECT COUNT(*) FROM comments WHERE post_id = p.id AND is_hidden = FALSE),
+    (SELECT COUNT(*) FROM reposts WHERE post_id = p.id AND user_id <> '00000000-0000-0000-0000-000000000000'),
+    COALESCE(p.views_count, 0)
+FROM posts p
+ON CONFLICT (post_id) DO NOTHING;
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS auth_epoch (
+    id INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO auth_epoch (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
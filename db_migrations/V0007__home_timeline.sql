@@ -0,0 +1,29 @@
+CREATE TABLE IF NOT EXISTS timeline_entries (
+    user_id UUID NOT NULL,
+    post_id UUID NOT NULL,
+    author_id UUID NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, post_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_timeline_user_created ON timeline_entries (user_id, created_at DESC, post_id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_timeline_user_author ON timeline_entries (user_id, author_id);
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_follows_following_status ON follows (following_id, status);
+
+CREATE INDEX IF NOT EXISTS idx_follows_follower_status ON follows (follower_id, status);
+
+INSERT INTO timeline_entries (user_id, post_id, author_id, created_at)
+SELECT f.follower_id, p.id, p.user_id, p.created_at
+FROM posts p JOIN follows f ON f.following_id = p.user_id AND f.status = 'accepted'
+WHERE p.is_hidden = FALSE AND p.created_at > NOW() - INTERVAL '30 days'
+ON CONFLICT DO NOTHING;
+
+INSERT INTO timeline_entries (user_id, post_id, author_id, created_at)
+SELECT p.user_id, p.id, p.user_id, p.created_at
+FROM posts p
+WHERE p.is_hidden = FALSE AND p.created_at > NOW() - INTERVAL '30 days'
+ON CONFLICT DO NOTHING;
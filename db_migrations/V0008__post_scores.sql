@@ -0,0 +1,18 @@
+CREATE TABLE IF NOT EXISTS post_scores (
+    post_id UUID PRIMARY KEY REFERENCES posts(id),
+    bucket INTEGER NOT NULL,
+    score DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_post_scores_rank ON post_scores (score DESC, post_id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_post_scores_bucket ON post_scores (bucket, score DESC);
+
+INSERT INTO post_scores (post_id, bucket, score)
+SELECT p.id,
+    FLOOR(EXTRACT(EPOCH FROM p.created_at) / 86400)::INTEGER,
+    LN(1 + COALESCE(s.likes_count, 0) + 3 * COALESCE(s.comments_count, 0) + 4 * COALESCE(s.reposts_count, 0) + 0.05 * COALESCE(s.views_count, 0))
+        + (EXTRACT(EPOCH FROM p.created_at) - 1700000000) / (12 * 3600 / LN(2))
+FROM posts p LEFT JOIN post_stats s ON s.post_id = p.id
+WHERE p.is_hidden = FALSE AND p.created_at > NOW() - INTERVAL '3 days'
+ON CONFLICT (post_id) DO NOTHING;
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_user_avatars_primary ON user_avatars (user_id, created_at DESC) WHERE is_primary = TRUE;
@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS post_view_sketches (
+    post_id UUID PRIMARY KEY REFERENCES posts(id),
+    registers BYTEA NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_post_views_post ON post_views (post_id, created_at);
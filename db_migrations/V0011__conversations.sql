@@ -0,0 +1,29 @@
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id UUID NOT NULL,
+    partner_id UUID NOT NULL,
+    last_message_id UUID,
+    last_message TEXT,
+    last_sender_id UUID,
+    last_time TIMESTAMP NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, partner_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_user_time ON conversations (user_id, last_time DESC, partner_id DESC);
+
+WITH sides AS (
+    SELECT sender_id AS user_id, receiver_id AS partner_id, id, content, sender_id, created_at, FALSE AS unread
+    FROM messages WHERE hidden_by_sender = FALSE
+    UNION ALL
+    SELECT receiver_id, sender_id, id, content, sender_id, created_at, NOT is_read
+    FROM messages WHERE hidden_by_receiver = FALSE
+), latest AS (
+    SELECT DISTINCT ON (user_id, partner_id) user_id, partner_id, id, content, sender_id, created_at
+    FROM sides ORDER BY user_id, partner_id, created_at DESC
+), unread AS (
+    SELECT user_id, partner_id, COUNT(*) FILTER (WHERE unread) AS n FROM sides GROUP BY user_id, partner_id
+)
+INSERT INTO conversations (user_id, partner_id, last_message_id, last_message, last_sender_id, last_time, unread_count)
+SELECT l.user_id, l.partner_id, l.id, LEFT(l.content, 200), l.sender_id, l.created_at, u.n
+FROM latest l JOIN unread u ON u.user_id = l.user_id AND u.partner_id = l.partner_id
+ON CONFLICT (user_id, partner_id) DO NOTHING;
@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS idx_messages_pair_created ON messages (LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_messages_pair_pinned ON messages (LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), created_at DESC) WHERE is_pinned = TRUE;
@@ -0,0 +1,23 @@
+CREATE SEQUENCE IF NOT EXISTS sync_seq;
+
+CREATE TABLE IF NOT EXISTS user_sync (
+    user_id UUID PRIMARY KEY,
+    last_seq BIGINT NOT NULL DEFAULT 0
+);
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq BIGINT;
+ALTER TABLE messages ALTER COLUMN seq SET DEFAULT nextval('sync_seq');
+
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS seq BIGINT;
+ALTER TABLE notifications ALTER COLUMN seq SET DEFAULT nextval('sync_seq');
+
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS seq BIGINT;
+ALTER TABLE conversations ALTER COLUMN seq SET DEFAULT nextval('sync_seq');
+
+CREATE INDEX IF NOT EXISTS idx_messages_sender_seq ON messages (sender_id, seq);
+
+CREATE INDEX IF NOT EXISTS idx_messages_receiver_seq ON messages (receiver_id, seq);
+
+CREATE INDEX IF NOT EXISTS idx_notifications_user_seq ON notifications (user_id, seq);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_user_seq ON conversations (user_id, seq);
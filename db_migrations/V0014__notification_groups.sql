@@ -0,0 +1,10 @@
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS group_key VARCHAR(128);
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS actor_count INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS recent_actor_ids UUID[];
+ALTER TABLE notifications ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+
+UPDATE notifications SET recent_actor_ids = ARRAY[from_user_id] WHERE from_user_id IS NOT NULL AND recent_actor_ids IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_user_group ON notifications (user_id, group_key) WHERE group_key IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_notifications_user_updated ON notifications (user_id, (COALESCE(updated_at, created_at)) DESC);
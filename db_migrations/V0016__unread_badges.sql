@@ -0,0 +1,10 @@
+ALTER TABLE user_sync ADD COLUMN IF NOT EXISTS unread_notifications INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE user_sync ADD COLUMN IF NOT EXISTS unread_messages INTEGER NOT NULL DEFAULT 0;
+
+INSERT INTO user_sync (user_id, unread_notifications, unread_messages)
+SELECT u.id, COALESCE(n.c, 0), COALESCE(m.c, 0)
+FROM users u
+LEFT JOIN (SELECT user_id, COUNT(*) AS c FROM notifications WHERE is_read = FALSE GROUP BY user_id) n ON n.user_id = u.id
+LEFT JOIN (SELECT user_id, SUM(unread_count) AS c FROM conversations GROUP BY user_id) m ON m.user_id = u.id
+WHERE n.c IS NOT NULL OR m.c IS NOT NULL
+ON CONFLICT (user_id) DO UPDATE SET unread_notifications = EXCLUDED.unread_notifications, unread_messages = EXCLUDED.unread_messages;
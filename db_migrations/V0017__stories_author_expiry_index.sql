@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_stories_user_expires ON stories (user_id, expires_at);
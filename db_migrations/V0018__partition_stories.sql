@@ -0,0 +1,48 @@
+ALTER TABLE stories RENAME TO stories_legacy;
+ALTER TABLE story_views RENAME TO story_views_legacy;
+ALTER INDEX IF EXISTS idx_stories_user_expires RENAME TO idx_stories_legacy_user_expires;
+
+CREATE TABLE stories (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    user_id UUID REFERENCES users(id),
+    image_url TEXT NOT NULL,
+    visibility VARCHAR(20) DEFAULT 'all',
+    created_at TIMESTAMP DEFAULT NOW(),
+    expires_at TIMESTAMP NOT NULL DEFAULT NOW() + INTERVAL '24 hours',
+    PRIMARY KEY (id, expires_at)
+) PARTITION BY RANGE (expires_at);
+
+CREATE TABLE story_views (
+    story_id UUID NOT NULL,
+    user_id UUID NOT NULL REFERENCES users(id),
+    story_expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (story_id, user_id, story_expires_at)
+) PARTITION BY RANGE (story_expires_at);
+
+CREATE INDEX IF NOT EXISTS idx_stories_user_expires ON stories (user_id, expires_at);
+
+DO $$
+DECLARE
+    d DATE;
+BEGIN
+    FOR d IN SELECT generate_series(
+        CURRENT_DATE,
+        GREATEST(CURRENT_DATE + 3, (SELECT MAX(expires_at)::date FROM stories_legacy)),
+        INTERVAL '1 day')::date
+    LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF stories FOR VALUES FROM (%L) TO (%L)',
+            'stories_p' || to_char(d, 'YYYYMMDD'), d, d + 1);
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF story_views FOR VALUES FROM (%L) TO (%L)',
+            'story_views_p' || to_char(d, 'YYYYMMDD'), d, d + 1);
+    END LOOP;
+END $$;
+
+INSERT INTO stories (id, user_id, image_url, visibility, created_at, expires_at)
+SELECT id, user_id, image_url, visibility, created_at, expires_at FROM stories_legacy WHERE expires_at > NOW();
+
+INSERT INTO story_views (story_id, user_id, story_expires_at, created_at)
+SELECT v.story_id, v.user_id, s.expires_at, v.created_at
+FROM story_views_legacy v JOIN stories_legacy s ON s.id = v.story_id
+WHERE s.expires_at > NOW() AND v.user_id IS NOT NULL
+ON CONFLICT DO NOTHING;
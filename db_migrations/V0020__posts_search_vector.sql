@@ -0,0 +1,3 @@
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE posts SET search_vector = to_tsvector('russian', COALESCE(content, '')) WHERE search_vector IS NULL;
@@ -0,0 +1 @@
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_posts_search_vector ON posts USING gin (search_vector);
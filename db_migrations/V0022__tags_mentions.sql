@@ -0,0 +1,26 @@
+CREATE TABLE IF NOT EXISTS post_tags (
+    tag VARCHAR(64) NOT NULL,
+    post_id UUID NOT NULL REFERENCES posts(id),
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (tag, post_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_post_tags_tag_created ON post_tags (tag, created_at DESC, post_id DESC);
+
+CREATE TABLE IF NOT EXISTS mentions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID NOT NULL REFERENCES users(id),
+    author_id UUID NOT NULL,
+    post_id UUID NOT NULL,
+    comment_id UUID,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_mentions_user_created ON mentions (user_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS tag_trends (
+    bucket INTEGER NOT NULL,
+    tag VARCHAR(64) NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, tag)
+);
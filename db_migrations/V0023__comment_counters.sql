@@ -0,0 +1,14 @@
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS reply_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE comments c SET likes_count = l.n
+FROM (SELECT comment_id, COUNT(*) AS n FROM comment_likes WHERE user_id <> '00000000-0000-0000-0000-000000000000' GROUP BY comment_id) l
+WHERE l.comment_id = c.id;
+
+UPDATE comments c SET reply_count = r.n
+FROM (SELECT parent_id, COUNT(*) AS n FROM comments WHERE parent_id IS NOT NULL AND is_hidden = FALSE GROUP BY parent_id) r
+WHERE r.parent_id = c.id;
+
+CREATE INDEX IF NOT EXISTS idx_comments_post_roots ON comments (post_id, created_at DESC, id DESC) WHERE parent_id IS NULL AND is_hidden = FALSE;
+CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments (post_id, created_at) WHERE is_hidden = FALSE;
+CREATE INDEX IF NOT EXISTS idx_comments_parent_created ON comments (parent_id, created_at, id) WHERE is_hidden = FALSE;
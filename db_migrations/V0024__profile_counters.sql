@@ -0,0 +1,9 @@
+ALTER TABLE users ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS posts_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_version BIGINT NOT NULL DEFAULT 1;
+
+UPDATE users u SET
+    followers_count = (SELECT COUNT(*) FROM follows WHERE following_id = u.id AND status = 'accepted'),
+    following_count = (SELECT COUNT(*) FROM follows WHERE follower_id = u.id AND status = 'accepted'),
+    posts_count = (SELECT COUNT(*) FROM posts WHERE user_id = u.id AND is_hidden = FALSE);
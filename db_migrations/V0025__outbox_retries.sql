@@ -0,0 +1,15 @@
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS last_error TEXT;
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS retry_at TIMESTAMP DEFAULT NOW();
+
+CREATE INDEX IF NOT EXISTS idx_outbox_retry ON outbox (retry_at) WHERE attempts > 0;
+
+CREATE TABLE IF NOT EXISTS outbox_dead (
+    id BIGINT PRIMARY KEY,
+    kind VARCHAR(32) NOT NULL,
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP,
+    failed_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS comment_tags (
+    tag VARCHAR(64) NOT NULL,
+    comment_id UUID NOT NULL REFERENCES comments(id),
+    post_id UUID NOT NULL REFERENCES posts(id),
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (tag, comment_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_comment_tags_tag_created ON comment_tags (tag, created_at DESC, comment_id DESC);
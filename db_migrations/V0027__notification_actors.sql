@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS notification_actors (
+    user_id UUID NOT NULL REFERENCES users(id),
+    group_key VARCHAR(128) NOT NULL,
+    actor_id UUID NOT NULL REFERENCES users(id),
+    PRIMARY KEY (user_id, group_key, actor_id)
+);
+
+INSERT INTO notification_actors (user_id, group_key, actor_id)
+SELECT n.user_id, n.group_key, a FROM notifications n, unnest(n.recent_actor_ids) a
+WHERE n.group_key IS NOT NULL
+ON CONFLICT DO NOTHING;
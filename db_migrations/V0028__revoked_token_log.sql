@@ -0,0 +1,3 @@
+ALTER TABLE revoked_tokens ADD COLUMN IF NOT EXISTS revoked_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_revoked ON revoked_tokens (revoked_at);
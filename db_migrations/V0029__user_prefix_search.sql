@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users ((lower(username) COLLATE "C")) WHERE is_blocked = FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_users_display_name_prefix ON users ((lower(display_name) COLLATE "C")) WHERE is_blocked = FALSE;
@@ -41,12 +41,19 @@ export const api = {
   post: (id: string) => request(`${API_URL}?action=post&id=${id}`),
   profile: (username: string) => request(`${API_URL}?action=profile&username=${username}`),
   comments: (postId: string) => request(`${API_URL}?action=comments&post_id=${postId}`),
+  commentThreads: (postId: string, cursor = "") => request(`${API_URL}?action=comments&mode=threaded&post_id=${postId}&cursor=${cursor}`),
+  commentReplies: (postId: string, parentId: string, cursor = "") => request(`${API_URL}?action=comments&post_id=${postId}&parent_id=${parentId}&cursor=${cursor}`),
   search: (q: string) => request(`${API_URL}?action=search&q=${q}`),
+  searchPosts: (q: string) => request(`${API_URL}?action=search_posts&q=${encodeURIComponent(q)}`),
+  tagFeed: (tag: string) => request(`${API_URL}?action=tag_feed&tag=${encodeURIComponent(tag)}`),
+  tagComments: (tag: string) => request(`${API_URL}?action=tag_feed&scope=comments&tag=${encodeURIComponent(tag)}`),
+  trending: () => request(`${API_URL}?action=trending`),
   followers: (userId: string) => request(`${API_URL}?action=followers&user_id=${userId}`),
   following: (userId: string) => request(`${API_URL}?action=following&user_id=${userId}`),
   friends: (userId: string) => request(`${API_URL}?action=friends&user_id=${userId}`),
   stories: () => request(`${API_URL}?action=stories`),
   notifications: () => request(`${API_URL}?action=notifications`),
+  badges: () => request(`${API_URL}?action=badges`),
   messages: () => request(`${API_URL}?action=messages`),
   conversation: (partnerId: string) => request(`${API_URL}?action=conversation&partner_id=${partnerId}`),
   userPosts: (userId: string, offset = 0) => request(`${API_URL}?action=user_posts&user_id=${userId}&offset=${offset}`),
@@ -93,6 +100,8 @@ export const api = {
     request(API_URL, { method: "POST", body: JSON.stringify({ action: "mark_read", sender_id: senderId }) }),
   createStory: (imageUrl: string, visibility: string) =>
     request(API_URL, { method: "POST", body: JSON.stringify({ action: "create_story", image_url: imageUrl, visibility }) }),
+  recordStoryViews: (storyIds: string[]) =>
+    request(API_URL, { method: "POST", body: JSON.stringify({ action: "record_story_views", story_ids: storyIds }) }),
   blockUser: (userId: string) =>
     request(API_URL, { method: "POST", body: JSON.stringify({ action: "block_user", user_id: userId }) }),
   unblockUser: (userId: string) =>
@@ -13,6 +13,7 @@ interface Notification {
   created_at: string;
   post_id?: string;
   from_user?: { id: string; username: string; display_name: string; is_verified: boolean; avatar?: string | null } | null;
+  actor_count?: number;
 }
 
 export default function Notifications() {
@@ -50,6 +51,7 @@ export default function Notifications() {
     follow_accepted: "UserCheck",
     verification: "BadgeCheck",
     message: "MessageCircle",
+    mention: "AtSign",
   };
 
   if (loading) return <div className="p-8 text-center"><Icon name="Loader2" size={24} className="animate-spin mx-auto" style={{ color: "var(--online-muted)" }} /></div>;
@@ -80,6 +82,9 @@ export default function Notifications() {
                 {n.from_user && (
                   <span className="font-semibold text-sm cursor-pointer" onClick={() => navigate(`/u/${n.from_user!.username}`)}>{n.from_user.display_name}</span>
                 )}
+                {n.actor_count && n.actor_count > 1 ? (
+                  <span className="text-sm" style={{ color: "var(--online-muted)" }}>и ещё {n.actor_count - 1}</span>
+                ) : null}
                 <span className="text-sm" style={{ color: "var(--online-muted)" }}>
                   {n.type === "like" ? "нравится ваш пост" :
                    n.type === "comment" ? "прокомментировал(а)" :
@@ -87,7 +92,8 @@ export default function Notifications() {
                    n.type === "follow_request" ? "хочет подписаться" :
                    n.type === "follow_accepted" ? "принял(а) заявку" :
                    n.type === "verification" ? n.content :
-                   n.type === "message" ? "отправил(а) сообщение" : n.content}
+                   n.type === "message" ? "отправил(а) сообщение" :
+                   n.type === "mention" ? "упомянул(а) вас" : n.content}
                 </span>
               </div>
               <span className="text-xs" style={{ color: "var(--online-muted)" }}>{formatTime(n.created_at)}</span>